@@ -0,0 +1,74 @@
+"""Latency of the latest-version list endpoints as history grows.
+
+Creates one game per history depth, pads every cell and offer with extra
+historical versions and then times `/v1/cells/by-game/<game_id>` and
+`/v1/offers/<game_id>`.
+
+Run inside the app container (see `make bench`).
+"""
+import json
+
+from bottleneck import get_connection
+from sqlalchemy.sql import text as sql_text
+
+from bigleague.storage import reset_tables
+from common import get_client, create_game, percentiles, time_calls
+
+VERSIONS_PER_KEY = (10, 100, 1000)
+ITERATIONS = 50
+
+PAD_CELLS = sql_text("""
+    INSERT INTO cell (game_id, home_index, away_index, timestamp, home_digit,
+                      away_digit, player_id)
+    SELECT game_id, home_index, away_index, timestamp - s, home_digit,
+           away_digit, player_id
+    FROM cell, generate_series(1, :versions) s
+    WHERE game_id = :game_id
+    """)
+
+PAD_OFFERS = sql_text("""
+    INSERT INTO offer (game_id, home_index, away_index, player_id, timestamp,
+                       type, price, state)
+    SELECT game_id, home_index, away_index, player_id, timestamp - s, type,
+           price, state
+    FROM offer, generate_series(1, :versions) s
+    WHERE game_id = :game_id
+    """)
+
+
+def pad_history(game_id, versions):
+    """Give every cell and offer in the game `versions` versions in total."""
+    with get_connection() as conn:
+        conn.execute(PAD_CELLS, game_id=game_id, versions=versions - 1)
+        conn.execute(PAD_OFFERS, game_id=game_id, versions=versions - 1)
+        conn.execute(sql_text('ANALYZE cell; ANALYZE offer'))
+
+
+def get_ok(client, url):
+    response = client.get(url)
+    # Lists are streamed, so errors can only show up in the body.
+    body = json.loads(response.get_data(as_text=True))
+    assert response.status_code == 200, body
+
+
+def main():
+    client = get_client()
+    reset_tables()
+    try:
+        print('%-10s %-20s %10s %10s' % ('versions', 'endpoint', 'p50 ms',
+                                         'p95 ms'))
+        for versions in VERSIONS_PER_KEY:
+            game = create_game(client, versions)
+            pad_history(game['id'], versions)
+            for endpoint in ('/v1/cells/by-game', '/v1/offers'):
+                url = '%s/%s' % (endpoint, game['id'])
+                p50, p95 = percentiles(time_calls(
+                    lambda: get_ok(client, url), ITERATIONS))
+                print('%-10d %-20s %10.2f %10.2f' % (versions, endpoint,
+                                                     p50, p95))
+    finally:
+        reset_tables()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Offers per second through the matching engine.
+
+"submit_offer" is the headline: each offer takes one transaction that
+locks its game and cell, rebuilds the cell's book from the database,
+and writes the offer, or the fill and the cell's new owner. "threads"
+is the same path from THREADS threads at once, as one process serving
+concurrent requests would run it. "batched" places BATCH_SIZE offers on
+distinct cells per transaction, as the batch endpoint does.
+
+"book" matches random offers against in-memory order books only. It is
+not a rate the engine reaches; it shows how little of each offer's time
+is spent matching rather than in the database.
+
+Run inside the app container (see `make bench`).
+"""
+import random
+import threading
+import time
+
+from bigleague.lib.matching import OrderBook, submit_offer, submit_offers
+from bigleague.storage import reset_tables
+from bigleague.storage.offers import OfferRejected
+from common import get_client, create_game, post_json
+
+BOOK_OFFERS = 200000
+ENGINE_OFFERS = 2000
+THREADS = 8
+BATCH_SIZE = 50
+PLAYERS = 50
+
+
+def random_offer(rng, players):
+    return {
+        'player_id': rng.choice(players),
+        'type': rng.choice(('buy', 'sell')),
+        'price': rng.randint(1, 100),
+        'timestamp': 0,
+    }
+
+
+def random_buy(rng, game_id, players, home_index=None, away_index=None):
+    return {
+        'game_id': game_id,
+        'home_index': (rng.randrange(10) if home_index is None
+                       else home_index),
+        'away_index': (rng.randrange(10) if away_index is None
+                       else away_index),
+        'player_id': rng.choice(players),
+        'type': 'buy',
+        'price': rng.randint(1, 100),
+    }
+
+
+def run_books(rng):
+    books = [OrderBook() for _ in range(100)]
+    players = ['player-%d' % index for index in range(PLAYERS)]
+    offers = [(rng.choice(books), random_offer(rng, players))
+              for _ in range(BOOK_OFFERS)]
+
+    fills = 0
+    start = time.perf_counter()
+    for book, offer in offers:
+        if book.submit(offer) is not None:
+            fills += 1
+    return BOOK_OFFERS / (time.perf_counter() - start), fills
+
+
+def submit_buys(offers):
+    """Submit offers one at a time, returning how many filled."""
+    fills = 0
+    for offer in offers:
+        try:
+            if submit_offer(offer)['state'] == 'filled':
+                fills += 1
+        except OfferRejected:
+            # The player already owns that cell.
+            continue
+    return fills
+
+
+def run_engine(rng, game_id, players):
+    offers = [random_buy(rng, game_id, players)
+              for _ in range(ENGINE_OFFERS)]
+    start = time.perf_counter()
+    fills = submit_buys(offers)
+    return ENGINE_OFFERS / (time.perf_counter() - start), fills
+
+
+def run_threads(rng, game_id, players):
+    offers = [random_buy(rng, game_id, players)
+              for _ in range(ENGINE_OFFERS)]
+    fills = []
+
+    def work(index):
+        fills.append(submit_buys(offers[index::THREADS]))
+
+    threads = [threading.Thread(target=work, args=(index,))
+               for index in range(THREADS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return ENGINE_OFFERS / (time.perf_counter() - start), sum(fills)
+
+
+def run_batched(rng, game_id, players):
+    cells = [(home_index, away_index)
+             for home_index in range(10) for away_index in range(10)]
+    batches = [[random_buy(rng, game_id, players, *cell)
+                for cell in rng.sample(cells, BATCH_SIZE)]
+               for _ in range(ENGINE_OFFERS // BATCH_SIZE)]
+
+    fills = 0
+    start = time.perf_counter()
+    for batch in batches:
+        while batch:
+            try:
+                placed = submit_offers(batch)
+            except OfferRejected as rejected:
+                # Drop the offer on a cell its player owns, and resend.
+                batch.remove(rejected.offer)
+                continue
+            fills += sum(offer['state'] == 'filled' for offer in placed)
+            break
+    return ENGINE_OFFERS / (time.perf_counter() - start), fills
+
+
+def main():
+    rng = random.Random(0)
+    client = get_client()
+    reset_tables()
+    try:
+        players = [post_json(client, '/v1/player', {
+            'handle': 'bench-%d' % index})['id'] for index in range(PLAYERS)]
+
+        runs = [('submit_offer', run_engine), ('threads', run_threads),
+                ('batched', run_batched)]
+        for name, run in runs:
+            game = create_game(client, name)
+            rate, fills = run(rng, game['id'], players)
+            print('%-12s %12.1f offers/s %8d fills' % (name, rate, fills))
+
+        rate, fills = run_books(rng)
+        print('%-12s %12.1f offers/s %8d fills (no database)' % (
+            'book', rate, fills))
+    finally:
+        reset_tables()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Throughput of PUT /v1/offer/... before and after INSERT ... RETURNING.
+
+"before" swaps in the old two-statement write (INSERT, then SELECT the
+newest version back) so both paths run against the same database. Both
+keep offer_current up to date and send the same notifications.
+
+Run inside the app container (see `make bench`).
+"""
+import time
+
+import bottleneck
+from bottleneck import get_connection
+from sqlalchemy.sql import text as sql_text
+
+import bigleague.storage.offers
+from bigleague.storage import reset_tables
+from common import get_client, create_game, post_json
+
+OFFERS = 1000
+
+
+def put_item_two_statements(item, table, fields, primary_keys=('id',),
+                            defaults=('timestamp',)):
+    """The write path as it was: INSERT, then SELECT the newest version.
+
+    The SELECT also keeps <table>_current up to date and sends the
+    notifications, as the single statement does, so both paths write the
+    same rows.
+    """
+    item = bottleneck._prepare_item(item, table, fields, primary_keys,
+                                    defaults)
+    keys = tuple(key for key in primary_keys if key != 'timestamp')
+    with get_connection() as conn:
+        query = sql_text(
+            """
+            INSERT INTO {table} ({field_names}) VALUES ({field_values});
+            WITH inserted AS (
+                SELECT {field_names}
+                FROM {table}
+                WHERE {conditions_clause}
+                ORDER BY timestamp DESC
+                LIMIT 1
+            ){write_clauses}
+            """.format(table=table,
+                       conditions_clause=' AND '.join(
+                           '%s = :%s_0' % (key, key) for key in keys),
+                       field_names=', '.join(fields),
+                       field_values=', '.join(
+                           bottleneck._put_value(table, field, 0, defaults,
+                                                 keys)
+                           for field in fields),
+                       write_clauses=bottleneck._write_clauses(
+                           table, fields, table in bottleneck._current_tables,
+                           bottleneck._notify_tables.get(table),
+                           table in bottleneck._reference_tables)))
+        results = conn.execute(query, **{
+            '%s_0' % field: value for field, value in item.items()
+        }).fetchall()
+    return dict(zip(fields, results[0]))
+
+
+def put_items_two_statements(items, table, fields, primary_keys=('id',),
+                             defaults=('timestamp',)):
+    """put_items as it was: two statements for every item."""
+    return [put_item_two_statements(item, table, fields, primary_keys,
+                                    defaults)
+            for item in items]
+
+
+def run(client, game_id, player_id):
+    start = time.perf_counter()
+    for index in range(OFFERS):
+        post_json(client, '/v1/offer/%s/by-index/%d/%d' % (
+            game_id, index % 100 // 10, index % 10), {
+            'player_id': player_id,
+            'type': 'buy',
+            # Below the house's asking price, so no offer ever fills and
+            # every PUT is the same write.
+            'price': 10 + index % 30,
+        }, method='put')
+    return OFFERS / (time.perf_counter() - start)
+
+
+def main():
+    client = get_client()
+    reset_tables()
+    try:
+        game = create_game(client, 'put-offer')
+        player = post_json(client, '/v1/player', {'handle': 'bench'})
+
+        # Offers are written by put_offers, which imported put_items by
+        # name, so swap it where it is used.
+        returning = bigleague.storage.offers.put_items
+        bigleague.storage.offers.put_items = put_items_two_statements
+        try:
+            before = run(client, game['id'], player['id'])
+        finally:
+            bigleague.storage.offers.put_items = returning
+
+        after = run(client, game['id'], player['id'])
+        print('%-24s %10.1f offers/s' % ('INSERT; SELECT', before))
+        print('%-24s %10.1f offers/s' % ('INSERT ... RETURNING', after))
+    finally:
+        reset_tables()
+
+
+if __name__ == '__main__':
+    main()
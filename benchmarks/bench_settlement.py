@@ -0,0 +1,120 @@
+"""Games per second through the settlement engine.
+
+"compute" finds winners and payouts for every period of random boards in
+memory, which bounds what one process can settle. "settle" seeds GAMES
+games with random scores and digits straight into the database and
+settles one period of all of them through settle_period, reads and payout
+inserts included.
+
+Run inside the app container (see `make bench`).
+"""
+import time
+
+import numpy as np
+from sqlalchemy.sql import text as sql_text
+
+from bottleneck import backfill_current, get_connection
+
+from bigleague.lib.settlement import compute_payouts, settle_period
+from bigleague.storage import get_current_tables, reset_tables
+from common import get_client, post_json
+
+GAMES = 10000
+PERIODS = 4
+PLAYERS = 50
+
+SEED_GAMES = sql_text("""
+    INSERT INTO game (id, event_name, sport, state, home_team_id,
+                      away_team_id, home_score, away_score)
+    SELECT md5('settlement-' || s)::uuid, 'Settlement ' || s, 'football',
+           'playing', :home_team_id, :away_team_id,
+           (random() * 50)::int, (random() * 50)::int
+    FROM generate_series(1, :games) s
+    RETURNING id
+    """)
+
+# Deals each game's digits by shuffling them per side, so the winning
+# cell is anywhere on the board, and hands its cells to random players.
+SEED_CELLS = sql_text("""
+    WITH digits AS (
+        SELECT game.id AS game_id, side, n,
+               row_number() OVER (PARTITION BY game.id, side
+                                  ORDER BY random()) - 1 AS digit
+        FROM game, (VALUES ('home'), ('away')) sides (side),
+             generate_series(0, 9) n
+        WHERE game.event_name LIKE 'Settlement %'
+    )
+    INSERT INTO cell (game_id, home_index, away_index, home_digit,
+                      away_digit, player_id)
+    SELECT home.game_id, home.n, away.n, home.digit, away.digit,
+           (CAST(:player_ids AS UUID[]))[
+               1 + CAST(floor(random() * :players) AS INT)]
+    FROM digits home
+    JOIN digits away ON away.game_id = home.game_id AND away.side = 'away'
+    WHERE home.side = 'home'
+    """)
+
+
+def random_boards(rng, count):
+    boards = np.empty((count, 10, 10), dtype=np.int16)
+    positions = np.arange(100).reshape(10, 10)
+    for index in range(count):
+        boards[index] = positions[rng.permutation(10)][:, rng.permutation(10)]
+    return boards
+
+
+def run_compute(rng):
+    boards = random_boards(rng, GAMES)
+    owners = rng.randint(0, PLAYERS, (GAMES, 100)).astype(np.int32)
+    home_scores = rng.randint(0, 50, (GAMES, PERIODS))
+    away_scores = rng.randint(0, 50, (GAMES, PERIODS))
+
+    start = time.perf_counter()
+    compute_payouts(boards, owners, home_scores, away_scores,
+                    np.full(GAMES, PERIODS))
+    return GAMES / (time.perf_counter() - start)
+
+
+def seed_games(client):
+    home_team, away_team = [post_json(client, '/v1/team', {
+        'name': '%s Settlement' % name,
+        'sport': 'football',
+    }) for name in ('Home', 'Away')]
+    player_ids = [post_json(client, '/v1/player', {
+        'handle': 'settle-%d' % index})['id'] for index in range(PLAYERS)]
+
+    with get_connection() as conn:
+        # The same games, scores and boards on every run.
+        conn.execute(sql_text('SELECT setseed(0)'))
+        game_ids = [str(row[0]) for row in conn.execute(
+            SEED_GAMES, games=GAMES, home_team_id=home_team['id'],
+            away_team_id=away_team['id'])]
+        conn.execute(SEED_CELLS, player_ids=player_ids, players=PLAYERS)
+
+    for table in ('game', 'cell'):
+        backfill_current(table, get_current_tables()[table])
+    return game_ids
+
+
+def run_settle(client):
+    game_ids = seed_games(client)
+    start = time.perf_counter()
+    payouts = settle_period(game_ids, '1st quarter')
+    assert len(payouts) == GAMES
+    return GAMES / (time.perf_counter() - start)
+
+
+def main():
+    rng = np.random.RandomState(0)
+    client = get_client()
+    reset_tables()
+    try:
+        for name, rate in (('compute', run_compute(rng)),
+                           ('settle', run_settle(client))):
+            print('%-8s %12.1f games/s' % (name, rate))
+    finally:
+        reset_tables()
+
+
+if __name__ == '__main__':
+    main()
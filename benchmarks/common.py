@@ -0,0 +1,51 @@
+"""Helpers shared by the benchmarks."""
+import json
+import statistics
+import time
+
+from bigleague.app import create_app_singletons
+
+
+def get_client():
+    """Build the app and return a test client for it."""
+    app, _ = create_app_singletons()
+    return app.test_client()
+
+
+def post_json(client, url, body, method='post'):
+    """Send a JSON body and decode the JSON response."""
+    response = getattr(client, method)(url, data=json.dumps(body),
+                                       content_type='application/json')
+    assert response.status_code in (200, 201), response.get_data()
+    return json.loads(response.get_data(as_text=True))
+
+
+def create_game(client, suffix):
+    """Create two teams and a game between them."""
+    home_team, away_team = [post_json(client, '/v1/team', {
+        'name': '%s %s' % (name, suffix),
+        'sport': 'football',
+    }) for name in ('Home', 'Away')]
+    return post_json(client, '/v1/game', {
+        'event_name': 'Benchmark %s' % suffix,
+        'sport': 'football',
+        'home_team_id': home_team['id'],
+        'away_team_id': away_team['id'],
+    })
+
+
+def percentiles(timings):
+    """Return the p50 and p95 of a list of timings."""
+    timings = sorted(timings)
+    return (statistics.median(timings),
+            timings[max(int(len(timings) * 0.95) - 1, 0)])
+
+
+def time_calls(f, iterations):
+    """Call f repeatedly and return each call's latency in milliseconds."""
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        f()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
@@ -0,0 +1,29 @@
+"""Add (primary keys..., timestamp DESC) indexes for latest-version reads."""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '4c1d0e7a9f21'
+down_revision = 'b37b9ce2be76'
+branch_labels = None
+depends_on = None
+
+
+LATEST_VERSION_INDEXES = {
+    'ix_cell_latest': ('cell', ['game_id', 'home_index', 'away_index']),
+    'ix_offer_latest': ('offer', ['game_id', 'home_index', 'away_index',
+                                  'player_id']),
+    'ix_game_latest': ('game', ['id']),
+}
+
+
+def upgrade():
+    """Upgrade."""
+    for index_name, (table, primary_keys) in LATEST_VERSION_INDEXES.items():
+        op.execute("CREATE INDEX %s ON %s (%s, timestamp DESC)" % (
+            index_name, table, ', '.join(primary_keys)))
+
+
+def downgrade():
+    """Downgrade."""
+    for index_name in LATEST_VERSION_INDEXES:
+        op.execute("DROP INDEX IF EXISTS %s" % index_name)
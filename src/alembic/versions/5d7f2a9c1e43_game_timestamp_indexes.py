@@ -0,0 +1,27 @@
+"""Add (game_id, timestamp) indexes for changes-since reads."""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5d7f2a9c1e43'
+down_revision = '8e52b1f3c6d0'
+branch_labels = None
+depends_on = None
+
+
+GAME_TIMESTAMP_INDEXES = {
+    'ix_cell_game_timestamp': 'cell',
+    'ix_offer_game_timestamp': 'offer',
+}
+
+
+def upgrade():
+    """Upgrade."""
+    for index_name, table in GAME_TIMESTAMP_INDEXES.items():
+        op.execute("CREATE INDEX %s ON %s (game_id, timestamp)" % (
+            index_name, table))
+
+
+def downgrade():
+    """Downgrade."""
+    for index_name in GAME_TIMESTAMP_INDEXES:
+        op.execute("DROP INDEX IF EXISTS %s" % index_name)
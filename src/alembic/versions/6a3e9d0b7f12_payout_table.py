@@ -0,0 +1,32 @@
+"""Add the payout table recording each period's winning cell."""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '6a3e9d0b7f12'
+down_revision = '5d7f2a9c1e43'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Upgrade."""
+    op.execute("""
+        CREATE TABLE payout (
+            game_id UUID NOT NULL,
+            period VARCHAR(32) NOT NULL,
+            timestamp BIGINT DEFAULT CAST(1000 * EXTRACT(EPOCH FROM NOW()) AS BIGINT) NOT NULL,
+            home_score INT NOT NULL,
+            away_score INT NOT NULL,
+            home_index SMALLINT NOT NULL,
+            away_index SMALLINT NOT NULL,
+            player_id UUID NOT NULL,
+            amount INT NOT NULL
+        )""")  # noqa
+    op.create_primary_key("pk_payout", "payout", ["game_id", "period",
+                                                  "timestamp"])
+    op.execute("CREATE INDEX ix_payout_player ON payout (player_id)")
+
+
+def downgrade():
+    """Downgrade."""
+    op.execute("DROP TABLE IF EXISTS payout")
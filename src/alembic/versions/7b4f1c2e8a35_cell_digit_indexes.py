@@ -0,0 +1,22 @@
+"""Add (game_id, home_digit, away_digit) indexes for lookups by digits."""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '7b4f1c2e8a35'
+down_revision = '6a3e9d0b7f12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Upgrade."""
+    op.execute("CREATE INDEX ix_cell_digits ON cell "
+               "(game_id, home_digit, away_digit, timestamp DESC)")
+    op.execute("CREATE INDEX ix_cell_current_digits ON cell_current "
+               "(game_id, home_digit, away_digit)")
+
+
+def downgrade():
+    """Downgrade."""
+    op.execute("DROP INDEX IF EXISTS ix_cell_digits")
+    op.execute("DROP INDEX IF EXISTS ix_cell_current_digits")
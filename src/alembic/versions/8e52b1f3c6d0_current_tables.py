@@ -0,0 +1,39 @@
+"""Add <table>_current tables holding the latest version per primary key."""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8e52b1f3c6d0'
+down_revision = '4c1d0e7a9f21'
+branch_labels = None
+depends_on = None
+
+
+CURRENT_TABLES = {
+    'cell': ['game_id', 'home_index', 'away_index'],
+    'offer': ['game_id', 'home_index', 'away_index', 'player_id'],
+    'game': ['id'],
+    'team': ['id'],
+    'player': ['id'],
+}
+
+
+def upgrade():
+    """Upgrade."""
+    for table, primary_keys in CURRENT_TABLES.items():
+        op.execute("""
+            CREATE TABLE {table}_current (LIKE {table} INCLUDING DEFAULTS)
+            """.format(table=table))
+        op.create_primary_key("pk_%s_current" % table, "%s_current" % table,
+                              primary_keys)
+        op.execute("""
+            INSERT INTO {table}_current
+            SELECT DISTINCT ON ({primary_keys}) *
+            FROM {table}
+            ORDER BY {primary_keys}, timestamp DESC
+            """.format(table=table, primary_keys=', '.join(primary_keys)))
+
+
+def downgrade():
+    """Downgrade."""
+    for table in CURRENT_TABLES:
+        op.execute("DROP TABLE IF EXISTS %s_current" % table)
@@ -0,0 +1,20 @@
+"""Add game.observed_at, when the feed observed the game's score."""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9c2d4e6f8a10'
+down_revision = '7b4f1c2e8a35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Upgrade."""
+    for table in ('game', 'game_current'):
+        op.execute("ALTER TABLE %s ADD COLUMN observed_at BIGINT" % table)
+
+
+def downgrade():
+    """Downgrade."""
+    for table in ('game', 'game_current'):
+        op.execute("ALTER TABLE %s DROP COLUMN IF EXISTS observed_at" % table)
@@ -1,12 +1,20 @@
-from flask import Flask
+import logging
+
+import bottleneck
+from flask import Flask, request
 from flask_restplus import Api
 
 import bigleague.views.health
+import bigleague.views.metrics
 import bigleague.views.teams
 import bigleague.views.players
 import bigleague.views.cells
 import bigleague.views.games
 import bigleague.views.offers
+import bigleague.views.boards
+import bigleague.views.streams
+
+log = logging.getLogger(__name__)
 
 
 def create_app_singletons():
@@ -19,10 +27,40 @@ def create_app_singletons():
               point in time.""")
 
     bigleague.views.health.init_app(app, api)
+    bigleague.views.metrics.init_app(app, api)
     bigleague.views.teams.init_app(app, api)
     bigleague.views.players.init_app(app, api)
     bigleague.views.cells.init_app(app, api)
     bigleague.views.games.init_app(app, api)
     bigleague.views.offers.init_app(app, api)
+    bigleague.views.boards.init_app(app, api)
+    bigleague.views.streams.init_app(app, api)
+
+    init_unit_of_work(app)
 
     return app, api
+
+
+def init_unit_of_work(app):
+    """Give each request its own bottleneck unit of work.
+
+    Reads in GET requests share one snapshot. Writes are committed before
+    the response is sent, so a failed commit still becomes an error.
+    Streamed responses keep the unit of work open until the body is done.
+    """
+    @app.before_request
+    def begin_unit_of_work():
+        bottleneck.begin_request(
+            read_only=request.method in ('GET', 'HEAD', 'OPTIONS'))
+
+    @app.after_request
+    def finish_unit_of_work(response):
+        if not response.is_streamed:
+            bottleneck.finish_request(commit=response.status_code < 400)
+        return response
+
+    @app.teardown_request
+    def end_unit_of_work(exc):
+        stats = bottleneck.end_request(exc)
+        if stats:
+            log.debug(dict(msg='identity-map', path=request.path, **stats))
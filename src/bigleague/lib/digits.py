@@ -0,0 +1,60 @@
+"""The shuffled digits of a game's rows and columns.
+
+Cells are created without digits. When the game starts, the digits are
+dealt at random to the home rows and, separately, to the away columns. A
+DigitIndex inverts the deal, so finding the cell a score lands on is two
+list lookups.
+"""
+import random
+from collections import namedtuple
+
+from bottleneck.cache import LRUCache
+
+DIGITS = tuple(range(10))
+
+# Digits never change once dealt, so indexes can be kept until evicted.
+DIGIT_INDEX_CACHE_SIZE = 10000
+
+# The home and away index of each digit.
+DigitIndex = namedtuple('DigitIndex', ['home_indexes', 'away_indexes'])
+
+_random = random.SystemRandom()
+_digit_indexes = LRUCache(DIGIT_INDEX_CACHE_SIZE)
+
+
+def deal_digits():
+    """Return (home_digits, away_digits): a random digit for each index."""
+    home_digits, away_digits = list(DIGITS), list(DIGITS)
+    _random.shuffle(home_digits)
+    _random.shuffle(away_digits)
+    return home_digits, away_digits
+
+
+def build_digit_index(home_digits, away_digits):
+    """Invert the digits of each index into the index of each digit."""
+    home_indexes = [None] * len(DIGITS)
+    away_indexes = [None] * len(DIGITS)
+    for index, digit in enumerate(home_digits):
+        home_indexes[digit] = index
+    for index, digit in enumerate(away_digits):
+        away_indexes[digit] = index
+    return DigitIndex(home_indexes, away_indexes)
+
+
+def get_cell_indexes(digit_index, home_score, away_score):
+    """The (home_index, away_index) of the cell a score lands on."""
+    return (digit_index.home_indexes[home_score % len(DIGITS)],
+            digit_index.away_indexes[away_score % len(DIGITS)])
+
+
+def remember_digit_index(game_id, digit_index):
+    _digit_indexes.put(str(game_id), digit_index)
+
+
+def get_remembered_digit_index(game_id):
+    """The game's digit index, if this process has it."""
+    return _digit_indexes.get(str(game_id))
+
+
+def get_digit_index_stats():
+    return _digit_indexes.stats()
@@ -1 +1,4 @@
 HOUSE_PLAYER_ID = '01eb998b-bcba-4390-9ddd-af4989aaf6a8'
+
+# What the house first offers each cell of a new board for.
+HOUSE_CELL_PRICE = 50
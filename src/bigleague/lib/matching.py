@@ -0,0 +1,253 @@
+"""Price-time priority matching of cell offers.
+
+Every cell has an order book of its open offers. An incoming offer that
+crosses the best offer resting on the other side fills against it, at the
+resting offer's price; otherwise it rests in the book. An offer is for the
+whole cell, so it fills at most once.
+
+Nothing is kept between calls: a cell's book is built from its open
+offers while the cell is locked, so every process matches against the
+same book.
+"""
+import heapq
+import itertools
+from collections import namedtuple
+
+from bottleneck import get_timestamp_millis, transaction
+from bigleague.storage.cells import lock_cells, put_cells
+from bigleague.storage.games import lock_games, OPEN_STATES
+from bigleague.storage.offers import (get_offers, put_offers,
+                                      put_filled_offers, OfferRejected,
+                                      OFFER_OPEN, OFFER_CANCELED,
+                                      REJECT_GAME_CLOSED, REJECT_NO_CELL,
+                                      REJECT_NO_PLAYER, REJECT_NOT_OWNER,
+                                      REJECT_OWN_CELL)
+from bigleague.storage.players import get_players_by_id
+
+BUY = 'buy'
+SELL = 'sell'
+
+Fill = namedtuple('Fill', ['incoming', 'resting', 'price'])
+
+
+class OrderBook(object):
+    """The open offers on one cell, best price first, then oldest first.
+
+    A player has at most one offer per cell, so offers are keyed by player
+    and a new offer replaces the player's previous one.
+    """
+
+    def __init__(self, offers=()):
+        self._sequence = itertools.count()
+        self._heaps = {BUY: [], SELL: []}
+        self._entries = {}
+        for offer in sorted(offers, key=lambda offer: offer['timestamp']):
+            self._rest(offer)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def best(self, type_):
+        """The offer of that type first in line to fill, or None."""
+        heap = self._heaps[type_]
+        while heap and heap[0][-1] is None:
+            heapq.heappop(heap)
+        return heap[0][-1] if heap else None
+
+    def submit(self, offer):
+        """Add an offer, returning its Fill if it crossed, else None."""
+        self.remove(offer['player_id'])
+
+        if offer['type'] == BUY:
+            resting = self.best(SELL)
+            crosses = resting is not None and offer['price'] >= resting['price']
+        else:
+            resting = self.best(BUY)
+            crosses = resting is not None and offer['price'] <= resting['price']
+
+        if not crosses:
+            self._rest(offer)
+            return None
+
+        self.remove(resting['player_id'])
+        return Fill(offer, resting, resting['price'])
+
+    def get(self, player_id):
+        """A player's resting offer, or None."""
+        entry = self._entries.get(str(player_id))
+        return entry[-1] if entry is not None else None
+
+    def remove(self, player_id):
+        """Drop a player's resting offer, if there is one."""
+        entry = self._entries.pop(str(player_id), None)
+        if entry is not None:
+            # Lazily deleted: best() skips it when it reaches the top.
+            entry[-1] = None
+
+    def _rest(self, offer):
+        priority = offer['price'] if offer['type'] == SELL else -offer['price']
+        entry = [priority, next(self._sequence), offer]
+        self._entries[str(offer['player_id'])] = entry
+        heapq.heappush(self._heaps[offer['type']], entry)
+
+
+def submit_offer(offer):
+    """Place an offer, filling it right away if it crosses.
+
+    A fill writes the filled versions of both offers and the cell's new
+    owner in one transaction. Returns the stored version of the offer.
+    Raises OfferRejected if the cell or player does not exist, the game
+    is over, or the player may not make that offer on the cell.
+    """
+    return submit_offers([offer])[0]
+
+
+def submit_offers(offers):
+    """Place offers on distinct cells, all in one transaction.
+
+    Returns the stored versions in the same order as the offers. If any
+    offer is rejected, none are placed.
+    """
+    return place_and_cancel(offers, [])[0]
+
+
+def cancel_offers(offers):
+    """Cancel open offers on distinct cells, all in one transaction.
+
+    Returns the canceled versions, with None for offers no longer open.
+    """
+    return place_and_cancel([], offers)[1]
+
+
+def place_and_cancel(offers, cancels):
+    """Place some offers and cancel others, on distinct cells.
+
+    The games are locked FOR SHARE and the cells FOR UPDATE first, and
+    stay locked until the outermost transaction ends, so the state and
+    owner checks, the order books and the writes all see the board as it
+    is in the database, whichever process wrote it last. A canceled offer
+    leaves its book, and its canceled version is written, under the same
+    locks, so nothing can match it meanwhile. Returns (placed, canceled)
+    in the order of offers and cancels.
+    """
+    keys = [_cell_key(offer) for offer in offers]
+    cancel_keys = [_cell_key(offer) for offer in cancels]
+    assert len(set(keys + cancel_keys)) == len(keys + cancel_keys), (
+        'One offer per cell')
+
+    with transaction():
+        games = lock_games({key[0] for key in keys + cancel_keys}, share=True)
+        cells = _lock_cells(keys + cancel_keys)
+        _check(keys, offers, cells, games)
+        books = _load_books(keys + cancel_keys)
+        canceled = _cancel(cancel_keys, cancels, books)
+        fills = [books[key].submit(offer)
+                 for key, offer in zip(keys, offers)]
+        return _put_offers(offers, fills, cells), canceled
+
+
+def _lock_cells(keys):
+    """Lock the cells, returning them by key."""
+    return {_cell_key(cell): cell for cell in lock_cells(keys)}
+
+
+def _check(keys, offers, cells, games):
+    """Raise OfferRejected unless every offer may be placed.
+
+    The states and owners come from the locked games and cells, and the
+    players are looked up together.
+    """
+    players = get_players_by_id({offer['player_id'] for offer in offers})
+    for key, offer in zip(keys, offers):
+        cell = cells.get(key)
+        if cell is None:
+            raise OfferRejected(REJECT_NO_CELL, offer)
+        if games[key[0]]['state'] not in OPEN_STATES:
+            raise OfferRejected(REJECT_GAME_CLOSED, offer)
+        if str(offer['player_id']) not in players:
+            raise OfferRejected(REJECT_NO_PLAYER, offer)
+
+        owns = str(cell['player_id']) == str(offer['player_id'])
+        if offer['type'] == SELL and not owns:
+            raise OfferRejected(REJECT_NOT_OWNER, offer)
+        if offer['type'] == BUY and owns:
+            raise OfferRejected(REJECT_OWN_CELL, offer)
+
+
+def _load_books(keys):
+    """Build the order book of each locked cell from its open offers.
+
+    The open offers are read with one query per game, for the rows and
+    columns of its cells, and then sorted out by cell.
+    """
+    games = {}
+    for game_id, home_index, away_index in keys:
+        rows, columns = games.setdefault(game_id, (set(), set()))
+        rows.add(home_index)
+        columns.add(away_index)
+
+    offers = {key: [] for key in keys}
+    for game_id, (rows, columns) in games.items():
+        for offer in get_offers(game_id=game_id, home_index=tuple(rows),
+                                away_index=tuple(columns), state=OFFER_OPEN):
+            key = _cell_key(offer)
+            if key in offers:
+                offers[key].append(offer)
+    return {key: OrderBook(cell_offers) for key, cell_offers in offers.items()}
+
+
+def _cancel(keys, offers, books):
+    """Take the players' open offers out of their books and cancel them."""
+    open_offers = [books[key].get(offer['player_id'])
+                   for key, offer in zip(keys, offers)]
+    for key, offer in zip(keys, offers):
+        books[key].remove(offer['player_id'])
+
+    stored = iter(put_offers([dict(offer, state=OFFER_CANCELED)
+                              for offer in open_offers if offer]))
+    return [next(stored) if offer else None for offer in open_offers]
+
+
+def _cell_key(offer):
+    return (str(offer['game_id']), int(offer['home_index']),
+            int(offer['away_index']))
+
+
+def _put_offers(offers, fills, cells):
+    """Persist resting offers and fills, one statement per table."""
+    resting = [offer for offer, fill in zip(offers, fills) if fill is None]
+    stored = iter(put_offers(resting) if resting else [])
+    filled = iter(_put_fills([fill for fill in fills if fill is not None],
+                             cells))
+    return [next(stored) if fill is None else next(filled)
+            for fill in fills]
+
+
+def _put_fills(fills, cells):
+    """Persist fills, returning the incoming offers' filled versions.
+
+    cells holds the current version of each cell, and is updated with the
+    new owners.
+    """
+    if not fills:
+        return []
+
+    timestamp_filled = get_timestamp_millis()
+    versions = []
+    for fill in fills:
+        for offer, counterparty in ((fill.incoming, fill.resting),
+                                    (fill.resting, fill.incoming)):
+            versions.append(dict(
+                offer, counterparty_player_id=counterparty['player_id'],
+                counterparty_price=fill.price,
+                timestamp_filled=timestamp_filled))
+    filled = put_filled_offers(versions)
+
+    new_owners = []
+    for fill in fills:
+        buyer = fill.incoming if fill.incoming['type'] == BUY else fill.resting
+        new_owners.append(dict(cells[_cell_key(fill.incoming)],
+                               player_id=buyer['player_id']))
+    for cell in put_cells(new_owners):
+        cells[_cell_key(cell)] = cell
+    return filled[::2]
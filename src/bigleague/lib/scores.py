@@ -0,0 +1,115 @@
+"""Live scores from the feed, coalesced into as few game versions as possible.
+
+The feed sends bursts of (game_id, home_score, away_score, observed_at)
+events, several per second per game. A batch of events is one flush
+window: only the latest event of each game survives it, and events no
+newer than the game's stored observed_at are dropped as duplicates or
+out of order. The games are locked while they are compared and written,
+so concurrent batches apply in observed_at order. The surviving scores
+are written with one bulk insert.
+"""
+from werkzeug.exceptions import BadRequest
+
+from bottleneck import transaction
+from bigleague.lib.digits import (build_digit_index, get_cell_indexes,
+                                  get_remembered_digit_index,
+                                  remember_digit_index)
+from bigleague.lib.sports import GameState
+from bigleague.storage.cells import get_cells
+from bigleague.storage.games import lock_games, put_games
+
+# Most events accepted in one batch.
+MAX_SCORE_EVENTS = 10000
+
+SCORE_FIELDS = ('home_score', 'away_score', 'observed_at')
+
+
+def coalesce_scores(events):
+    """Keep the latest event of each game, by observed_at.
+
+    Of two events observed at the same time, the later one in the batch
+    wins. Returns a dict of game id to event.
+    """
+    latest = {}
+    for event in events:
+        game_id = str(event['game_id'])
+        kept = latest.get(game_id)
+        if kept is None or kept['observed_at'] <= event['observed_at']:
+            latest[game_id] = event
+    return latest
+
+
+def ingest_scores(events):
+    """Write the latest score of each game in a batch of feed events.
+
+    Games that do not exist or are not being played are skipped. Returns
+    (games, rows): the current version of each game with an event, by id,
+    and the number of events written, coalesced or dropped.
+    """
+    events = list(events)
+    if len(events) > MAX_SCORE_EVENTS:
+        raise BadRequest("At most %d score events may be sent at once." %
+                         MAX_SCORE_EVENTS)
+
+    latest = coalesce_scores(events)
+    with transaction():
+        games = lock_games(latest)
+        updates = [dict(game, **{field: latest[game_id][field]
+                                 for field in SCORE_FIELDS})
+                   for game_id, game in games.items()
+                   if _is_newer(game, latest[game_id])]
+        written = put_games(updates)
+
+    games.update((str(game['id']), game) for game in written)
+    return games, {
+        'written': len(written),
+        'coalesced': len(events) - len(latest),
+        'dropped': len(latest) - len(written),
+    }
+
+
+def _is_newer(game, event):
+    if game['state'] != GameState.playing:
+        return False
+    return game['observed_at'] is None or (
+        game['observed_at'] < event['observed_at'])
+
+
+def get_winning_cells(games):
+    """The (home_index, away_index) each game's current score lands on.
+
+    Uses the digit indexes this process remembers, and loads the digits
+    of the other games with one cell query. Games without digits map to
+    None.
+    """
+    indexes = {game_id: get_remembered_digit_index(game_id)
+               for game_id in games}
+    missing = [game_id for game_id, index in indexes.items()
+               if index is None]
+    if missing:
+        indexes.update(_load_digit_indexes(missing))
+
+    return {game_id: get_cell_indexes(indexes[game_id], game['home_score'],
+                                      game['away_score'])
+            if indexes.get(game_id) else None
+            for game_id, game in games.items()}
+
+
+def _load_digit_indexes(game_ids):
+    """Build and remember the digit index of each game with digits."""
+    boards = {}
+    for cell in get_cells(game_id=tuple(game_ids)):
+        if cell['home_digit'] is not None and cell['away_digit'] is not None:
+            boards.setdefault(str(cell['game_id']), []).append(cell)
+
+    indexes = {}
+    for game_id, cells in boards.items():
+        home_digits = {cell['home_index']: cell['home_digit']
+                       for cell in cells}
+        away_digits = {cell['away_index']: cell['away_digit']
+                       for cell in cells}
+        indexes[game_id] = build_digit_index(
+            [home_digits[index] for index in sorted(home_digits)],
+            [away_digits[index] for index in sorted(away_digits)])
+        remember_digit_index(game_id, indexes[game_id])
+    return indexes
@@ -0,0 +1,168 @@
+"""Settle squares: pay the owner of each period's winning cell.
+
+A cell wins a period when its home and away digits are the last digits of
+the home and away scores at the end of the period. Boards are loaded as
+BOARD_SIZE x BOARD_SIZE arrays indexed by (home digit, away digit), so the
+winners and payouts of a whole batch of games come out of a few NumPy
+operations instead of a loop over games and cells.
+"""
+import numpy as np
+
+from bottleneck import get_items, transaction
+from bigleague.lib.house import HOUSE_CELL_PRICE
+from bigleague.lib.sports import GameState, get_scoring_periods
+from bigleague.storage.boards import BOARD_SIZE
+from bigleague.storage.cells import get_cells
+from bigleague.storage.games import GAME_TABLE, get_game_fields
+from bigleague.storage.payouts import put_payouts
+
+# Games settled per transaction, and so per bulk insert of payouts.
+SETTLE_BATCH_SIZE = 1000
+
+# Marks a board slot whose digits have not been assigned.
+NO_CELL = -1
+
+SETTLED_STATES = (GameState.playing, GameState.complete)
+
+
+def find_winners(boards, home_scores, away_scores):
+    """Look up the winning slot of every game on a stack of boards.
+
+    boards is an (n, BOARD_SIZE, BOARD_SIZE) array indexed by [game, home
+    digit, away digit]. The scores are arrays of n scores, or of shape
+    (n, periods) to settle several periods of each game at once. Returns
+    the boards' values at the winning digits, in the scores' shape.
+    """
+    home_scores = np.asarray(home_scores)
+    away_scores = np.asarray(away_scores)
+    games = _game_axis(len(boards), home_scores.ndim)
+    return boards[games, home_scores % BOARD_SIZE, away_scores % BOARD_SIZE]
+
+
+def _game_axis(count, ndim):
+    """Game numbers shaped to broadcast against (n, ...) score arrays."""
+    return np.arange(count).reshape((-1,) + (1,) * (ndim - 1))
+
+
+def load_boards(game_ids, timestamp=None):
+    """Load the cells of many games in one query, as arrays.
+
+    Returns (boards, owners, players). boards is (n, BOARD_SIZE,
+    BOARD_SIZE), holding the position (home_index * BOARD_SIZE +
+    away_index) of the cell with those digits, or NO_CELL. owners is
+    (n, BOARD_SIZE ** 2) and holds, by position, the index of the cell's
+    owner in players, or -1.
+    """
+    game_index = {str(game_id): index
+                  for index, game_id in enumerate(game_ids)}
+    boards = np.full((len(game_index), BOARD_SIZE, BOARD_SIZE), NO_CELL,
+                     dtype=np.int16)
+    owners = np.full((len(game_index), BOARD_SIZE ** 2), -1, dtype=np.int32)
+    if not game_index:
+        return boards, owners, []
+
+    cells = get_cells(game_id=tuple(game_index), timestamp=timestamp)
+    if not cells:
+        return boards, owners, []
+
+    games = np.array([game_index[str(cell['game_id'])] for cell in cells])
+    positions = np.array([cell['home_index'] * BOARD_SIZE
+                          + cell['away_index'] for cell in cells])
+    players, player_codes = np.unique(
+        [str(cell['player_id']) for cell in cells], return_inverse=True)
+    owners[games, positions] = player_codes
+
+    assigned = np.array([cell['home_digit'] is not None
+                         and cell['away_digit'] is not None
+                         for cell in cells])
+    home_digits = np.array([cell['home_digit'] or 0 for cell in cells])
+    away_digits = np.array([cell['away_digit'] or 0 for cell in cells])
+    boards[games[assigned], home_digits[assigned],
+           away_digits[assigned]] = positions[assigned]
+
+    return boards, owners, [str(player) for player in players]
+
+
+def compute_payouts(boards, owners, home_scores, away_scores, periods):
+    """Find each game's winner and what it is paid.
+
+    The pot of a game is HOUSE_CELL_PRICE for every cell on its board,
+    split evenly over the game's number of scoring `periods`. Scores are
+    shaped as for find_winners, and so are the (positions, winners,
+    amounts) returned. Positions are NO_CELL and winners -1 where the
+    winning digits are not on the board.
+    """
+    positions = find_winners(boards, home_scores, away_scores)
+    games = _game_axis(len(boards), positions.ndim)
+    settled = positions != NO_CELL
+    winners = np.where(settled, owners[games, positions], -1)
+    pots = (owners != -1).sum(axis=1) * HOUSE_CELL_PRICE
+    shares = pots // np.asarray(periods)
+    amounts = np.where(settled, shares.reshape(games.shape), 0)
+    return positions, winners, amounts
+
+
+def settle_period(game_ids, period):
+    """Pay out `period` of each game at the game's current score.
+
+    Games are settled SETTLE_BATCH_SIZE at a time, each batch in one
+    transaction with one bulk insert of its payouts. Games that are not
+    under way, have no such period, or have no digits yet are skipped.
+    Returns the payouts written.
+    """
+    game_ids = list(game_ids)
+    payouts = []
+    for start in range(0, len(game_ids), SETTLE_BATCH_SIZE):
+        with transaction():
+            payouts += _settle_batch(
+                game_ids[start:start + SETTLE_BATCH_SIZE], period)
+    return payouts
+
+
+def settle_final_period(game):
+    """Pay out the last scoring period of a game that has just completed.
+
+    Returns the payouts written, none if the sport has no scoring periods.
+    """
+    periods = get_scoring_periods(game['sport'])
+    if not periods:
+        return []
+    return settle_period([game['id']], periods[-1])
+
+
+def _settle_batch(game_ids, period):
+    games = get_items(game_ids, GAME_TABLE, get_game_fields())
+    games = [game for game in games.values()
+             if game['state'] in SETTLED_STATES
+             and period in (get_scoring_periods(game['sport']) or ())]
+    if not games:
+        return []
+
+    boards, owners, players = load_boards([game['id'] for game in games])
+    positions, winners, amounts = compute_payouts(
+        boards, owners,
+        np.array([game['home_score'] for game in games]),
+        np.array([game['away_score'] for game in games]),
+        np.array([len(get_scoring_periods(game['sport']))
+                  for game in games]))
+
+    return put_payouts({
+        'game_id': games[index]['id'],
+        'period': period,
+        'home_score': games[index]['home_score'],
+        'away_score': games[index]['away_score'],
+        'home_index': int(positions[index]) // BOARD_SIZE,
+        'away_index': int(positions[index]) % BOARD_SIZE,
+        'player_id': players[winners[index]],
+        'amount': int(amounts[index]),
+    } for index in np.flatnonzero(winners != -1))
+
+
+def get_winnings(payouts):
+    """Total the amounts of many payouts by player id."""
+    players, codes = np.unique([str(payout['player_id'])
+                                for payout in payouts], return_inverse=True)
+    totals = np.bincount(codes, weights=[payout['amount']
+                                         for payout in payouts])
+    return {str(player): int(total)
+            for player, total in zip(players, totals)}
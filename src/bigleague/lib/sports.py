@@ -28,3 +28,10 @@ def get_sport_periods(sport):
             '3rd quarter',
             'Final',
         ]
+
+
+def get_scoring_periods(sport):
+    """The periods whose ending scores pay out; every period but Pregame."""
+    periods = get_sport_periods(sport)
+    if periods:
+        return periods[1:]
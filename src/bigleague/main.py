@@ -1,9 +1,11 @@
 import os
 
+import bottleneck
 import config
 from raven.contrib.flask import Sentry
 
 from bigleague.app import create_app_singletons
+from bigleague.storage import get_current_tables
 
 
 def main():
@@ -18,5 +20,16 @@ def main():
 
     app.run(
         debug=True if os.environ.get('DEBUG') else False,
+        # Event streams hold their request open.
+        threaded=True,
         port=int(os.environ.get('PORT', 80)),
         host=os.environ.get('HOST', '0.0.0.0'))
+
+
+def backfill_current():
+    """Rebuild every <table>_current table from its table's history."""
+    config.init('bigleague')
+
+    for table, primary_keys in sorted(get_current_tables().items()):
+        print('Backfilling %s_current...' % table)
+        bottleneck.backfill_current(table, primary_keys)
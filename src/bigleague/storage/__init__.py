@@ -1,4 +1,8 @@
 import bottleneck
+import config
+
+from bigleague.storage.players import get_player_fields, put_house_player
+from bigleague.storage.teams import get_team_fields
 
 
 def get_tables():
@@ -8,7 +12,72 @@ def get_tables():
         'player',
         'cell',
         'team',
+        'offer',
+        'payout',
     ]
 
 
-bottleneck.init(db_url=bottleneck.get_db_url('bigleague'))
+def reset_tables():
+    """Empty this app's tables, keeping the house player the migrations seed.
+
+    Boards are created owned by the house, so without it every expansion
+    of a new cell's player fails.
+    """
+    bottleneck.clean_db(get_tables())
+    put_house_player()
+
+
+def get_current_tables():
+    """Tables with a <table>_current companion, and their primary keys."""
+    return {
+        'game': ['id'],
+        'player': ['id'],
+        'cell': ['game_id', 'home_index', 'away_index'],
+        'team': ['id'],
+        'offer': ['game_id', 'home_index', 'away_index', 'player_id'],
+    }
+
+
+def get_notify_tables():
+    """Tables whose writes are streamed to clients, and the key to use."""
+    return {
+        'game': 'id',
+        'cell': 'game_id',
+        'offer': 'game_id',
+    }
+
+
+def get_reference_tables():
+    """Rarely written tables to cache, with their lookup keys and fields."""
+    return {
+        'team': {
+            'keys': ['id'],
+            'fields': get_team_fields(),
+        },
+        'player': {
+            'keys': ['id', 'handle', 'auth_token'],
+            'fields': get_player_fields(),
+        },
+    }
+
+
+bottleneck.init(
+    db_url=bottleneck.get_db_url('bigleague'),
+    history_cache_size=config.get('bottleneck.history_cache.size', 0),
+    history_horizon_ms=config.get('bottleneck.history_cache.horizon_ms',
+                                  60000),
+    current_tables=(get_current_tables()
+                    if config.get('bottleneck.current_tables', False)
+                    else None),
+    pool_size=config.get('bottleneck.pool.size', 20),
+    max_overflow=config.get('bottleneck.pool.max_overflow', 0),
+    pool_timeout=config.get('bottleneck.pool.timeout', 30),
+    pool_recycle=config.get('bottleneck.pool.recycle', -1),
+    pool_pre_ping=config.get('bottleneck.pool.pre_ping', False),
+    notify_tables=(get_notify_tables()
+                   if config.get('bottleneck.notify', False) else None),
+    reference_tables=get_reference_tables(),
+    reference_cache_size=config.get('bottleneck.reference_cache.size', 0),
+    reference_cache_ttl_s=config.get('bottleneck.reference_cache.ttl_s', 300),
+    changes_lag_ms=config.get('bottleneck.changes.lag_ms', 0),
+    changes_max_lag_ms=config.get('bottleneck.changes.max_lag_ms', 60000))
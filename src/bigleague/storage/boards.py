@@ -0,0 +1,66 @@
+from bottleneck import get_items
+from bigleague.storage.cells import get_cells
+from bigleague.storage.games import get_game
+from bigleague.storage.offers import get_offers, OFFER_OPEN
+from bigleague.storage.players import PLAYER_TABLE
+from bigleague.storage.teams import TEAM_TABLE
+
+BOARD_SIZE = 10
+
+
+def get_board(game_id, timestamp=None):
+    """Load a whole game board in five queries.
+
+    Returns the game, its teams, the digits of each row and column, a
+    BOARD_SIZE x BOARD_SIZE grid of owners and open offers, and every player
+    referenced by the grid, keyed by id. Returns None if the game does not
+    exist.
+    """
+    game = get_game(id=game_id, timestamp=timestamp)
+    if not game:
+        return None
+
+    teams = get_items([game['home_team_id'], game['away_team_id']],
+                      TEAM_TABLE, ['id', 'name'], timestamp=timestamp)
+    cells = get_cells(game_id=game_id, timestamp=timestamp)
+    offers = get_offers(game_id=game_id, state=OFFER_OPEN,
+                        timestamp=timestamp)
+
+    home_digits = [None] * BOARD_SIZE
+    away_digits = [None] * BOARD_SIZE
+    grid = [[None] * BOARD_SIZE for _ in range(BOARD_SIZE)]
+    player_ids = set()
+
+    for cell in cells:
+        home_index, away_index = cell['home_index'], cell['away_index']
+        home_digits[home_index] = cell['home_digit']
+        away_digits[away_index] = cell['away_digit']
+        grid[home_index][away_index] = {
+            'player_id': cell['player_id'],
+            'offers': [],
+        }
+        player_ids.add(cell['player_id'])
+
+    for offer in offers:
+        cell = grid[offer['home_index']][offer['away_index']]
+        if cell is None:
+            continue
+        cell['offers'].append({
+            'player_id': offer['player_id'],
+            'type': offer['type'],
+            'price': offer['price'],
+        })
+        player_ids.add(offer['player_id'])
+
+    player_ids.discard(None)
+    players = get_items(player_ids, PLAYER_TABLE, ['id', 'handle'],
+                        timestamp=timestamp)
+
+    return {
+        'game': game,
+        'teams': teams,
+        'players': players,
+        'home_digits': home_digits,
+        'away_digits': away_digits,
+        'cells': grid,
+    }
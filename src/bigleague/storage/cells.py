@@ -1,9 +1,12 @@
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest
 
-from bottleneck import put_item, get_item, get_latest_items
+from bottleneck import (put_item, put_items, get_item, get_latest_items,
+                        iter_latest_items, get_changes,
+                        get_high_water_mark, revise_items, lock_items)
 
 CELL_TABLE = 'cell'
+CELL_PRIMARY_KEYS = ['game_id', 'home_index', 'away_index']
 
 
 def get_cell_fields():
@@ -23,8 +26,26 @@ def get_cells(timestamp=None, **conditions):
     """Get all the cells."""
     return get_latest_items(CELL_TABLE, get_cell_fields(), timestamp=timestamp,
                             conditions=conditions,
-                            primary_keys=['game_id', 'home_index',
-                                          'away_index'])
+                            primary_keys=CELL_PRIMARY_KEYS)
+
+
+def iter_cells(timestamp=None, limit=None, after=None, **conditions):
+    """Stream the cells, newest first, optionally a page at a time."""
+    return iter_latest_items(CELL_TABLE, get_cell_fields(),
+                             timestamp=timestamp, conditions=conditions,
+                             primary_keys=CELL_PRIMARY_KEYS, limit=limit,
+                             after=after)
+
+
+def get_cell_high_water_mark(timestamp=None, **conditions):
+    """The newest timestamp written to any matching cell."""
+    return get_high_water_mark(CELL_TABLE, conditions, timestamp=timestamp)
+
+
+def get_cell_changes(since, **conditions):
+    """Get the cells changed after `since`; see bottleneck.get_changes."""
+    return get_changes(CELL_TABLE, get_cell_fields(), since,
+                       conditions=conditions, primary_keys=CELL_PRIMARY_KEYS)
 
 
 def get_cell(**conditions):
@@ -37,6 +58,20 @@ def get_cell(**conditions):
                     timestamp=timestamp)
 
 
+def get_cell_by_digits(game_id, home_digit, away_digit, timestamp=None):
+    """Lookup the cell a game's digits were dealt to.
+
+    Digits never change once dealt, so the latest version with the digits
+    is the latest version of the cell. One probe of the (game_id,
+    home_digit, away_digit, timestamp) index.
+    """
+    return get_item({
+        'game_id': game_id,
+        'home_digit': home_digit,
+        'away_digit': away_digit,
+    }, CELL_TABLE, get_cell_fields(), timestamp=timestamp)
+
+
 def put_cell(cell):
     """Place a cell into the database.
 
@@ -48,7 +83,60 @@ def put_cell(cell):
 
     try:
         return put_item(cell, CELL_TABLE, get_cell_fields(),
-                        primary_keys=['game_id', 'home_index', 'away_index'])
+                        primary_keys=CELL_PRIMARY_KEYS)
     except IntegrityError as e:
         raise BadRequest('Integrity error %s in request. Please try again.' %
                          str(e))
+
+
+def lock_cells(keys):
+    """Lock cells until the outermost transaction ends.
+
+    keys are (game_id, home_index, away_index) tuples. Returns the locked
+    cells, read after the locks were granted.
+    """
+    return lock_items([dict(zip(CELL_PRIMARY_KEYS, key)) for key in keys],
+                      CELL_TABLE, get_cell_fields(),
+                      primary_keys=CELL_PRIMARY_KEYS)
+
+
+def lock_board(game_id):
+    """Lock all of a game's cells; see lock_cells."""
+    return lock_cells((game_id, home_index, away_index)
+                      for home_index in range(10)
+                      for away_index in range(10))
+
+
+def put_cells(cells):
+    """Place many cells into the database in a single statement."""
+    cells = [dict(cell) for cell in cells]
+    for cell in cells:
+        cell.pop('timestamp', None)
+
+    try:
+        return put_items(cells, CELL_TABLE, get_cell_fields(),
+                         primary_keys=CELL_PRIMARY_KEYS)
+    except IntegrityError as e:
+        raise BadRequest('Integrity error %s in request. Please try again.' %
+                         str(e))
+
+
+def assign_digits(game_id, home_digits, away_digits):
+    """Write every cell of a game with its row's and column's digits.
+
+    home_digits and away_digits list the digit of each index. All the new
+    cell versions are written by one statement, and returned.
+    """
+    return revise_items(
+        CELL_TABLE, get_cell_fields(), {'game_id': game_id},
+        CELL_PRIMARY_KEYS,
+        changes={
+            'home_digit': '(CAST(:home_digits AS SMALLINT[]))'
+                          '[home_index + 1]',
+            'away_digit': '(CAST(:away_digits AS SMALLINT[]))'
+                          '[away_index + 1]',
+        },
+        params={
+            'home_digits': list(home_digits),
+            'away_digits': list(away_digits),
+        })
@@ -3,13 +3,34 @@ from uuid import uuid4
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest
 
-from bottleneck import put_item, get_item, get_latest_items
-from bigleague.storage.cells import get_cell, put_cell
-from bigleague.storage.offers import put_offer
+from bottleneck import (put_item, put_items, get_item, get_latest_items,
+                        iter_latest_items, get_high_water_mark,
+                        lock_items, transaction, after_commit)
+from bigleague.storage.cells import (get_cell, put_cells, assign_digits,
+                                     lock_board, CELL_TABLE)
+from bigleague.storage.offers import (put_offers, cancel_open_offers,
+                                      OFFER_TABLE)
+from bigleague.lib.digits import (deal_digits, build_digit_index,
+                                  remember_digit_index)
 from bigleague.lib.sports import GameState
-from bigleague.lib.house import HOUSE_PLAYER_ID
+from bigleague.lib.house import HOUSE_PLAYER_ID, HOUSE_CELL_PRICE
 
 GAME_TABLE = 'game'
+GAME_PRIMARY_KEYS = ['id']
+
+# The states a game may move to from each state.
+GAME_TRANSITIONS = {
+    GameState.pregame: (GameState.playing, GameState.canceled),
+    GameState.playing: (GameState.complete, GameState.canceled),
+    GameState.canceled: (),
+    GameState.complete: (),
+}
+
+# Moving into these states closes the board's open offers.
+CLOSED_STATES = (GameState.canceled, GameState.complete)
+
+# Offers may only be placed in games in these states.
+OPEN_STATES = (GameState.pregame, GameState.playing)
 
 
 def get_game_fields():
@@ -24,6 +45,7 @@ def get_game_fields():
         'away_team_id',
         'home_score',
         'away_score',
+        'observed_at',
     ]
 
 
@@ -31,7 +53,20 @@ def get_games(timestamp=None, **conditions):
     """Get all the games."""
     return get_latest_items(GAME_TABLE, get_game_fields(), timestamp=timestamp,
                             conditions=conditions,
-                            primary_keys=['id'])
+                            primary_keys=GAME_PRIMARY_KEYS)
+
+
+def iter_games(timestamp=None, limit=None, after=None, **conditions):
+    """Stream the games, newest first, optionally a page at a time."""
+    return iter_latest_items(GAME_TABLE, get_game_fields(),
+                             timestamp=timestamp, conditions=conditions,
+                             primary_keys=GAME_PRIMARY_KEYS, limit=limit,
+                             after=after)
+
+
+def get_game_high_water_mark(timestamp=None, **conditions):
+    """The newest timestamp written to any matching game."""
+    return get_high_water_mark(GAME_TABLE, conditions, timestamp=timestamp)
 
 
 def get_game(**conditions):
@@ -44,6 +79,19 @@ def get_game(**conditions):
                     timestamp=timestamp)
 
 
+def lock_games(game_ids, share=False):
+    """Lock games until the outermost transaction ends.
+
+    With share, the games are only kept from changing; see lock_items.
+    Returns the locked games by id, read after the locks were granted.
+    """
+    return {str(game['id']): game
+            for game in lock_items([{'id': game_id} for game_id in game_ids],
+                                   GAME_TABLE, get_game_fields(),
+                                   primary_keys=GAME_PRIMARY_KEYS,
+                                   share=share)}
+
+
 def put_game(game):
     """Place a game into the database."""
     game = game.copy()
@@ -51,6 +99,7 @@ def put_game(game):
     game.setdefault('home_score', 0)
     game.setdefault('away_score', 0)
     game.setdefault('state', GameState.pregame)
+    game.setdefault('observed_at', None)
     game.pop('timestamp', None)
 
     try:
@@ -60,35 +109,112 @@ def put_game(game):
                          str(e))
 
 
+def put_games(games):
+    """Place new versions of many games into the database at once."""
+    games = [dict(game) for game in games]
+    for game in games:
+        game.pop('timestamp', None)
+
+    try:
+        return put_items(games, GAME_TABLE, get_game_fields(),
+                         primary_keys=GAME_PRIMARY_KEYS)
+    except IntegrityError as e:
+        raise BadRequest('Integrity error %s in request. Please try again.' %
+                         str(e))
+
+
 def ensure_cells_exist(game_id):
-    game = get_game(id=game_id)
+    """Create the game's 10x10 grid and the house's sell offers.
+
+    Runs in one transaction with a constant number of round trips: the game
+    lookup, a check for existing cells, and one bulk insert each for the
+    cells and the offers.
+    """
+    with transaction():
+        game = get_game(id=game_id)
+        if not game:
+            raise BadRequest(
+                "Game does not exist: %s" % game_id)
+
+        if get_cell(game_id=game_id):
+            raise BadRequest("Cells already exist in game %s" % game_id)
+
+        cells = put_cells({
+            'game_id': game_id,
+            'home_index': home_index,
+            'away_index': away_index,
+            'home_digit': None,
+            'away_digit': None,
+            'player_id': HOUSE_PLAYER_ID,
+        } for home_index in range(10) for away_index in range(10))
+
+        put_offers({
+            'game_id': cell['game_id'],
+            'home_index': cell['home_index'],
+            'away_index': cell['away_index'],
+            'player_id': HOUSE_PLAYER_ID,
+            'type': 'sell',
+            'price': HOUSE_CELL_PRICE,
+        } for cell in cells)
+
+
+def _get_game_for_transition(game_id, state):
+    """Lock a game, raising unless it may move to `state`."""
+    game = lock_games([game_id]).get(str(game_id))
     if not game:
-        raise BadRequest(
-            "Game does not exist: %s" % game_id)
-
-    for home_index in range(10):
-        for away_index in range(10):
-            cell = get_cell(game_id=game_id, home_index=home_index,
-                            away_index=away_index)
-            if cell:
-                raise BadRequest(
-                    """Cell (home_index=%d, away_index=%d) already exists in
-                    game %s""" % (home_index, away_index, game_id))
-
-            cell = put_cell({
-                'game_id': game_id,
-                'home_index': home_index,
-                'away_index': away_index,
-                'home_digit': None,
-                'away_digit': None,
-                'player_id': HOUSE_PLAYER_ID,
-            })
-
-            put_offer({
-                'game_id': cell['game_id'],
-                'home_index': cell['home_index'],
-                'away_index': cell['away_index'],
-                'player_id': HOUSE_PLAYER_ID,
-                'type': 'sell',
-                'price': 50,
-            })
+        raise BadRequest("Game does not exist: %s" % game_id)
+
+    if state not in GAME_TRANSITIONS.get(game['state'], ()):
+        raise BadRequest("Game %s cannot go from %s to %s." % (
+            game_id, game['state'], state))
+    return game
+
+
+def transition_game(game_id, state):
+    """Move a game to a new state, if GAME_TRANSITIONS allows it.
+
+    Starting a game deals its digits; see start_game. Canceling or
+    completing it cancels every open offer on its board with one
+    statement, in the same transaction as the game's new version. Returns
+    the game and the number of rows written to each table.
+    """
+    if state == GameState.playing:
+        game, cells = start_game(game_id)
+        return game, {GAME_TABLE: 1, CELL_TABLE: len(cells)}
+
+    with transaction():
+        game = _get_game_for_transition(game_id, state)
+        game = put_game(dict(game, state=state))
+        if state in CLOSED_STATES:
+            # Nothing can fill on the board until the cancels commit.
+            lock_board(game_id)
+            offers = cancel_open_offers(game_id)
+        else:
+            offers = []
+
+    return game, {GAME_TABLE: 1, OFFER_TABLE: len(offers)}
+
+
+def start_game(game_id):
+    """Deal the board's digits and move the game from pregame to playing.
+
+    The 100 cell versions with their digits are written by one set-based
+    statement, in the same transaction as the game's new state, with the
+    game and its cells locked so no fill lands between the read and the
+    write. Returns the game and its cells. Once the deal commits, it is
+    remembered as a DigitIndex, so the cell a score lands on can be found
+    without a query.
+    """
+    with transaction():
+        game = _get_game_for_transition(game_id, GameState.playing)
+        lock_board(game_id)
+        home_digits, away_digits = deal_digits()
+        cells = assign_digits(game_id, home_digits, away_digits)
+        if not cells:
+            raise BadRequest("Game %s has no cells." % game_id)
+
+        game = put_game(dict(game, state=GameState.playing))
+        digit_index = build_digit_index(home_digits, away_digits)
+        after_commit(lambda: remember_digit_index(game_id, digit_index))
+
+    return game, cells
@@ -1,15 +1,34 @@
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest
 
-from bottleneck import put_item, get_item, get_latest_items
+from bottleneck import (put_item, put_items, get_item, get_latest_items,
+                        iter_latest_items, get_changes,
+                        get_high_water_mark, revise_items)
 
 OFFER_TABLE = 'offer'
+OFFER_PRIMARY_KEYS = ['game_id', 'home_index', 'away_index', 'player_id']
 OFFER_OPEN = 'open'
 OFFER_CANCELED = 'canceled'
 OFFER_FILLED = 'filled'
 OFFER_STATES = [OFFER_OPEN, OFFER_CANCELED, OFFER_FILLED]
 OFFER_TYPES = ['buy', 'sell']
 
+# Why an offer could not be placed.
+REJECT_NO_CELL = 'no_cell'
+REJECT_NO_PLAYER = 'no_player'
+REJECT_NOT_OWNER = 'not_owner'
+REJECT_OWN_CELL = 'own_cell'
+REJECT_GAME_CLOSED = 'game_closed'
+
+
+class OfferRejected(Exception):
+    """An offer failed validation against the board; see REJECT_*."""
+
+    def __init__(self, reason, offer):
+        super(OfferRejected, self).__init__(reason)
+        self.reason = reason
+        self.offer = offer
+
 
 def get_offer_fields():
     """The list of fields in the DB."""
@@ -32,8 +51,26 @@ def get_offers(timestamp=None, **conditions):
     """Get all the offers."""
     return get_latest_items(OFFER_TABLE, get_offer_fields(),
                             timestamp=timestamp, conditions=conditions,
-                            primary_keys=['game_id', 'home_index', 'away_index',
-                                          'player_id'])
+                            primary_keys=OFFER_PRIMARY_KEYS)
+
+
+def iter_offers(timestamp=None, limit=None, after=None, **conditions):
+    """Stream the offers, newest first, optionally a page at a time."""
+    return iter_latest_items(OFFER_TABLE, get_offer_fields(),
+                             timestamp=timestamp, conditions=conditions,
+                             primary_keys=OFFER_PRIMARY_KEYS, limit=limit,
+                             after=after)
+
+
+def get_offer_high_water_mark(timestamp=None, **conditions):
+    """The newest timestamp written to any matching offer."""
+    return get_high_water_mark(OFFER_TABLE, conditions, timestamp=timestamp)
+
+
+def get_offer_changes(since, **conditions):
+    """Get the offers changed after `since`; see bottleneck.get_changes."""
+    return get_changes(OFFER_TABLE, get_offer_fields(), since,
+                       conditions=conditions, primary_keys=OFFER_PRIMARY_KEYS)
 
 
 def get_offer(**conditions):
@@ -46,19 +83,62 @@ def get_offer(**conditions):
                     timestamp=timestamp)
 
 
-def put_offer(offer):
-    """Place an offer into the database."""
+def _prepare_offer(offer):
     offer = offer.copy()
     offer.setdefault('state', OFFER_OPEN)
     offer.pop('timestamp', None)
+    return offer
+
 
+def put_offer(offer):
+    """Place an offer into the database."""
     try:
         return put_item(
-            offer, OFFER_TABLE, get_offer_fields(),
-            primary_keys=['game_id', 'home_index', 'away_index', 'player_id'],
+            _prepare_offer(offer), OFFER_TABLE, get_offer_fields(),
+            primary_keys=OFFER_PRIMARY_KEYS,
+            defaults=['timestamp_filled', 'counterparty_player_id',
+                      'counterparty_price', 'timestamp'])
+
+    except IntegrityError as e:
+        raise BadRequest('Integrity error %s in request. Please try again.' %
+                         str(e))
+
+
+def put_offers(offers):
+    """Place many offers into the database in a single statement."""
+    try:
+        return put_items(
+            [_prepare_offer(offer) for offer in offers], OFFER_TABLE,
+            get_offer_fields(),
+            primary_keys=OFFER_PRIMARY_KEYS,
             defaults=['timestamp_filled', 'counterparty_player_id',
                       'counterparty_price', 'timestamp'])
 
     except IntegrityError as e:
         raise BadRequest('Integrity error %s in request. Please try again.' %
                          str(e))
+
+
+def put_filled_offers(offers):
+    """Place filled offer versions, counterparty fields included."""
+    offers = [dict(_prepare_offer(offer), state=OFFER_FILLED)
+              for offer in offers]
+    try:
+        return put_items(offers, OFFER_TABLE, get_offer_fields(),
+                         primary_keys=OFFER_PRIMARY_KEYS)
+
+    except IntegrityError as e:
+        raise BadRequest('Integrity error %s in request. Please try again.' %
+                         str(e))
+
+
+def cancel_open_offers(game_id):
+    """Cancel every open offer in a game with one statement.
+
+    Returns the canceled versions.
+    """
+    return revise_items(OFFER_TABLE, get_offer_fields(),
+                        {'game_id': game_id, 'state': OFFER_OPEN},
+                        OFFER_PRIMARY_KEYS,
+                        changes={'state': ':canceled_state'},
+                        params={'canceled_state': OFFER_CANCELED})
@@ -0,0 +1,43 @@
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import BadRequest
+
+from bottleneck import put_items, get_latest_items
+
+PAYOUT_TABLE = 'payout'
+PAYOUT_PRIMARY_KEYS = ['game_id', 'period']
+
+
+def get_payout_fields():
+    """The list of fields in the DB."""
+    return [
+        'game_id',
+        'period',
+        'timestamp',
+        'home_score',
+        'away_score',
+        'home_index',
+        'away_index',
+        'player_id',
+        'amount',
+    ]
+
+
+def get_payouts(timestamp=None, **conditions):
+    """Get the payouts of every settled period."""
+    return get_latest_items(PAYOUT_TABLE, get_payout_fields(),
+                            timestamp=timestamp, conditions=conditions,
+                            primary_keys=PAYOUT_PRIMARY_KEYS)
+
+
+def put_payouts(payouts):
+    """Place many payouts into the database in a single statement."""
+    payouts = [dict(payout) for payout in payouts]
+    for payout in payouts:
+        payout.pop('timestamp', None)
+
+    try:
+        return put_items(payouts, PAYOUT_TABLE, get_payout_fields(),
+                         primary_keys=PAYOUT_PRIMARY_KEYS)
+    except IntegrityError as e:
+        raise BadRequest('Integrity error %s in request. Please try again.' %
+                         str(e))
@@ -3,7 +3,8 @@ from uuid import uuid4
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest
 
-from bottleneck import put_item, get_item, get_latest_items
+from bottleneck import put_item, get_item, get_items, get_latest_items
+from bigleague.lib.house import HOUSE_PLAYER_ID
 
 PLAYER_TABLE = 'player'
 
@@ -32,6 +33,11 @@ def get_player(**conditions):
     return get_item(conditions, PLAYER_TABLE, ['id', 'handle'])
 
 
+def get_players_by_id(player_ids):
+    """Lookup many players by id in one query, as a dict of id to player."""
+    return get_items(player_ids, PLAYER_TABLE, ['id', 'handle'])
+
+
 def put_player(player):
     """Place a player item into the database."""
     player = player.copy()
@@ -44,3 +50,12 @@ def put_player(player):
     except IntegrityError as e:
         raise BadRequest('Integrity error %s in request. Please try again.' %
                          str(e))
+
+
+def put_house_player():
+    """Place the house player, which owns every cell of a new board."""
+    return put_player({
+        'id': HOUSE_PLAYER_ID,
+        'handle': 'house',
+        'auth_token': None,
+    })
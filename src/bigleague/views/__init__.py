@@ -1,6 +1,14 @@
+import hashlib
+import json
+from functools import wraps
+from itertools import islice
+
+from flask import Response, after_this_request, request, stream_with_context
 from flask_restplus import fields
 
-from bottleneck import StorageError
+from bottleneck import (StorageError, encode_cursor, decode_cursor,
+                        finish_request)
+from config.serialize import serialize
 from werkzeug.exceptions import BadRequest
 
 from bigleague.storage.teams import TEAM_TABLE
@@ -19,6 +27,163 @@ def get_uuid_field(**kwargs):
         **kwargs)
 
 
+STREAM_CHUNK_SIZE = 100
+
+PAGE_DOC = {
+    'limit': 'Return at most this many items, plus a next_cursor '
+             '(optional).',
+    'cursor': 'The next_cursor of the previous page (optional).',
+}
+
+SINCE_DOC = ('Only return what changed after this timestamp (in epoch '
+             'milliseconds), along with the keys of items that no longer '
+             'match the filters (removed) and the high_water_mark to pass '
+             'as since on the next poll (optional).')
+
+
+def get_page_args(primary_keys):
+    """Read the `limit` and `cursor` query params of a paginated list."""
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            raise BadRequest("'limit' must be a positive integer.")
+
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor, primary_keys) if cursor else None
+    return limit, after
+
+
+def get_since_arg():
+    """Read the `since` query param of a changes-since poll."""
+    since = request.args.get('since')
+    if since is None:
+        return None
+
+    if 'timestamp' in request.args:
+        raise BadRequest("'since' and 'timestamp' cannot be combined.")
+    try:
+        return int(since)
+    except ValueError:
+        raise BadRequest("'since' must be a timestamp in epoch "
+                         "milliseconds.")
+
+
+def stream_json(items, primary_keys, render=serialize, limit=None,
+                not_found_if_empty=False):
+    """Stream an iterable of items out as JSON, a chunk at a time.
+
+    Without a limit the body is a plain JSON array, as it was before
+    streaming. With one it is {"items": [...], "next_cursor": ...}, where
+    next_cursor is null once the last page has been served. `render`
+    turns a list of raw items into JSON-ifyable ones.
+    """
+    items = iter(items)
+    first = list(islice(items, STREAM_CHUNK_SIZE))
+    if not first and not_found_if_empty and limit is None:
+        return {}, 404
+
+    def render_chunk(chunk):
+        """The chunk as JSON array elements, and a cursor past its end.
+
+        The cursor is read off the raw rows, before `render` expands them.
+        """
+        cursor = None
+        if chunk and limit is not None:
+            cursor = encode_cursor(chunk[-1], primary_keys)
+        return json.dumps(render(chunk))[1:-1], cursor
+
+    # Render the first chunk before committing to a 200, so a failed
+    # query or expansion is still reported with an error status.
+    first_body, first_cursor = render_chunk(first)
+
+    def chunks():
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == STREAM_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def generate():
+        finished = False
+        try:
+            yield '[' if limit is None else '{"items": ['
+            yield first_body
+            count, cursor = len(first), first_cursor
+            for chunk in chunks():
+                body, cursor = render_chunk(chunk)
+                yield (', ' if count else '') + body
+                count += len(chunk)
+
+            if limit is None:
+                yield ']'
+            else:
+                next_cursor = cursor if count == limit else None
+                yield '], "next_cursor": %s}' % json.dumps(next_cursor)
+            finished = True
+        finally:
+            if not finished:
+                _abandon_stream(items)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def _abandon_stream(items):
+    """Release a stream that was closed or failed before its end.
+
+    The rows come from a server-side cursor on the request's unit of work,
+    which would otherwise sit idle in transaction, holding its locks,
+    until the response object happened to be collected.
+    """
+    close = getattr(items, 'close', None)
+    if close is not None:
+        close()
+    finish_request(commit=False)
+
+
+def conditional(version):
+    """Answer If-None-Match with 304 Not Modified while nothing changed.
+
+    version() gets the view's URL arguments and the `timestamp` query param
+    and returns the high-water mark of the rows the view reads, or None to
+    skip the check. It runs before the view, so an unchanged resource costs
+    one index probe instead of the full query and expansion.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(self, **kwargs):
+            mark = version(timestamp=request.args.get('timestamp', None),
+                           **kwargs)
+            if mark is None:
+                return f(self, **kwargs)
+
+            # The same rows can be read many ways, so the query string is
+            # part of the tag.
+            etag = '%s-%s' % (mark, hashlib.md5(
+                request.query_string).hexdigest()[:8])
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag, weak=True)
+                return response
+
+            @after_this_request
+            def set_etag(response):
+                if response.status_code == 200:
+                    response.set_etag(etag, weak=True)
+                return response
+
+            return f(self, **kwargs)
+        return wrapped
+    return decorator
+
+
 def get_error_model(api, area):
     return api.model('%s_error' % area, {
         'message': fields.String(required=True,
@@ -69,7 +234,7 @@ def auto_expand(f):
 
 
 def expand_relations(*args, **kwargs):
-    from bottleneck import expand
+    from bottleneck import expand_batched
 
     kwargs.setdefault('expanders', get_expanders())
-    return expand(*args, **kwargs)
+    return expand_batched(*args, **kwargs)
@@ -0,0 +1,25 @@
+from flask import request
+from flask_restplus import Resource
+
+from config.serialize import serialize
+from bigleague.storage.boards import get_board
+
+
+def init_app(app, api):
+    @api.route('/v1/board/<uuid:game_id>')
+    class BoardRead(Resource):
+        @api.doc(params={'timestamp': 'Recall the board at a '
+                         'particular timestamp (in epoch milliseconds).'})
+        def get(self, game_id):
+            """Retrieve a whole game board in one request.
+
+            `cells` is a 10x10 grid indexed [home_index][away_index] of
+            owners and open offers. Players and teams are listed once, by
+            id, in `players` and `teams`.
+            """
+            board = get_board(game_id,
+                              timestamp=request.args.get('timestamp', None))
+            if board:
+                return serialize(board), 200
+            else:
+                return {}, 404
@@ -1,8 +1,25 @@
 from flask import request
 from flask_restplus import Resource
 
-from bigleague.views import expand_relations
-from bigleague.storage.cells import get_cell, get_cells
+from config.serialize import serialize
+
+from bigleague.views import (expand_relations, get_page_args, stream_json,
+                             get_since_arg, conditional, PAGE_DOC,
+                             SINCE_DOC)
+from bigleague.storage.cells import (get_cell, iter_cells, get_cell_changes,
+                                     get_cell_by_digits,
+                                     get_cell_high_water_mark,
+                                     CELL_PRIMARY_KEYS)
+from bigleague.storage.games import get_game_high_water_mark
+
+
+def get_cells_version(game_id, timestamp, **conditions):
+    """Cells are expanded with their game, so either one changing counts."""
+    marks = [get_cell_high_water_mark(game_id=game_id, timestamp=timestamp,
+                                      **conditions),
+             get_game_high_water_mark(id=game_id, timestamp=timestamp)]
+    if None not in marks:
+        return max(marks)
 
 
 def init_app(app, api):
@@ -23,6 +40,7 @@ def init_app(app, api):
     class CellReadByGameIdByIndex(Resource):
         @api.doc(params={'timestamp': 'Recall the cell information at a '
                          'particular timestamp (in epoch milliseconds).'})
+        @conditional(get_cells_version)
         def get(self, game_id, home_index, away_index):
             """Retrieve a cell in a game by its pre-shuffled index."""
             cell = get_cell(game_id=game_id, home_index=home_index,
@@ -37,11 +55,15 @@ def init_app(app, api):
     class CellReadByGameIdDigits(Resource):
         @api.doc(params={'timestamp': 'Recall the cell information at a '
                          'particular timestamp (in epoch milliseconds).'})
+        @conditional(lambda game_id, home_digits, away_digits, timestamp:
+                     get_cells_version(game_id, timestamp,
+                                       home_digit=home_digits,
+                                       away_digit=away_digits))
         def get(self, game_id, home_digits, away_digits):
             """Retrieve a cell in a game by its digits."""
-            cell = get_cell(game_id=game_id, home_digits=home_digits,
-                            away_digits=away_digits,
-                            timestamp=request.args.get('timestamp', None))
+            cell = get_cell_by_digits(
+                game_id, home_digits, away_digits,
+                timestamp=request.args.get('timestamp', None))
             if cell:
                 return expand_relations(cell), 200
             else:
@@ -49,13 +71,25 @@ def init_app(app, api):
 
     @api.route('/v1/cells/by-game/<uuid:game_id>')
     class CellReadByGame(Resource):
-        @api.doc(params={'timestamp': 'Recall the cell information at a '
-                         'particular timestamp (in epoch milliseconds).'})
+        @api.doc(params=dict(PAGE_DOC, since=SINCE_DOC,
+                             timestamp='Recall the cell information at a '
+                             'particular timestamp (in epoch milliseconds).'))
+        @conditional(get_cells_version)
         def get(self, game_id):
             """Return cells for a game at a particular point in time."""
-            cell = get_cells(game_id=game_id,
-                             timestamp=request.args.get('timestamp', None))
-            if cell:
-                return expand_relations(cell), 200
-            else:
-                return {}, 404
+            since = get_since_arg()
+            if since is not None:
+                cells, removed, high_water_mark = get_cell_changes(
+                    since, game_id=game_id)
+                return {
+                    'items': expand_relations(cells),
+                    'removed': serialize(removed),
+                    'high_water_mark': high_water_mark,
+                }, 200
+
+            limit, after = get_page_args(CELL_PRIMARY_KEYS)
+            cells = iter_cells(game_id=game_id, limit=limit, after=after,
+                               timestamp=request.args.get('timestamp', None))
+            return stream_json(cells, CELL_PRIMARY_KEYS,
+                               render=expand_relations, limit=limit,
+                               not_found_if_empty=True)
@@ -1,10 +1,20 @@
 from flask import request
 from flask_restplus import Resource, fields
 
-from bigleague.lib.sports import GAMES
-from bigleague.views import expand_relations, get_uuid_field
-from bigleague.storage.games import (get_game, put_game, get_games,
-                                     ensure_cells_exist)
+from bottleneck import transaction
+from config.serialize import serialize
+from bigleague.lib.sports import GAMES, GAME_STATES, GameState
+from bigleague.views import (expand_relations, get_uuid_field,
+                             get_page_args, stream_json, conditional,
+                             PAGE_DOC)
+from bigleague.lib.scores import ingest_scores, get_winning_cells
+from bigleague.lib.settlement import settle_final_period, settle_period
+from bigleague.storage.games import (get_game, put_game, iter_games,
+                                     ensure_cells_exist, start_game,
+                                     transition_game,
+                                     get_game_high_water_mark,
+                                     GAME_PRIMARY_KEYS)
+from bigleague.storage.payouts import PAYOUT_TABLE
 
 
 def get_game_fields():
@@ -23,16 +33,59 @@ def get_game_fields():
     }
 
 
+def get_score_event_fields():
+    return {
+        'game_id': get_uuid_field(description='The game\'s ID.'),
+        'home_score': fields.Integer(
+            required=True,
+            min=0,
+            description='The home team\'s score.'),
+        'away_score': fields.Integer(
+            required=True,
+            min=0,
+            description='The away team\'s score.'),
+        'observed_at': fields.Integer(
+            required=True,
+            min=0,
+            description='When the feed observed the score (in epoch '
+                        'milliseconds).'),
+    }
+
+
 def init_app(app, api):
     game_model = api.model('GameModel', get_game_fields())
+    game_state_model = api.model('GameStateModel', {
+        'state': fields.String(
+            required=True,
+            enum=GAME_STATES,
+            description='The state to move the game to. ' + str(GAME_STATES)),
+    })
+    score_event_model = api.model('ScoreEventModel',
+                                  get_score_event_fields())
+    score_batch_model = api.model('ScoreBatchModel', {
+        'events': fields.List(
+            fields.Nested(score_event_model),
+            required=True,
+            description='Score events from the feed, in any order.'),
+    })
+    settle_model = api.model('SettleModel', {
+        'period': fields.String(
+            required=True,
+            description='The scoring period that just ended.'),
+        'game_ids': fields.List(
+            get_uuid_field(description='A game\'s ID.'),
+            required=True,
+            description='The games whose period ended.'),
+    })
 
     @api.route('/v1/game')
     class GameCreate(Resource):
         @api.expect(game_model, validate=True)
         def post(self):
             """Create a game."""
-            game = put_game(request.get_json())
-            ensure_cells_exist(game['id'])
+            with transaction():
+                game = put_game(request.get_json())
+                ensure_cells_exist(game['id'])
             if game:
                 return expand_relations(game), 200
             else:
@@ -42,6 +95,8 @@ def init_app(app, api):
     class GameRead(Resource):
         @api.doc(params={'timestamp': 'Recall the game information at a '
                          'particular timestamp (in epoch milliseconds).'})
+        @conditional(lambda game_id, timestamp: get_game_high_water_mark(
+            id=game_id, timestamp=timestamp))
         def get(self, game_id):
             """Retrieve game info from its ID."""
             game = get_game(id=game_id,
@@ -51,24 +106,100 @@ def init_app(app, api):
             else:
                 return {}, 404
 
-    @api.route('/v1/games/by-sport/<string:sport>')  # noqa
+    @api.route('/v1/game/<uuid:game_id>/start')  # noqa
+    class GameStart(Resource):
+        def post(self, game_id):
+            """Deal the board's digits and start the game.
+
+            Returns the game and its cells, now with their digits.
+            """
+            game, cells = start_game(game_id)
+            return {
+                'game': expand_relations(game),
+                'cells': serialize(cells),
+            }, 200
+
+    @api.route('/v1/game/<uuid:game_id>/state')  # noqa
+    class GameTransition(Resource):
+        @api.expect(game_state_model, validate=True)
+        def put(self, game_id):
+            """Move a game to a new state.
+
+            Games go from pregame to playing or canceled, and from playing
+            to complete or canceled. Canceling or completing a game cancels
+            its open offers, and completing it pays out its final period at
+            its last score. Returns the game and the rows written to each
+            table.
+            """
+            game, rows = transition_game(game_id,
+                                         request.get_json()['state'])
+            if game['state'] == GameState.complete:
+                rows[PAYOUT_TABLE] = len(settle_final_period(game))
+            return {'game': expand_relations(game), 'rows': rows}, 200
+
+    @api.route('/v1/games/scores')  # noqa
+    class GameScores(Resource):
+        @api.expect(score_batch_model, validate=True)
+        def post(self):
+            """Record a batch of live scores from the feed.
+
+            Only the latest event of each game is kept, and events no newer
+            than the game's last observed score are dropped. The surviving
+            scores are written in one transaction. Returns each game's
+            current score and winning cell, and the number of events
+            written, coalesced and dropped.
+            """
+            games, rows = ingest_scores(request.get_json()['events'])
+            cells = get_winning_cells(games)
+            return {
+                'games': {game_id: {
+                    'home_score': game['home_score'],
+                    'away_score': game['away_score'],
+                    'observed_at': game['observed_at'],
+                    'winning_cell': dict(zip(
+                        ('home_index', 'away_index'),
+                        cells[game_id])) if cells[game_id] else None,
+                } for game_id, game in games.items()},
+                'rows': rows,
+            }, 200
+
+    @api.route('/v1/games/settle')  # noqa
+    class GameSettle(Resource):
+        @api.expect(settle_model, validate=True)
+        def post(self):
+            """Pay out a period that just ended, at each game's score.
+
+            The feed sends this as each scoring period ends; the final
+            period is paid when the game completes. Games that are not
+            under way, have no such period, or have no digits yet are
+            skipped. Returns the payouts written.
+            """
+            settle = request.get_json()
+            payouts = settle_period(settle['game_ids'], settle['period'])
+            return serialize(payouts), 200
+
     class GameRead(Resource):
-        @api.doc(params={'timestamp': 'Recall the game information at a '
-                         'particular timestamp (in epoch milliseconds).'})
+        @api.doc(params=dict(PAGE_DOC, timestamp='Recall the game '
+                             'information at a particular timestamp (in '
+                             'epoch milliseconds).'))
         def get(self, sport):
             """Retrieve games by sport."""
-            games = get_games(sport=sport,
-                              timestamp=request.args.get('timestamp', None))
-            return expand_relations(games), 200
+            limit, after = get_page_args(GAME_PRIMARY_KEYS)
+            games = iter_games(sport=sport, limit=limit, after=after,
+                               timestamp=request.args.get('timestamp', None))
+            return stream_json(games, GAME_PRIMARY_KEYS,
+                               render=expand_relations, limit=limit)
 
     @api.route('/v1/games')  # noqa
     class GameRead(Resource):
-        @api.doc(params={'timestamp': 'Recall the game information at a '
-                         'particular timestamp (in epoch milliseconds).'})
+        @api.doc(params=dict(PAGE_DOC, timestamp='Recall the game '
+                             'information at a particular timestamp (in '
+                             'epoch milliseconds).'))
         def get(self):
             """Retrieve all games."""
-            games = get_games(timestamp=request.args.get('timestamp', None))
-            if games:
-                return expand_relations(games), 200
-            else:
-                return {}, 404
+            limit, after = get_page_args(GAME_PRIMARY_KEYS)
+            games = iter_games(limit=limit, after=after,
+                               timestamp=request.args.get('timestamp', None))
+            return stream_json(games, GAME_PRIMARY_KEYS,
+                               render=expand_relations, limit=limit,
+                               not_found_if_empty=True)
@@ -1,8 +1,17 @@
 from flask_restplus import Resource
 
+from bottleneck import (get_history_cache_stats, get_pool_stats,
+                        get_reference_cache_stats)
+from bottleneck.notify import get_listener_stats
+
 
 def init_app(app, api):
     @api.route('/health')
     class HelloWorld(Resource):
         def get(self):
-            return {}
+            return {
+                'history_cache': get_history_cache_stats(),
+                'reference_cache': get_reference_cache_stats(),
+                'pool': get_pool_stats(),
+                'listener': get_listener_stats(),
+            }
@@ -0,0 +1,122 @@
+import time
+
+from flask import Response, g, request
+
+from bottleneck import (get_pool_stats, get_query_metrics,
+                        get_reference_cache_stats)
+from bottleneck.stats import Metrics
+
+# Latency of every request, by method, route and status code.
+REQUEST_METRICS = Metrics(['method', 'route', 'status'])
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in sorted(labels.items()))
+
+
+def _seconds(bound):
+    return bound if isinstance(bound, str) else repr(bound / 1000)
+
+
+def render_histogram(name, labels, snapshot):
+    """Render a millisecond histogram snapshot as a seconds histogram."""
+    lines = ['%s_bucket%s %d' % (name, _labels(dict(labels, le=_seconds(le))),
+                                 count)
+             for le, count in snapshot['buckets']]
+    lines.append('%s_sum%s %r' % (name, _labels(labels),
+                                  snapshot['sum'] / 1000))
+    lines.append('%s_count%s %d' % (name, _labels(labels), snapshot['count']))
+    return lines
+
+
+def render_metrics():
+    """Render query, pool and request metrics in Prometheus text format."""
+    lines = [
+        '# HELP bottleneck_query_duration_seconds Latency of storage calls.',
+        '# TYPE bottleneck_query_duration_seconds histogram',
+    ]
+    queries = get_query_metrics()
+    for labels, latency, _ in queries:
+        lines += render_histogram('bottleneck_query_duration_seconds',
+                                  labels, latency)
+
+    lines += [
+        '# HELP bottleneck_query_rows_total Rows returned by storage calls.',
+        '# TYPE bottleneck_query_rows_total counter',
+    ]
+    lines += ['bottleneck_query_rows_total%s %d' % (_labels(labels), rows)
+              for labels, _, rows in queries]
+
+    pool = get_pool_stats()
+    if pool:
+        lines += [
+            '# HELP bottleneck_pool_checked_out Connections in use.',
+            '# TYPE bottleneck_pool_checked_out gauge',
+            'bottleneck_pool_checked_out %d' % pool['checked_out'],
+            '# HELP bottleneck_pool_checkout_timeouts_total Checkouts that '
+            'timed out.',
+            '# TYPE bottleneck_pool_checkout_timeouts_total counter',
+            'bottleneck_pool_checkout_timeouts_total %d'
+            % pool['checkout_timeouts'],
+            '# HELP bottleneck_pool_checkout_wait_seconds Time spent waiting '
+            'for a connection.',
+            '# TYPE bottleneck_pool_checkout_wait_seconds histogram',
+        ]
+        lines += render_histogram('bottleneck_pool_checkout_wait_seconds',
+                                  {}, pool['checkout_wait_ms'])
+
+    reference_cache = get_reference_cache_stats()
+    if reference_cache:
+        lines += [
+            '# HELP bottleneck_reference_cache_hits_total Team and player '
+            'lookups served from memory.',
+            '# TYPE bottleneck_reference_cache_hits_total counter',
+            'bottleneck_reference_cache_hits_total %d'
+            % reference_cache['hits'],
+            '# HELP bottleneck_reference_cache_misses_total Team and player '
+            'lookups read from the database.',
+            '# TYPE bottleneck_reference_cache_misses_total counter',
+            'bottleneck_reference_cache_misses_total %d'
+            % reference_cache['misses'],
+        ]
+
+    lines += [
+        '# HELP bigleague_request_duration_seconds Latency of requests.',
+        '# TYPE bigleague_request_duration_seconds histogram',
+    ]
+    for labels, latency, _ in REQUEST_METRICS.snapshot():
+        lines += render_histogram('bigleague_request_duration_seconds',
+                                  labels, latency)
+
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app, api):
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = getattr(g, 'request_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            REQUEST_METRICS.observe(
+                (request.method, route, str(response.status_code)),
+                (time.perf_counter() - start) * 1000)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render_metrics(), content_type=CONTENT_TYPE)
@@ -3,12 +3,28 @@ from flask_restplus import Resource, fields
 from werkzeug.exceptions import BadRequest
 
 from config.serialize import serialize
-from bigleague.storage.offers import (get_offer, get_offers, OFFER_TYPES,
+from bigleague.storage.offers import (get_offer, get_offers, iter_offers,
+                                      get_offer_changes,
+                                      get_offer_high_water_mark, OFFER_TYPES,
                                       OFFER_STATES, OFFER_CANCELED, OFFER_OPEN,
-                                      put_offer)
-from bigleague.storage.cells import get_cell
+                                      OFFER_PRIMARY_KEYS, OfferRejected,
+                                      REJECT_GAME_CLOSED, REJECT_NO_CELL,
+                                      REJECT_NO_PLAYER, REJECT_NOT_OWNER,
+                                      REJECT_OWN_CELL)
+from bigleague.storage.cells import get_cells
+from bigleague.lib.matching import (submit_offer, cancel_offers,
+                                    place_and_cancel)
 from bigleague.storage.players import get_player
-from bigleague.views import get_uuid_field
+from bigleague.views import (get_uuid_field, get_page_args, stream_json,
+                             get_since_arg, conditional, PAGE_DOC,
+                             SINCE_DOC)
+
+REJECTION_MESSAGES = {
+    REJECT_NO_CELL: "Cell does not exist?",
+    REJECT_NOT_OWNER: "You cannot sell a cell you do not own.",
+    REJECT_OWN_CELL: "You cannot buy a cell you own.",
+    REJECT_GAME_CLOSED: "The game is no longer taking offers.",
+}
 
 
 def get_put_offer_fields():
@@ -38,6 +54,33 @@ def get_put_offer_fields():
     }
 
 
+def get_batch_operation_fields():
+    return {
+        'home_index': fields.Integer(
+            required=True,
+            min=0,
+            max=9,
+            description='The home index of the cell.'),
+        'away_index': fields.Integer(
+            required=True,
+            min=0,
+            max=9,
+            description='The away index of the cell.'),
+        'type': fields.String(
+            required=False,
+            enum=OFFER_TYPES,
+            description='Whether you are buying or selling.'),
+        'price': fields.Integer(
+            required=False,
+            min=0,
+            description='The amount of the offer.'),
+        'cancel': fields.Boolean(
+            required=False,
+            default=False,
+            description='Cancel the open offer on this cell instead.'),
+    }
+
+
 def get_delete_offer_fields():
     return {
         'player_id': get_uuid_field(
@@ -57,19 +100,32 @@ def get_delete_offer_fields():
 
 def init_app(app, api):  # noqa
     put_offer_model = api.model('PutOfferModel', get_put_offer_fields())
+    batch_operation_model = api.model('BatchOfferOperationModel',
+                                      get_batch_operation_fields())
+    batch_model = api.model('BatchOfferModel', {
+        'player_id': get_uuid_field(
+            description='The player placing and canceling the offers.'),
+        'operations': fields.List(
+            fields.Nested(batch_operation_model),
+            required=True,
+            description='Offers to place or cancel, at most one per cell.'),
+    })
 
     @api.route('/v1/offers/<uuid:game_id>')
     class GetOffers(Resource):
-        @api.doc(params={
-            'timestamp': ('Recall the offers available at a '
-                          'particular timestamp (in epoch milliseconds) '
-                          '(optional).'),
-            'state': ('Filter offers by state. Valid choices are [%s] '
-                      '(optional).' % ', '.join(OFFER_STATES)),
-            'player_id': 'Filter on a particular player (optional).',
-            'home_index': 'The home team index (optional).',
-            'away_index': 'The away team index (optional).',
-        })
+        @api.doc(params=dict(
+            PAGE_DOC,
+            since=SINCE_DOC,
+            timestamp=('Recall the offers available at a '
+                       'particular timestamp (in epoch milliseconds) '
+                       '(optional).'),
+            state=('Filter offers by state. Valid choices are [%s] '
+                   '(optional).' % ', '.join(OFFER_STATES)),
+            player_id='Filter on a particular player (optional).',
+            home_index='The home team index (optional).',
+            away_index='The away team index (optional).',
+        ))
+        @conditional(get_offer_high_water_mark)
         def get(self, game_id):
             """Retrieve all offers in a game by the game ID."""
             state = request.args.get('state')
@@ -95,8 +151,21 @@ def init_app(app, api):  # noqa
             if away_index:
                 conditions['away_index'] = away_index
 
-            offers = get_offers(game_id=game_id, **conditions)
-            return serialize(offers), 200
+            since = get_since_arg()
+            if since is not None:
+                del conditions['timestamp']
+                offers, removed, high_water_mark = get_offer_changes(
+                    since, game_id=game_id, **conditions)
+                return {
+                    'items': serialize(offers),
+                    'removed': serialize(removed),
+                    'high_water_mark': high_water_mark,
+                }, 200
+
+            limit, after = get_page_args(OFFER_PRIMARY_KEYS)
+            offers = iter_offers(game_id=game_id, limit=limit, after=after,
+                                 **conditions)
+            return stream_json(offers, OFFER_PRIMARY_KEYS, limit=limit)
 
     @api.route('/v1/offer/<uuid:game_id>/by-index/<int:home_index>/<int:away_index>')  # noqa
     class PutOffer(Resource):
@@ -128,6 +197,20 @@ def init_app(app, api):  # noqa
             return close_offer(player_id, game_id, home_index,
                                away_index)
 
+    @api.route('/v1/offers/<uuid:game_id>/batch')
+    class BatchOffers(Resource):
+        @api.expect(batch_model, validate=True)
+        def post(self, game_id):
+            """Place and cancel many of one player's offers at once.
+
+            Returns a result per operation, in order. Operations that fail
+            validation are reported and skipped; the rest are written in a
+            single transaction.
+            """
+            batch = request.get_json()
+            return place_offers(batch['player_id'], game_id,
+                                batch['operations'])
+
 
 def close_offer(player_id, game_id, home_index, away_index):
     """Handle closing of an offer."""
@@ -149,35 +232,113 @@ def close_offer(player_id, game_id, home_index, away_index):
         raise BadRequest("The existing offer is '%s'."
                          % existing_offer['state'])
 
-    existing_offer['state'] = OFFER_CANCELED
-    return serialize(put_offer(existing_offer)), 200
+    offer = cancel_offers([existing_offer])[0]
+    if offer is None:
+        raise BadRequest("The existing offer is no longer open.")
+    return serialize(offer), 200
+
+
+def get_rejection_message(rejected):
+    """The error message for an OfferRejected."""
+    if rejected.reason == REJECT_NO_PLAYER:
+        return "Invalid player_id: %s" % rejected.offer['player_id']
+    return REJECTION_MESSAGES[rejected.reason]
 
 
 def place_offer(player_id, game_id, home_index, away_index, price, type_):
-    """Place or update an offer on a cell."""
-    cell = get_cell(game_id=game_id, home_index=home_index,
-                    away_index=away_index)
-    if not cell:
-        raise BadRequest("Cell does not exist?")
+    """Place or update an offer on a cell.
 
+    The matching engine checks the cell, its owner and the player in the
+    same transaction as the write, under the cell's lock.
+    """
+    try:
+        offer = submit_offer({
+            'game_id': game_id,
+            'home_index': home_index,
+            'away_index': away_index,
+            'player_id': player_id,
+            'type': type_,
+            'price': price,
+        })
+    except OfferRejected as rejected:
+        raise BadRequest(get_rejection_message(rejected))
+    return serialize(offer), 200
+
+
+def place_offers(player_id, game_id, operations):
+    """Validate a batch of offers against the board, then write them."""
     player = get_player(id=player_id)
     if not player:
         raise BadRequest("Invalid player_id: %s" % player_id)
 
-    if type_ == 'sell':
-        if cell['player_id'] != player_id:
-            raise BadRequest("You cannot sell a cell you do not own.")
-
-    elif type_ == 'buy':
-        if cell['player_id'] == player_id:
-            raise BadRequest("You cannot buy a cell you own.")
-
-    offer = put_offer({
-        'game_id': game_id,
-        'home_index': home_index,
-        'away_index': away_index,
-        'player_id': player_id,
-        'type': type_,
-        'price': price,
-    })
-    return serialize(offer), 200
+    cells = {(cell['home_index'], cell['away_index']): cell
+             for cell in get_cells(game_id=game_id)}
+    open_offers = {(offer['home_index'], offer['away_index']): offer
+                   for offer in get_offers(game_id=game_id,
+                                           player_id=player_id,
+                                           state=OFFER_OPEN)}
+
+    results = []
+    placements, cancels, seen = [], [], set()
+    for operation in operations:
+        index = (operation['home_index'], operation['away_index'])
+        result = {'home_index': index[0], 'away_index': index[1]}
+        results.append(result)
+
+        error = _check_operation(player_id, operation, index, cells,
+                                 open_offers, seen)
+        seen.add(index)
+        if error:
+            result['error'] = error
+        elif operation.get('cancel'):
+            cancels.append((result, open_offers[index]))
+        else:
+            placements.append((result, {
+                'game_id': game_id,
+                'home_index': index[0],
+                'away_index': index[1],
+                'player_id': player_id,
+                'type': operation['type'],
+                'price': operation['price'],
+            }))
+
+    try:
+        placed, canceled = place_and_cancel(
+            [offer for _, offer in placements],
+            [offer for _, offer in cancels])
+    except OfferRejected as rejected:
+        # The board changed since it was loaded above.
+        raise BadRequest(get_rejection_message(rejected))
+
+    for (result, _), offer in zip(cancels + placements, canceled + placed):
+        if offer is None:
+            result['error'] = "No open offer found."
+        else:
+            result['offer'] = offer
+    return serialize(results), 200
+
+
+def _check_operation(player_id, operation, index, cells, open_offers, seen):
+    """Return why a batch operation cannot be applied, or None."""
+    if index in seen:
+        return "Only one operation per cell is allowed in a batch."
+
+    cell = cells.get(index)
+    if not cell:
+        return REJECTION_MESSAGES[REJECT_NO_CELL]
+
+    if operation.get('cancel'):
+        if index not in open_offers:
+            return "No open offer found."
+        return None
+
+    if operation.get('price') is None or not operation.get('type'):
+        return ("In order to place or update an offer, you must supply "
+                "both 'price' and 'type'.")
+
+    owner = str(cell['player_id']) if cell['player_id'] else None
+    if operation['type'] == 'sell' and owner != player_id:
+        return REJECTION_MESSAGES[REJECT_NOT_OWNER]
+    elif operation['type'] == 'buy' and owner == player_id:
+        return REJECTION_MESSAGES[REJECT_OWN_CELL]
+    return None
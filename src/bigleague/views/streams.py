@@ -0,0 +1,53 @@
+import json
+import queue
+
+from flask import Response
+from flask_restplus import Resource
+
+from bottleneck.notify import subscribe, unsubscribe
+
+# Seconds of quiet after which a comment is sent, so proxies and clients
+# keep the connection open.
+KEEPALIVE_SECONDS = 15
+
+
+def format_event(event):
+    """Render a notification as a server-sent event named after its table."""
+    return 'event: %s\ndata: %s\n\n' % (event['table'],
+                                        json.dumps(event['row']))
+
+
+def stream_events(key):
+    """Yield server-sent events for every row written under key."""
+    events = subscribe(key)
+    try:
+        yield ': subscribed\n\n'
+        while True:
+            try:
+                event = events.get(timeout=KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+
+            if event is None:
+                # Too far behind; the client reconnects and catches up with
+                # a since= read.
+                return
+            yield format_event(event)
+    finally:
+        unsubscribe(key, events)
+
+
+def init_app(app, api):
+    @api.route('/v1/stream/game/<uuid:game_id>')
+    class GameStream(Resource):
+        def get(self, game_id):
+            """Stream changes to a game, its cells and its offers.
+
+            A text/event-stream of `game`, `cell` and `offer` events, each
+            holding the newly written row.
+            """
+            return Response(stream_events(game_id),
+                            mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache',
+                                     'X-Accel-Buffering': 'no'})
@@ -1,17 +1,94 @@
+import base64
 import copy
+import json
 import os
 import logging
+import threading
+import time
+from collections import namedtuple
 from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache, wraps
 from uuid import UUID
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc, select
 from sqlalchemy.sql import text as sql_text
 from werkzeug.exceptions import BadRequest
 
+from bottleneck.cache import LRUCache
+from bottleneck.stats import Histogram, Metrics
+
 global _engine
 _engine = None
 
+# Results of reads pinned to timestamps older than the horizon. Tables are
+# append-only, so those reads can never change.
+_history_cache = None
+_history_horizon_ms = None
+_MISSING = object()
+
+# Tables that keep a <table>_current row per primary key, mapped to their
+# primary keys (excluding timestamp).
+_current_tables = {}
+
+# Tables whose writes NOTIFY listeners, mapped to the field the
+# notifications are keyed on (e.g. game_id).
+NOTIFY_CHANNEL = 'bottleneck'
+_notify_tables = {}
+
+# Rarely written tables kept in a process-wide cache, mapped to the fields
+# they are looked up by and the fields cached for each row. Writes NOTIFY
+# INVALIDATE_CHANNEL so every process drops its stale copies.
+INVALIDATE_CHANNEL = 'bottleneck_invalidate'
+_reference_tables = {}
+_reference_cache = None
+
+# The database clock, in the epoch milliseconds of every timestamp.
+_CLOCK_MS = "CAST(1000 * EXTRACT(EPOCH FROM clock_timestamp()) AS BIGINT)"
+
+# Versions are stamped when they are written (see _version_stamp), and may
+# commit long after younger ones. A version is settled once no open
+# transaction that writes as this role started at or before it, and it is
+# older than the lag, which covers a commit racing the read of
+# pg_stat_activity. Readers hold no transaction id, so they never hold the
+# horizon back, and this role can always see its own sessions' activity.
+# Only settled timestamps are handed out as high-water marks. The horizon
+# never trails the clock by more than the max lag: writing transactions
+# open longer than that may commit versions below a mark already handed
+# out, so they are expected to commit well within it.
+_changes_lag_ms = 0
+_changes_max_lag_ms = 60000
+_SETTLED_HORIZON = """
+    GREATEST(
+        {clock} - :max_lag_ms,
+        LEAST(
+            {clock} - :lag_ms,
+            (SELECT min(CAST(1000 * EXTRACT(EPOCH FROM xact_start)
+                             AS BIGINT))
+             FROM pg_stat_activity
+             WHERE datname = current_database()
+             AND usename = current_user
+             AND backend_xid IS NOT NULL
+             AND pid <> pg_backend_pid()) - 1))
+    """.format(clock=_CLOCK_MS)
+
+# Statements are built once per shape of call and reused. SQLAlchemy then
+# keeps their compiled form, keyed on the statement object.
+QUERY_CACHE_SIZE = 512
+_compiled_cache = LRUCache(QUERY_CACHE_SIZE)
+
+# How long callers wait to check a connection out of the pool, and how
+# often they give up.
+_checkout_wait_ms = Histogram()
+_checkout_timeouts = 0
+
+# Latency and rows of every storage call, by operation and table.
+_query_metrics = Metrics(['operation', 'table'])
+
+# Holds the connection of the transaction this thread is currently inside,
+# and the unit of work (e.g. request) and identity map it is serving.
+_local = threading.local()
+
 log = logging.getLogger(__name__)
 
 
@@ -43,21 +120,446 @@ def get_db_url(db_name):
     )
 
 
-def init(db_url):
-    """Initialize the Lucid bottleneck."""
-    global _engine
-    _engine = create_engine(db_url, pool_size=20, max_overflow=0)
+def init(db_url, history_cache_size=0, history_horizon_ms=60000,
+         current_tables=None, pool_size=20, max_overflow=0, pool_timeout=30,
+         pool_recycle=-1, pool_pre_ping=False, notify_tables=None,
+         reference_tables=None, reference_cache_size=0,
+         reference_cache_ttl_s=300, changes_lag_ms=0,
+         changes_max_lag_ms=60000):
+    """Initialize the Lucid bottleneck.
+
+    The pool_* arguments configure the connection pool. pool_pre_ping
+    tests each connection as it is checked out and replaces it if the
+    database has dropped it.
+
+    history_cache_size bounds the cache of reads at timestamps more than
+    history_horizon_ms in the past. A size of 0 disables the cache.
+
+    current_tables maps tables that have a <table>_current companion to
+    their primary keys. Writes keep the companion up to date, and reads
+    without a timestamp are served from it.
+
+    notify_tables maps tables to a key field. Every row written to them is
+    sent on the NOTIFY_CHANNEL when its transaction commits, as JSON with
+    the table, the row's key and the row itself. See bottleneck.notify.
+
+    reference_tables maps tables keyed by id to {'keys': [...], 'fields':
+    [...]}. get_item and get_items lookups by one of the keys are served
+    from a cache of up to reference_cache_size rows, each re-read after
+    reference_cache_ttl_s seconds at the latest. A size of 0 disables it.
+
+    changes_lag_ms holds high-water marks at least that far in the past,
+    and changes_max_lag_ms at most that far; see _SETTLED_HORIZON.
+    """
+    global _engine, _history_cache, _history_horizon_ms, _current_tables
+    global _notify_tables, _reference_tables, _reference_cache
+    global _changes_lag_ms, _changes_max_lag_ms
+    _engine = create_engine(
+        db_url, pool_size=pool_size, max_overflow=max_overflow,
+        pool_timeout=pool_timeout, pool_recycle=pool_recycle,
+        execution_options={'compiled_cache': _compiled_cache})
+    if pool_pre_ping:
+        event.listen(_engine, 'engine_connect', _ping_connection)
+    _history_cache = (LRUCache(history_cache_size)
+                      if history_cache_size else None)
+    _history_horizon_ms = history_horizon_ms
+    _current_tables = dict(current_tables or {})
+    _notify_tables = dict(notify_tables or {})
+    _reference_tables = (dict(reference_tables or {})
+                         if reference_cache_size else {})
+    _reference_cache = (LRUCache(reference_cache_size,
+                                 ttl=reference_cache_ttl_s)
+                        if _reference_tables else None)
+    _changes_lag_ms = changes_lag_ms
+    _changes_max_lag_ms = changes_max_lag_ms
+
+
+# Reused by every ping, so they share one entry in the compiled cache.
+_PING = select([1])
+
+
+def _ping_connection(connection, branch):
+    """Make sure a connection fresh from the pool is still alive.
+
+    If the database went away, the ping invalidates the pool's connections
+    and the retry runs on a new one.
+    """
+    if branch:
+        return
+
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(_PING)
+    except exc.DBAPIError as err:
+        if err.connection_invalidated:
+            connection.scalar(_PING)
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+def _checkout():
+    """Check a connection out of the pool, recording how long it took."""
+    global _checkout_timeouts
+    start = time.perf_counter()
+    try:
+        return _engine.connect()
+    except exc.TimeoutError:
+        _checkout_timeouts += 1
+        raise
+    finally:
+        _checkout_wait_ms.observe((time.perf_counter() - start) * 1000)
+
+
+@contextmanager
+def _begin():
+    """Like engine.begin(), with the checkout instrumented."""
+    conn = _checkout()
+    try:
+        with conn.begin():
+            yield conn
+    finally:
+        conn.close()
+
+
+def get_pool_stats():
+    """Return the pool's size, use, checkout waits and timeouts."""
+    if _engine is None:
+        return None
+
+    pool = _engine.pool
+    return {
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'checkout_timeouts': _checkout_timeouts,
+        'checkout_wait_ms': _checkout_wait_ms.snapshot(),
+    }
+
+
+def _count_item(item):
+    return 1 if item else 0
+
+
+def instrumented(operation, table_arg='table', count_rows=len):
+    """Record the latency and row count of each call of a storage function.
+
+    table_arg names the argument holding the table (or list of tables), and
+    count_rows turns the function's result into a number of rows. Calls are
+    recorded in the query metrics by (operation, table).
+    """
+    def decorator(f):
+        position = f.__code__.co_varnames.index(table_arg)
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            rows = 0
+            try:
+                result = f(*args, **kwargs)
+                rows = count_rows(result) if result is not None else 0
+                return result
+            finally:
+                table = (args[position] if len(args) > position
+                         else kwargs[table_arg])
+                if not isinstance(table, str):
+                    table = ','.join(table)
+                _query_metrics.observe((operation, table),
+                                       (time.perf_counter() - start) * 1000,
+                                       rows)
+        return wrapper
+    return decorator
+
+
+def get_query_metrics():
+    """Return latency histograms and row counts by (operation, table)."""
+    return _query_metrics.snapshot()
+
+
+def get_query_cache_stats():
+    """Return hit and size stats of the statement caches."""
+    builders = {
+        'get_item': _get_item_query,
+        'get_items': _get_items_query,
+        'get_latest_items': _get_latest_items_query,
+        'get_current_items': _get_current_items_query,
+        'get_changes': _get_changes_query,
+        'get_high_water_mark': _get_high_water_mark_query,
+        'put_items': _put_items_query,
+        'revise_items': _revise_items_query,
+        'lock_items': _lock_items_query,
+        'advisory_lock': _advisory_lock_query,
+        'get_keyed_items': _get_keyed_items_query,
+    }
+    stats = {}
+    for operation, builder in builders.items():
+        info = builder.cache_info()
+        stats[operation] = {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+        }
+    stats['compiled'] = _compiled_cache.stats()
+    return stats
+
+
+def get_history_cache_stats():
+    """Return size, hit and eviction stats of the historical read cache."""
+    if _history_cache is not None:
+        return dict(_history_cache.stats(),
+                    horizon_ms=_history_horizon_ms)
+
+
+def get_reference_cache_stats():
+    """Return size, hit rate and invalidation stats of the reference cache."""
+    if _reference_cache is not None:
+        return dict(_reference_cache.stats(), ttl_s=_reference_cache.ttl)
+
+
+class IdentityMap(object):
+    """Entities loaded during one unit of work, such as a request.
+
+    Keyed by (table, id, timestamp), so each distinct version of an entity
+    is loaded from the database at most once while the map is active.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, table, id_, timestamp, fields):
+        """Return a copy of a loaded entity, or None if it is not loaded."""
+        item = self.items.get((table, str(id_), timestamp))
+        if item is None or not set(fields) <= set(item):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return {field: item[field] for field in fields}
+
+    def add(self, table, id_, timestamp, item):
+        self.items[(table, str(id_), timestamp)] = dict(item)
+
+    def stats(self):
+        return {
+            'size': len(self.items),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def start_identity_map():
+    """Begin a unit of work with an empty identity map for this thread."""
+    _local.identity_map = IdentityMap()
+
+
+def clear_identity_map():
+    """End this thread's unit of work. Returns the identity map's stats."""
+    identity_map = getattr(_local, 'identity_map', None)
+    _local.identity_map = None
+    if identity_map is not None:
+        return identity_map.stats()
+
+
+def get_identity_map():
+    """Return this thread's identity map, if a unit of work is active."""
+    return getattr(_local, 'identity_map', None)
+
+
+class UnitOfWork(object):
+    """One pooled connection and transaction shared by a whole request.
+
+    The connection is checked out lazily by the first bottleneck call.
+    Read-only units run at REPEATABLE READ, so all of their reads see the
+    same snapshot of the database.
+    """
+
+    def __init__(self, read_only=False):
+        self.read_only = read_only
+        self.connection = None
+        self.transaction = None
+        self.failed = False
+
+    def get_connection(self):
+        if self.connection is None:
+            connection = _checkout()
+            if self.read_only:
+                connection = connection.execution_options(
+                    isolation_level='REPEATABLE READ')
+            self.connection = connection
+            self.transaction = connection.begin()
+        return self.connection
+
+    def finish(self, commit=True):
+        """Commit or roll back, and return the connection to the pool."""
+        if self.connection is None:
+            _end_after_commit(commit)
+            return
+
+        committed = False
+        try:
+            if commit and not self.failed:
+                self.transaction.commit()
+                committed = True
+            else:
+                self.transaction.rollback()
+        finally:
+            self.connection.close()
+            self.connection = None
+            self.transaction = None
+            self.failed = False
+            _local.dirty_references = frozenset()
+            _end_after_commit(committed)
+
+
+def begin_request(read_only=False):
+    """Start a unit of work for this thread, e.g. for one HTTP request.
+
+    Until end_request(), every bottleneck call reuses one connection and
+    transaction, and expansions share one identity map.
+    """
+    _local.unit_of_work = UnitOfWork(read_only=read_only)
+    _local.after_commit = []
+    start_identity_map()
+
+
+def finish_request(commit=True):
+    """Commit or roll back the unit of work so far.
+
+    Raises if the commit fails, so a caller can still report the failure.
+    Later calls in the same unit of work begin a new transaction.
+    """
+    unit_of_work = getattr(_local, 'unit_of_work', None)
+    if unit_of_work is not None:
+        unit_of_work.finish(commit=commit)
+
+
+def end_request(error=None):
+    """End this thread's unit of work, committing unless there was an error.
+
+    Returns the identity map's stats.
+    """
+    unit_of_work = getattr(_local, 'unit_of_work', None)
+    _local.unit_of_work = None
+    try:
+        if unit_of_work is not None:
+            unit_of_work.finish(commit=error is None)
+    finally:
+        stats = clear_identity_map()
+    return stats
+
+
+@contextmanager
+def transaction():
+    """Run every bottleneck call in the block inside a single transaction.
+
+    Nested blocks, and any get_connection() call made inside the block,
+    reuse the outermost connection. The transaction commits when the
+    outermost block exits, and rolls back if it raises. Inside a unit of
+    work the block is a SAVEPOINT of the unit's transaction instead.
+    """
+    conn = getattr(_local, 'connection', None)
+    if conn is not None:
+        yield conn
+        return
+
+    unit_of_work = getattr(_local, 'unit_of_work', None)
+    if unit_of_work is not None:
+        conn = unit_of_work.get_connection()
+        _local.connection = conn
+        if getattr(_local, 'after_commit', None) is None:
+            _local.after_commit = []
+        pending = len(_local.after_commit)
+        try:
+            with conn.begin_nested():
+                yield conn
+        except Exception:
+            # Rolled back to the savepoint, with the block's callbacks.
+            del _local.after_commit[pending:]
+            raise
+        finally:
+            _local.connection = None
+        return
+
+    _local.after_commit = []
+    committed = False
+    try:
+        with _begin() as conn:
+            _local.connection = conn
+            try:
+                yield conn
+            finally:
+                _local.connection = None
+                _local.dirty_references = frozenset()
+        committed = True
+    finally:
+        _end_after_commit(committed)
+
+
+def after_commit(callback):
+    """Call callback() once the outermost transaction commits.
+
+    Inside a transaction() block or a unit of work, the call waits for the
+    commit, and never happens if the transaction, or the transaction()
+    savepoint it was registered in, rolls back. Otherwise there is nothing
+    to wait for, and callback() is called right away.
+    """
+    if (getattr(_local, 'connection', None) is None
+            and getattr(_local, 'unit_of_work', None) is None):
+        callback()
+        return
+
+    _local.after_commit = getattr(_local, 'after_commit', None) or []
+    _local.after_commit.append(callback)
+
 
+def _end_after_commit(committed):
+    """Run the after_commit() callbacks, or drop them after a rollback."""
+    callbacks = getattr(_local, 'after_commit', None) or []
+    _local.after_commit = []
+    if committed:
+        for callback in callbacks:
+            callback()
 
+
+@contextmanager
 def get_connection():
-    global _engine
-    return _engine.begin()
+    """Get a connection for one statement (or a few).
+
+    Joins the enclosing transaction() block or unit of work if there is
+    one, otherwise runs in a transaction of its own.
+    """
+    conn = getattr(_local, 'connection', None)
+    if conn is not None:
+        yield conn
+        return
+
+    unit_of_work = getattr(_local, 'unit_of_work', None)
+    if unit_of_work is None:
+        with _begin() as conn:
+            yield conn
+        return
+
+    try:
+        yield unit_of_work.get_connection()
+    except Exception:
+        # The transaction may be aborted, so it must not be committed.
+        unit_of_work.failed = True
+        raise
 
 
 def deinit():
     """Uninitialize the package if necessary for testing."""
-    global _engine
+    global _engine, _history_cache, _current_tables, _reference_tables
+    global _reference_cache
     _engine = None
+    _history_cache = None
+    _current_tables = {}
+    _reference_tables = {}
+    _reference_cache = None
 
 
 def mock_bottleneck(f):
@@ -73,7 +575,10 @@ def mock_bottleneck(f):
     return wrapper
 
 
+@instrumented('clean_db', table_arg='tables')
 def clean_db(tables):
+    tables = list(tables) + [_current_table(table) for table in tables
+                             if table in _current_tables]
     with get_connection() as conn:
         query = sql_text("{truncates};SELECT 1"
                          .format(truncates=";".join("TRUNCATE TABLE %s" % table
@@ -81,6 +586,63 @@ def clean_db(tables):
         results = conn.execute(query).fetchall()
         assert results[0][0] == 1
 
+    # Truncation bypasses invalidation.
+    clear_reference_cache()
+
+
+def _current_table(table):
+    return '%s_current' % table
+
+
+def _read_table(table, timestamp):
+    """Pick the table a read should be served from.
+
+    Reads of the present come from the <table>_current companion when there
+    is one. Reads at a timestamp need the full history.
+    """
+    if not timestamp and table in _current_tables:
+        return _current_table(table)
+    return table
+
+
+def _current_upsert(table, fields, source):
+    """SQL that upserts the latest of the source rows into <table>_current.
+
+    An older version never replaces a newer one.
+    """
+    primary_keys = _current_tables[table]
+    return """
+        INSERT INTO {current} ({field_names})
+        SELECT DISTINCT ON ({primary_keys}) {field_names}
+        FROM {source}
+        ORDER BY {primary_keys}, timestamp DESC
+        ON CONFLICT ({primary_keys}) DO UPDATE
+        SET {assignments}
+        WHERE {current}.timestamp <= EXCLUDED.timestamp
+        """.format(current=_current_table(table),
+                   source=source,
+                   field_names=', '.join(fields),
+                   primary_keys=', '.join(primary_keys),
+                   assignments=', '.join(
+                       '%s = EXCLUDED.%s' % (field, field)
+                       for field in fields if field not in primary_keys))
+
+
+def backfill_current(table, primary_keys=None):
+    """Rebuild <table>_current from the table's full history."""
+    primary_keys = primary_keys or _current_tables[table]
+    with get_connection() as conn:
+        conn.execute(sql_text(
+            """
+            TRUNCATE TABLE {current};
+            INSERT INTO {current}
+            SELECT DISTINCT ON ({primary_keys}) *
+            FROM {table}
+            ORDER BY {primary_keys}, timestamp DESC
+            """.format(current=_current_table(table),
+                       table=table,
+                       primary_keys=', '.join(primary_keys))))
+
 
 def _colon_replacer(field, defaults):
     if field in defaults:
@@ -102,6 +664,130 @@ class StorageError(Exception):
     pass
 
 
+def _history_key(operation, table, fields, conditions, timestamp):
+    """Return the history cache key for a read, if the read is cacheable.
+
+    Only reads pinned to a timestamp older than the horizon are cacheable.
+    """
+    if _history_cache is None or not timestamp:
+        return None
+
+    try:
+        timestamp = int(timestamp)
+    except (TypeError, ValueError):
+        return None
+
+    if timestamp > get_timestamp_millis() - _history_horizon_ms:
+        return None
+
+    return (operation, table, tuple(fields),
+            tuple(sorted((key, str(value))
+                         for key, value in conditions.items())),
+            timestamp)
+
+
+def _reference_key(table, conditions, fields):
+    """Return the lookup key of a read the reference cache can serve."""
+    reference = _reference_tables.get(table)
+    if reference is None or len(conditions) != 1:
+        return None
+
+    key = next(iter(conditions))
+    if key in reference['keys'] and set(fields) <= set(reference['fields']):
+        return key
+
+
+def _reference_visible(row, timestamp):
+    """Whether the latest version of a row is also the latest at timestamp."""
+    if not timestamp:
+        return True
+
+    try:
+        return row['timestamp'] <= int(timestamp)
+    except (TypeError, ValueError):
+        return False
+
+
+def _get_references(table, key, values, fields, timestamp):
+    """Serve lookups of a reference table by key from the reference cache.
+
+    Misses read the latest version of the rows and cache it. Returns
+    ({value: item or None}, values to read at the timestamp instead), the
+    latter being rows that changed after the timestamp. Rows this thread
+    has written but not committed are never cached.
+    """
+    found = {}
+    misses = set()
+    for value in set(str(value) for value in values):
+        row = _reference_cache.get((table, key, value))
+        if row is None:
+            misses.add(value)
+        elif _reference_visible(row, timestamp):
+            found[value] = {field: row[field] for field in fields}
+        else:
+            found[value] = _MISSING
+
+    if misses and table not in getattr(_local, 'dirty_references', ()):
+        for row in _get_latest_references(table, key, misses):
+            _cache_reference(table, row)
+            found[str(row[key])] = (
+                {field: row[field] for field in fields}
+                if _reference_visible(row, timestamp) else _MISSING)
+
+        # Tables are append-only: a row missing now was missing at any time.
+        for value in misses - set(found):
+            found[value] = None
+        misses = set()
+
+    return ({value: item for value, item in found.items()
+             if item is not _MISSING},
+            [value for value, item in found.items() if item is _MISSING]
+            + list(misses))
+
+
+def _get_latest_references(table, key, values):
+    """Read the latest version of reference rows, with every cached field."""
+    fields = _reference_tables[table]['fields']
+    if key != 'id':
+        rows = [_get_item({key: value}, table, fields, None)
+                for value in values]
+        return [row for row in rows if row]
+
+    query = _get_items_query(_read_table(table, None), tuple(fields), False)
+    with get_connection() as conn:
+        results = conn.execute(query, ids=tuple(values)).fetchall()
+    return [dict(zip(fields, row[1:])) for row in results]
+
+
+def _cache_reference(table, row):
+    """Cache a row under every key it can be looked up by."""
+    _start_invalidation_listener()
+    for key in _reference_tables[table]['keys']:
+        if row[key] is not None:
+            _reference_cache.put((table, key, str(row[key])), row)
+
+
+def _start_invalidation_listener():
+    # Imported here, as bottleneck.notify imports this module. The cache is
+    # cleared whenever the listener connects, so rows cached before then
+    # cannot go stale.
+    from bottleneck.notify import start_invalidation_listener
+    start_invalidation_listener()
+
+
+def clear_reference_cache():
+    if _reference_cache is not None:
+        _reference_cache.clear()
+
+
+def invalidate_reference(table, id_):
+    """Drop every cached lookup of the row with that id."""
+    if _reference_cache is not None and table in _reference_tables:
+        _reference_cache.discard_where(
+            lambda key, row: key[0] == table and str(row['id']) == str(id_))
+
+
+@instrumented('get_item', count_rows=_count_item)
 def get_item(conditions, table, fields, whitelist=None, timestamp=None):
     """Lookup an arbitrary Item from the database.
 
@@ -112,24 +798,50 @@ def get_item(conditions, table, fields, whitelist=None, timestamp=None):
 
     assert conditions and isinstance(conditions, dict)
 
-    conditions_clause = ' AND '.join('%s=:%s' % (key, key)
-                                     for key in conditions.keys())
-
+    reference_key = _reference_key(table, conditions, fields)
+    if reference_key is not None:
+        value = str(conditions[reference_key])
+        found, _ = _get_references(table, reference_key, [value], fields,
+                                   timestamp)
+        if value in found:
+            return found[value]
+
+    key = _history_key('get_item', table, fields, conditions, timestamp)
+    if key is not None:
+        item = _history_cache.get(key, _MISSING)
+        if item is not _MISSING:
+            return dict(item) if item else item
+
+    item = _get_item(conditions, table, fields, timestamp)
+
+    if key is not None:
+        _history_cache.put(key, dict(item) if item else item)
+    return item
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _get_item_query(table, fields, condition_keys, has_timestamp):
+    return sql_text(
+        """
+        SELECT {field_names}
+        FROM {table}
+        WHERE {conditions_clause}
+        {time_clause}
+        ORDER BY timestamp DESC
+        LIMIT 1
+        """.format(
+            field_names=', '.join(fields),
+            table=table,
+            time_clause='AND timestamp <= :timestamp' if has_timestamp else '',
+            conditions_clause=' AND '.join('%s=:%s' % (key, key)
+                                           for key in condition_keys),
+        ))
+
+
+def _get_item(conditions, table, fields, timestamp):
+    query = _get_item_query(_read_table(table, timestamp), tuple(fields),
+                            tuple(sorted(conditions)), bool(timestamp))
     with get_connection() as conn:
-        query = sql_text(
-            """
-            SELECT {field_names}
-            FROM {table}
-            WHERE {conditions_clause}
-            {time_clause}
-            ORDER BY timestamp DESC
-            LIMIT 1
-            """.format(
-                field_names=', '.join(fields),
-                table=table,
-                time_clause='AND timestamp <= :timestamp' if timestamp else '',
-                conditions_clause=conditions_clause,
-            ))
         results = conn.execute(query, timestamp=timestamp,
                                **conditions).fetchall()
 
@@ -137,12 +849,66 @@ def get_item(conditions, table, fields, whitelist=None, timestamp=None):
         return dict(zip(fields, results[0]))
 
 
-def put_item(item, table, fields, primary_keys=('id',),
-             defaults=('timestamp',)):
-    """Place an item item into the database.
-
-    Returns the full version from the database, including the id.
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _get_items_query(table, fields, has_timestamp):
+    return sql_text(
+        """
+        SELECT DISTINCT ON (id) id, {field_names}
+        FROM {table}
+        WHERE id IN :ids
+        {time_clause}
+        ORDER BY id, timestamp DESC
+        """.format(
+            field_names=', '.join(fields),
+            table=table,
+            time_clause='AND timestamp <= :timestamp' if has_timestamp else '',
+        ))
+
+
+@instrumented('get_items')
+def get_items(ids, table, fields, timestamp=None):
+    """Lookup many Items by id in a single query.
+
+    Returns a dict of id to item, with the same versioning semantics as
+    get_item: if a timestamp exists, each item is the latest version up to
+    that timestamp. Ids that do not exist are missing from the result.
     """
+    items = {}
+    keys = {}
+    if _reference_key(table, {'id': None}, fields):
+        found, ids = _get_references(table, 'id', ids, fields, timestamp)
+        items.update((id_, item) for id_, item in found.items() if item)
+
+    for id_ in set(str(id_) for id_ in ids):
+        key = _history_key('get_item', table, fields, {'id': id_}, timestamp)
+        item = (_history_cache.get(key, _MISSING) if key is not None
+                else _MISSING)
+        if item is _MISSING:
+            keys[id_] = key
+        elif item:
+            items[id_] = dict(item)
+
+    ids = tuple(keys)
+    if not ids:
+        return items
+
+    query = _get_items_query(_read_table(table, timestamp), tuple(fields),
+                             bool(timestamp))
+    with get_connection() as conn:
+        results = conn.execute(query, ids=ids, timestamp=timestamp).fetchall()
+
+    fetched = {str(row[0]): dict(zip(fields, row[1:])) for row in results}
+    for id_, key in keys.items():
+        if key is not None:
+            item = fetched.get(id_)
+            _history_cache.put(key, dict(item) if item else None)
+
+    items.update(fetched)
+    return items
+
+
+def _prepare_item(item, table, fields, primary_keys, defaults):
+    """Validate an item for insertion and strip it down to its values."""
     # defaults are the fields that will be set using the COLUMN's DEFAULT
     # expression
     item = {k: v for k, v in item.items()
@@ -166,86 +932,458 @@ def put_item(item, table, fields, primary_keys=('id',),
 
     if missing_fields != set(defaults):
         for default in defaults:
-            missing_fields.discard(defaults)
+            missing_fields.discard(default)
         raise StorageError('Missing fields: %s while putting %s into %s' % (
             ', '.join(missing_fields),
             item,
             table))
 
-    conditions_clause = ' AND '.join('%s=:%s' % (key, key)
-                                     for key in primary_keys)
+    return item
+
+
+@instrumented('put_item', count_rows=_count_item)
+def put_item(item, table, fields, primary_keys=('id',),
+             defaults=('timestamp',)):
+    """Place an item item into the database.
+
+    Returns the full version from the database, including the id. The
+    version comes from INSERT ... RETURNING, so it is exactly the row that
+    was written even when other writers are adding versions concurrently.
+    """
+    return _put_items([item], table, fields, primary_keys, defaults)[0]
+
+
+def _version_stamp(latest_timestamp):
+    """SQL for the timestamp of a new version of an item.
+
+    It is the database clock as the version is written, or one past the
+    item's latest timestamp if that is newer. A writer holding an item's
+    lock thus always supersedes the version it locked, even if its
+    transaction began before that version was written, and never collides
+    with it on the primary key.
+    """
+    return 'GREATEST(%s, %s + 1)' % (_CLOCK_MS, latest_timestamp)
+
+
+def _put_value(table, field, index, defaults, primary_keys):
+    """SQL for a field of the index'th row of a multi-row INSERT."""
+    if field not in defaults:
+        return ':%s_%d' % (field, index)
+    if field != 'timestamp':
+        return 'DEFAULT'
+    return _version_stamp(
+        '(SELECT max(timestamp) FROM {table} WHERE {clauses})'.format(
+            table=table,
+            clauses=' AND '.join('%s = :%s_%d' % (key, key, index)
+                                 for key in primary_keys)))
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _put_items_query(table, fields, defaults, count, has_current,
+                     notify_key=None, invalidate=False, primary_keys=('id',)):
+    rows = []
+    for index in range(count):
+        rows.append('(%s)' % ', '.join(
+            _put_value(table, field, index, defaults, primary_keys)
+            for field in fields))
+
+    return sql_text(
+        """
+        WITH inserted AS (
+            INSERT INTO {table} ({field_names}) VALUES {rows}
+            RETURNING {field_names}
+        ){write_clauses}
+        """.format(table=table,
+                   field_names=', '.join(fields),
+                   write_clauses=_write_clauses(table, fields, has_current,
+                                                notify_key, invalidate),
+                   rows=', '.join(rows)))
+
+
+def _write_clauses(table, fields, has_current, notify_key, invalidate):
+    """SQL following an `inserted AS (INSERT ... RETURNING)` clause.
+
+    Keeps <table>_current up to date, sends the notifications and selects
+    the inserted rows.
+    """
+    if has_current:
+        current_clause = ', current AS (%s)' % _current_upsert(
+            table, fields, 'inserted')
+    else:
+        current_clause = ''
+
+    # pg_notify() adds trailing columns, which the caller's zip() drops.
+    if notify_key:
+        notify_column = (
+            ", pg_notify('{channel}', json_build_object("
+            "'table', '{table}', 'key', inserted.{key}, "
+            "'row', row_to_json(inserted))::text)").format(
+                channel=NOTIFY_CHANNEL, table=table, key=notify_key)
+    else:
+        notify_column = ''
+
+    if invalidate:
+        notify_column += (
+            ", pg_notify('{channel}', json_build_object("
+            "'table', '{table}', 'key', inserted.id)::text)").format(
+                channel=INVALIDATE_CHANNEL, table=table)
+
+    return """
+        {current_clause}
+        SELECT {field_names}{notify_column} FROM inserted
+        """.format(current_clause=current_clause,
+                   field_names=', '.join(fields),
+                   notify_column=notify_column)
+
+
+@instrumented('put_items')
+def put_items(items, table, fields, primary_keys=('id',),
+              defaults=('timestamp',)):
+    """Place many items of one table into the database at once.
+
+    All items are written by a single multi-row INSERT ... RETURNING, so the
+    whole batch costs one round trip. Returns the stored versions in the
+    same order as the items.
+    """
+    return _put_items(items, table, fields, primary_keys, defaults)
+
+
+def _put_items(items, table, fields, primary_keys, defaults):
+    items = [_prepare_item(item, table, fields, primary_keys, defaults)
+             for item in items]
+    if not items:
+        return []
+
+    params = {}
+    for index, item in enumerate(items):
+        for field, value in item.items():
+            params['%s_%d' % (field, index)] = value
+
+    query = _put_items_query(table, tuple(fields), tuple(defaults),
+                             len(items), table in _current_tables,
+                             _notify_tables.get(table),
+                             table in _reference_tables,
+                             tuple(key for key in primary_keys
+                                   if key != 'timestamp'))
     with get_connection() as conn:
-        query = sql_text(
-            """
-            INSERT INTO {table} ({field_names}) VALUES ({field_refs});
-            SELECT {field_names}
-            FROM {table}
-            WHERE {conditions_clause}
-            ORDER BY timestamp DESC
-            LIMIT 1
-            """.format(table=table,
-                       conditions_clause=conditions_clause,
-                       field_names=', '.join(fields),
-                       field_refs=', '.join(colonify(fields,
-                                                     defaults=defaults))))
-        results = conn.execute(query, **item).fetchall()
+        results = conn.execute(query, **params).fetchall()
+
+    rows = [dict(zip(fields, row)) for row in results]
+    if table in _reference_tables:
+        _invalidate_written(table, rows)
+    return rows
+
+
+def _invalidate_written(table, rows):
+    """Drop this process's cached copies of rows just written.
+
+    Other processes drop theirs when the INVALIDATE_CHANNEL notification
+    arrives. Until this thread's transaction commits, it reads the rows
+    from the database rather than caching a version that may roll back.
+    """
+    if (getattr(_local, 'connection', None) is not None
+            or getattr(_local, 'unit_of_work', None) is not None):
+        _local.dirty_references = (
+            getattr(_local, 'dirty_references', frozenset()) | {table})
+
+    for row in rows:
+        invalidate_reference(table, row['id'])
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _revise_items_query(table, fields, condition_keys, primary_keys, changes,
+                        has_current, notify_key=None, invalidate=False):
+    written = list(fields)
+    expressions = dict(changes, timestamp=_version_stamp('timestamp'))
+    if has_current:
+        source = _current_table(table)
+        version_filters = []
+        row_filters = ['%s=:%s' % (key, key) for key in condition_keys]
+    else:
+        source = table
+        version_filters = ['%s=:%s' % (key, key) for key in condition_keys
+                           if key in primary_keys]
+        row_filters = ['%s=:%s' % (key, key) for key in condition_keys
+                       if key not in primary_keys]
+
+    return sql_text(
+        """
+        WITH inserted AS (
+            INSERT INTO {table} ({written_names})
+            SELECT {expressions}
+            FROM (
+                SELECT DISTINCT ON ({primary_keys}) *
+                FROM {source}
+                WHERE {version_clauses}
+                ORDER BY {primary_keys}, timestamp DESC
+            ) latest
+            {row_clauses}
+            RETURNING {field_names}
+        ){write_clauses}
+        """.format(
+            table=table,
+            source=source,
+            written_names=', '.join(written),
+            expressions=', '.join(expressions.get(field, field)
+                                  for field in written),
+            primary_keys=', '.join(primary_keys),
+            version_clauses=' AND '.join(['TRUE'] + version_filters),
+            row_clauses=('WHERE ' + ' AND '.join(row_filters)
+                         if row_filters else ''),
+            field_names=', '.join(fields),
+            write_clauses=_write_clauses(table, fields, has_current,
+                                         notify_key, invalidate)))
+
+
+@instrumented('revise_items')
+def revise_items(table, fields, conditions, primary_keys, changes,
+                 params=None):
+    """Write a new version of every item matching the conditions.
+
+    The versions are copied from the latest ones with `changes` applied, by
+    a single INSERT ... SELECT, so no row makes a round trip however many
+    match. changes maps fields to SQL expressions over the latest version's
+    columns, which may use bound :params. Conditions filter the latest
+    versions as in get_latest_items. Returns the versions written.
+    """
+    assert conditions and isinstance(conditions, dict)
+    primary_keys = tuple(key for key in primary_keys if key != 'timestamp')
+
+    query = _revise_items_query(table, tuple(fields),
+                                tuple(sorted(conditions)), primary_keys,
+                                tuple(sorted(changes.items())),
+                                table in _current_tables,
+                                _notify_tables.get(table),
+                                table in _reference_tables)
+    with get_connection() as conn:
+        results = conn.execute(query, **dict(params or {},
+                                             **conditions)).fetchall()
+
+    rows = [dict(zip(fields, row)) for row in results]
+    if table in _reference_tables:
+        _invalidate_written(table, rows)
+    return rows
+
+
+def _key_rows(primary_keys, count):
+    """(:key_0, ...), (:key_1, ...): the bound keys of count items."""
+    return ', '.join('(%s)' % ', '.join(':%s_%d' % (key, index)
+                                        for key in primary_keys)
+                     for index in range(count))
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _lock_items_query(table, fields, primary_keys, count, share=False):
+    return sql_text(
+        """
+        SELECT {field_names}
+        FROM {table}
+        WHERE ({primary_keys}) IN ({rows})
+        ORDER BY {primary_keys}
+        FOR {strength}
+        """.format(field_names=', '.join(fields),
+                   table=_current_table(table),
+                   primary_keys=', '.join(primary_keys),
+                   rows=_key_rows(primary_keys, count),
+                   strength='SHARE' if share else 'UPDATE'))
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _advisory_lock_query(count, share=False):
+    # Taken in the order of the lock ids, so lockers cannot deadlock even
+    # when two keys hash alike. OFFSET 0 keeps the sort below the locking.
+    return sql_text(
+        """
+        SELECT pg_advisory_xact_lock{shared}(hashtext(:table), hashtext(key))
+        FROM (
+            SELECT key FROM (VALUES {keys}) AS keys (key)
+            ORDER BY hashtext(key)
+            OFFSET 0
+        ) sorted
+        """.format(shared='_shared' if share else '',
+                   keys=', '.join('(:key_%d)' % index
+                                  for index in range(count))))
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _get_keyed_items_query(table, fields, primary_keys, count):
+    return sql_text(
+        """
+        SELECT DISTINCT ON ({primary_keys}) {field_names}
+        FROM {table}
+        WHERE ({primary_keys}) IN ({rows})
+        ORDER BY {primary_keys}, timestamp DESC
+        """.format(field_names=', '.join(fields),
+                   table=table,
+                   primary_keys=', '.join(primary_keys),
+                   rows=_key_rows(primary_keys, count)))
+
+
+@instrumented('lock_items')
+def lock_items(keys, table, fields, primary_keys=('id',), share=False):
+    """Lock the present version of many items until the transaction ends.
+
+    keys are dicts of primary key values. The rows of <table>_current are
+    locked with SELECT ... FOR UPDATE in primary key order, so writers
+    that lock the items they read and write are serialized across
+    processes without deadlocking each other. With share, the lock is FOR
+    SHARE instead: it keeps the items from changing, and only conflicts
+    with writers. Row locks outlast transaction() savepoints: they are
+    held until the outermost transaction commits or rolls back. Returns
+    the locked versions, read once the locks were granted; keys without a
+    version are missing.
+
+    A table without a <table>_current companion has no row to lock, so
+    each key takes a transaction-level advisory lock instead. Those only
+    exclude other lock_items() callers, not every writer of the items.
+    """
+    primary_keys = tuple(key for key in primary_keys if key != 'timestamp')
+    keys = list(keys)
+    if not keys:
+        return []
+
+    params = {}
+    for index, key in enumerate(keys):
+        for field in primary_keys:
+            params['%s_%d' % (field, index)] = key[field]
+
+    with get_connection() as conn:
+        if table in _current_tables:
+            query = _lock_items_query(table, tuple(fields), primary_keys,
+                                      len(keys), share)
+        else:
+            conn.execute(_advisory_lock_query(len(keys), share), table=table,
+                         **{'key_%d' % index: _lock_key(key, primary_keys)
+                            for index, key in enumerate(keys)})
+            # A statement of its own, to read what was committed meanwhile.
+            query = _get_keyed_items_query(table, tuple(fields),
+                                           primary_keys, len(keys))
+        results = conn.execute(query, **params).fetchall()
+    return [dict(zip(fields, row)) for row in results]
 
-    return dict(zip(fields, results[0]))
 
+def _lock_key(key, primary_keys):
+    return '/'.join(str(key[field]) for field in primary_keys)
 
+
+@instrumented('get_latest_items')
 def get_latest_items(table, fields, timestamp=None, conditions=None,
                      primary_keys=None):
-    """Retrieve many items from a table, with conditional filtering."""
+    """Retrieve many items from a table, with conditional filtering.
+
+    The latest version of each primary key is found in a single pass with
+    DISTINCT ON, which walks the (primary keys..., timestamp DESC) index
+    instead of running a correlated max(timestamp) subquery per row.
+    Conditions on primary keys narrow the versions considered, other
+    conditions filter the latest versions. A condition whose value is a
+    tuple or list matches any of its values.
+    """
     conditions = conditions or {}
     assert isinstance(conditions, dict)
 
-    conditions_clause = (
-        ' AND '.join('%s=:%s' % (key, key)
-                     for key in conditions.keys()))
+    key = _history_key(('get_latest_items', tuple(primary_keys or ())),
+                       table, fields, conditions, timestamp)
+    if key is not None:
+        items = _history_cache.get(key)
+        if items is not None:
+            return [dict(item) for item in items]
+
+    items = _get_latest_items(table, fields, timestamp, conditions,
+                              primary_keys)
+
+    if key is not None:
+        _history_cache.put(key, [dict(item) for item in items])
+    return items
+
+
+def _in_keys(conditions):
+    """The condition keys that match any of a sequence of values."""
+    return tuple(sorted(key for key, value in conditions.items()
+                        if isinstance(value, (tuple, list))))
+
+
+def _bind_conditions(conditions, in_keys):
+    """Condition values as query params, with sequences as tuples."""
+    return {key: tuple(value) if key in in_keys else value
+            for key, value in conditions.items()}
+
 
-    # Select over composite primary keys, and still get the most recent entry
-    # for each relation.
-    subfilters = (
-        set(primary_keys or []) -
-        set(conditions.keys()) -
-        set(['timestamp']))
+def _condition_clause(key, in_keys):
+    if key in in_keys:
+        return '%s IN :%s' % (key, key)
+    return '%s=:%s' % (key, key)
 
-    subfilters_clause = (
-        ' AND '.join('t1.%s = t2.%s' % (subfilter, subfilter)
-                     for subfilter in subfilters))
 
-    if timestamp:
-        recency_clause = "t2.timestamp <= :timestamp"
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _get_latest_items_query(table, fields, condition_keys, has_timestamp,
+                            primary_keys, has_after=False, has_limit=False,
+                            in_keys=()):
+    version_filters = [_condition_clause(key, in_keys)
+                       for key in condition_keys if key in primary_keys]
+    row_filters = [_condition_clause(key, in_keys)
+                   for key in condition_keys if key not in primary_keys]
+    if has_after:
+        row_filters.append(_keyset_clause(primary_keys))
+
+    if has_timestamp:
+        recency_clause = "timestamp <= :timestamp"
     else:
-        recency_clause = ("t2.timestamp <= CAST("
-                          "1000 * EXTRACT(EPOCH FROM NOW()) AS BIGINT)")
-
-    timestamp_clause = """t1.timestamp = (
-        SELECT max(timestamp)
-        FROM {table} t2
-        WHERE {clauses})""".format(table=table,
-                                   clauses=' AND '.join(
-                                       filter(bool,
-                                              [recency_clause,
-                                               conditions_clause,
-                                               subfilters_clause])))
+        recency_clause = "timestamp <= %s" % _CLOCK_MS
 
+    return sql_text(
+        """
+        SELECT {field_names}
+        FROM (
+            SELECT DISTINCT ON ({primary_keys}) *
+            FROM {table}
+            WHERE {version_clauses}
+            ORDER BY {primary_keys}, timestamp DESC
+        ) latest
+        {row_clauses}
+        ORDER BY {order}
+        {limit_clause}
+        """.format(
+            field_names=', '.join(fields),
+            table=table,
+            primary_keys=', '.join(primary_keys),
+            version_clauses=' AND '.join([recency_clause] + version_filters),
+            row_clauses=('WHERE ' + ' AND '.join(row_filters)
+                         if row_filters else ''),
+            order=_keyset_order(primary_keys),
+            limit_clause='LIMIT :limit' if has_limit else '',
+        ))
+
+
+def _keyset_order(primary_keys):
+    """Newest first, with the primary keys breaking ties."""
+    return ', '.join('%s DESC' % key
+                     for key in ('timestamp',) + tuple(primary_keys))
+
+
+def _keyset_clause(primary_keys):
+    """Rows that sort after the :after_* key in _keyset_order."""
+    keys = ('timestamp',) + tuple(primary_keys)
+    return '(%s) < (%s)' % (', '.join(keys),
+                            ', '.join(':after_%s' % key for key in keys))
+
+
+def _get_latest_items(table, fields, timestamp, conditions, primary_keys):
+    if _read_table(table, timestamp) != table:
+        return _get_current_items(table, fields, conditions)
+
+    primary_keys = tuple(key for key in primary_keys or []
+                         if key != 'timestamp')
+    assert primary_keys, 'get_latest_items requires primary_keys'
+
+    in_keys = _in_keys(conditions)
+    query = _get_latest_items_query(table, tuple(fields),
+                                    tuple(sorted(conditions)),
+                                    bool(timestamp), primary_keys,
+                                    in_keys=in_keys)
     with get_connection() as conn:
-        query = sql_text(
-            """
-            SELECT {field_names}
-            FROM {table} t1
-            WHERE {clauses}
-            ORDER BY timestamp DESC
-            """.format(
-                field_names=', '.join(fields),
-                table=table,
-                clauses=' AND '.join(filter(bool,
-                                            [timestamp_clause,
-                                             conditions_clause])),
-            ))
-        results = conn.execute(query, **conditions,
-                               timestamp=timestamp).fetchall()
+        results = conn.execute(query, timestamp=timestamp,
+                               **_bind_conditions(conditions, in_keys)
+                               ).fetchall()
 
     if results:
         return [dict(zip(fields, row)) for row in results]
@@ -253,6 +1391,229 @@ def get_latest_items(table, fields, timestamp=None, conditions=None,
         return []
 
 
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _get_current_items_query(table, fields, condition_keys, primary_keys=(),
+                             has_after=False, has_limit=False, in_keys=()):
+    clauses = [_condition_clause(key, in_keys) for key in condition_keys]
+    if has_after:
+        clauses.append(_keyset_clause(primary_keys))
+
+    return sql_text(
+        """
+        SELECT {field_names}
+        FROM {table}
+        {where} {clauses}
+        ORDER BY {order}
+        {limit_clause}
+        """.format(
+            field_names=', '.join(fields),
+            table=_current_table(table),
+            where='WHERE' if clauses else '',
+            clauses=' AND '.join(clauses),
+            order=_keyset_order(primary_keys),
+            limit_clause='LIMIT :limit' if has_limit else '',
+        ))
+
+
+def _get_current_items(table, fields, conditions):
+    """Read the present versions straight from <table>_current."""
+    in_keys = _in_keys(conditions)
+    query = _get_current_items_query(table, tuple(fields),
+                                     tuple(sorted(conditions)),
+                                     tuple(_current_tables[table]),
+                                     in_keys=in_keys)
+    with get_connection() as conn:
+        results = conn.execute(
+            query, **_bind_conditions(conditions, in_keys)).fetchall()
+
+    return [dict(zip(fields, row)) for row in results]
+
+
+def iter_latest_items(table, fields, timestamp=None, conditions=None,
+                      primary_keys=None, limit=None, after=None):
+    """Stream the latest version of many items, newest first.
+
+    Same versioning and filtering as get_latest_items, but rows are pulled
+    through a server-side cursor as they are consumed, so memory stays flat
+    however many rows match. Keyset pagination: `limit` bounds the rows,
+    and `after` is the (timestamp, primary keys...) key of the last row of
+    the previous page, as returned by decode_cursor().
+    """
+    conditions = conditions or {}
+    assert isinstance(conditions, dict)
+
+    primary_keys = tuple(key for key in primary_keys or []
+                         if key != 'timestamp')
+    assert primary_keys, 'iter_latest_items requires primary_keys'
+
+    params = dict(conditions, timestamp=timestamp, limit=limit)
+    if after:
+        params.update(('after_%s' % key, value) for key, value
+                      in zip(('timestamp',) + primary_keys, after))
+
+    if _read_table(table, timestamp) != table:
+        query = _get_current_items_query(table, tuple(fields),
+                                         tuple(sorted(conditions)),
+                                         primary_keys, bool(after),
+                                         bool(limit))
+    else:
+        query = _get_latest_items_query(table, tuple(fields),
+                                        tuple(sorted(conditions)),
+                                        bool(timestamp), primary_keys,
+                                        bool(after), bool(limit))
+
+    with get_connection() as conn:
+        results = conn.execution_options(stream_results=True).execute(
+            query, **params)
+        for row in results:
+            yield dict(zip(fields, row))
+
+
+def encode_cursor(item, primary_keys):
+    """An opaque pagination cursor pointing just past the item."""
+    key = [item['timestamp']] + [
+        str(item[key]) if isinstance(item[key], UUID) else item[key]
+        for key in primary_keys]
+    return base64.urlsafe_b64encode(
+        json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, primary_keys):
+    """Turn a cursor from encode_cursor() back into a keyset key."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8'))
+    except ValueError:
+        raise BadRequest('Invalid cursor: %s' % cursor)
+
+    if not isinstance(key, list) or len(key) != len(primary_keys) + 1:
+        raise BadRequest('Invalid cursor: %s' % cursor)
+    return key
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _get_changes_query(table, fields, condition_keys, primary_keys):
+    version_filters = ['%s=:%s' % (key, key) for key in condition_keys
+                       if key in primary_keys]
+    row_filters = ['%s=:%s' % (key, key) for key in condition_keys
+                   if key not in primary_keys]
+
+    # The mark row survives the LEFT JOIN even when nothing changed. Changed
+    # items that fail the row filters come back unmatched, as tombstones.
+    return sql_text(
+        """
+        WITH horizon AS (
+            SELECT {horizon} AS mark
+        ), changed AS (
+            SELECT DISTINCT ON ({primary_keys}) *
+            FROM {table}
+            WHERE {version_clauses}
+            ORDER BY {primary_keys}, timestamp DESC
+        )
+        SELECT mark.high_water_mark, {matched}, {field_names}
+        FROM (SELECT max(timestamp) AS high_water_mark FROM changed) mark
+        LEFT JOIN changed latest ON TRUE
+        ORDER BY {order}
+        """.format(
+            horizon=_SETTLED_HORIZON,
+            field_names=', '.join('latest.%s' % field for field in fields),
+            table=table,
+            primary_keys=', '.join(primary_keys),
+            version_clauses=' AND '.join(
+                ['timestamp > :since',
+                 'timestamp <= (SELECT mark FROM horizon)']
+                + version_filters),
+            matched=' AND '.join(
+                ['TRUE'] + ['latest.%s' % clause for clause in row_filters]),
+            order=', '.join('latest.%s DESC' % key
+                            for key in ('timestamp',) + primary_keys),
+        ))
+
+
+@instrumented('get_changes', count_rows=lambda result: len(result[0]))
+def get_changes(table, fields, since, conditions=None, primary_keys=None):
+    """Return the items with versions written after `since`.
+
+    Returns (items, removed, high_water_mark): the latest version of every
+    item that changed, newest first, the primary keys of the changed items
+    that no longer pass the conditions, and the timestamp to pass as
+    `since` next time. Conditions on primary keys pick the items to diff;
+    any others filter their latest versions, as in get_latest_items, so
+    an item leaving the filter (e.g. an offer closing) shows up in
+    removed. Only settled versions are returned (see _SETTLED_HORIZON), so
+    a transaction committing late cannot slip in below the mark.
+    """
+    conditions = conditions or {}
+    assert isinstance(conditions, dict)
+
+    primary_keys = tuple(key for key in primary_keys or []
+                         if key != 'timestamp')
+    assert primary_keys, 'get_changes requires primary_keys'
+
+    query = _get_changes_query(table, tuple(fields),
+                               tuple(sorted(conditions)), primary_keys)
+    with get_connection() as conn:
+        results = conn.execute(query, since=since, lag_ms=_changes_lag_ms,
+                               max_lag_ms=_changes_max_lag_ms,
+                               **conditions).fetchall()
+
+    high_water_mark = results[0][0]
+    if high_water_mark is None:
+        return [], [], since
+
+    items, removed = [], []
+    for row in results:
+        item = dict(zip(fields, row[2:]))
+        if not row[1]:
+            removed.append({key: item[key] for key in primary_keys})
+        else:
+            items.append(item)
+    return items, removed, high_water_mark
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _get_high_water_mark_query(table, condition_keys, has_timestamp):
+    clauses = ['%s=:%s' % (key, key) for key in condition_keys]
+    if has_timestamp:
+        clauses.append('timestamp <= :timestamp')
+
+    return sql_text(
+        """
+        SELECT CASE WHEN max(timestamp) <= (SELECT {horizon})
+                    THEN max(timestamp) END
+        FROM {table}
+        {where} {clauses}
+        """.format(
+            horizon=_SETTLED_HORIZON,
+            table=table,
+            where='WHERE' if clauses else '',
+            clauses=' AND '.join(clauses),
+        ))
+
+
+@instrumented('get_high_water_mark', count_rows=_count_item)
+def get_high_water_mark(table, conditions=None, timestamp=None):
+    """Return the newest timestamp written to the matching rows, or None.
+
+    Tables are append-only, so this changes whenever any matching item
+    does. With an index on (conditions..., timestamp) it is one index probe,
+    cheap enough to decide whether a client's copy is still current. It is
+    also None while the newest version is not settled (see
+    _SETTLED_HORIZON): a transaction still open could yet write a version
+    below it, which the mark would not show.
+    """
+    conditions = conditions or {}
+    assert isinstance(conditions, dict)
+
+    query = _get_high_water_mark_query(table, tuple(sorted(conditions)),
+                                       bool(timestamp))
+    with get_connection() as conn:
+        return conn.execute(query, timestamp=timestamp,
+                            lag_ms=_changes_lag_ms,
+                            max_lag_ms=_changes_max_lag_ms,
+                            **conditions).scalar()
+
+
 @contextmanager
 def expanding(value, seen):
     if value in seen:
@@ -288,6 +1649,21 @@ def _in_whitelist(key, whitelist):
     return False
 
 
+def _get_related(id_, expander, timestamp):
+    """get_item for an expansion, going through the identity map if any."""
+    identity_map = get_identity_map()
+    table, fields = expander['table'], expander['fields']
+    if identity_map is not None:
+        nested = identity_map.get(table, id_, timestamp, fields)
+        if nested:
+            return nested
+
+    nested = get_item(id_, table, fields, timestamp=timestamp)
+    if nested and identity_map is not None:
+        identity_map.add(table, id_, timestamp, nested)
+    return nested
+
+
 def _expand_dict(obj, timestamp, seen, expanders, whitelist, path):
     id_suffix = '_id'
     ids_suffix = '_ids'
@@ -318,8 +1694,7 @@ def _expand_dict(obj, timestamp, seen, expanders, whitelist, path):
                 model_path = _path_join(path, model)
                 expander = expanders[model]
 
-                nested = get_item(value, expander['table'], expander['fields'],
-                                  timestamp=timestamp)
+                nested = _get_related(value, expander, timestamp)
                 if nested:
                     assert model not in obj
                     with expanding(value, seen):
@@ -353,8 +1728,7 @@ def _expand_dict(obj, timestamp, seen, expanders, whitelist, path):
                 assert isinstance(value, list)
 
                 for subitem in value:
-                    nested = get_item(subitem, expander['table'],
-                                      expander['fields'], timestamp=timestamp)
+                    nested = _get_related(subitem, expander, timestamp)
 
                     if nested:
                         with expanding(subitem, seen):
@@ -421,6 +1795,188 @@ def expand(obj, latest=False, timestamp=None, seen=None, expanders=None,
         return obj
 
 
+# A *_id or *_ids reference waiting to be filled in by expand_batched.
+_Relation = namedtuple('_Relation', [
+    'container', 'slot', 'id', 'model', 'expander', 'timestamp', 'ancestors',
+    'path', 'ids'])
+
+
+def _collect_dict(obj, timestamp, ancestors, expanders, whitelist, path,
+                  pending):
+    id_suffix = '_id'
+    ids_suffix = '_ids'
+
+    # Same pinning semantics as _expand_dict.
+    timestamp = timestamp or obj.get('timestamp')
+    for key, value in list(obj.items()):
+        key_path = _path_join(path, key)
+        if value is None or not _in_whitelist(key_path, whitelist):
+            obj.pop(key)
+            continue
+
+        if isinstance(value, UUID):
+            value = str(value)
+            obj[key] = value
+
+        if key.endswith(id_suffix):
+            model = key[:-len(id_suffix)]
+
+            if model in expanders:
+                obj.pop(key)
+                assert model not in obj
+                # Hold the key's place so the output keeps expand()'s order.
+                obj[model] = None
+                pending.append(_Relation(
+                    obj, model, value, model, expanders[model], timestamp,
+                    ancestors, _path_join(path, model), None))
+
+        elif key.endswith(ids_suffix):
+            model = key[:-len(ids_suffix)]
+            if model in expanders:
+                obj.pop(key)
+
+                models = model + 's'
+                models_path = _path_join(path, _path_listify(models))
+                assert isinstance(value, list)
+
+                obj[models] = [None] * len(value)
+                for index, subitem in enumerate(value):
+                    pending.append(_Relation(
+                        obj[models], index, subitem, model, expanders[model],
+                        timestamp, ancestors, models_path, value))
+
+        else:
+            _collect(value, timestamp, ancestors, expanders, whitelist,
+                     key_path, pending)
+
+    return obj
+
+
+def _collect(obj, timestamp, ancestors, expanders, whitelist, path, pending):
+    """Serialize obj like expand() does, deferring every lookup to pending."""
+    if isinstance(obj, dict):
+        return _collect_dict(obj, timestamp, ancestors, expanders, whitelist,
+                             path, pending)
+
+    elif isinstance(obj, list):
+        for index, item in enumerate(obj):
+            obj[index] = _collect(item, timestamp, ancestors, expanders,
+                                  whitelist, _path_listify(path), pending)
+        return obj
+
+    elif isinstance(obj, tuple):
+        return tuple(_collect(x, timestamp, ancestors, expanders, whitelist,
+                              _path_join(path, '()'), pending) for x in obj)
+
+    elif isinstance(obj, UUID):
+        return str(obj)
+
+    else:
+        return obj
+
+
+def _fetch_group(ids, table, fields, timestamp):
+    """get_items for an expansion, going through the identity map if any."""
+    identity_map = get_identity_map()
+    if identity_map is None:
+        return get_items(ids, table, fields, timestamp=timestamp)
+
+    found = {}
+    missing = set()
+    for id_ in ids:
+        item = identity_map.get(table, id_, timestamp, fields)
+        if item:
+            found[str(id_)] = item
+        else:
+            missing.add(id_)
+
+    for id_, item in get_items(missing, table, fields,
+                               timestamp=timestamp).items():
+        identity_map.add(table, id_, timestamp, item)
+        found[id_] = item
+
+    return found
+
+
+def _fetch_relations(relations):
+    """Fetch every relation with one query per (table, fields, timestamp)."""
+    groups = {}
+    for relation in relations:
+        key = (relation.expander['table'],
+               tuple(relation.expander['fields']),
+               relation.timestamp)
+        groups.setdefault(key, set()).add(relation.id)
+
+    return {key: _fetch_group(ids, key[0], list(key[1]), key[2])
+            for key, ids in groups.items()}
+
+
+def _resolve_relation(relation, fetched):
+    key = (relation.expander['table'],
+           tuple(relation.expander['fields']),
+           relation.timestamp)
+    nested = fetched[key].get(str(relation.id))
+    if nested:
+        return dict(nested)
+
+    if relation.ids is None:
+        log.warning({
+            'msg': 'failed-expansion',
+            'model_path': relation.path,
+            'model': relation.model,
+            'id': str(relation.id),
+            'timestamp': relation.timestamp,
+        })
+        raise StorageError('Failed expansion of %s: %s' % (
+            relation.model, str(relation.id)))
+    else:
+        log.warning({
+            'msg': 'failed-subitem-expansion',
+            'models_path': relation.path,
+            'model': relation.model,
+            'id': str(relation.id),
+            'timestamp': relation.timestamp,
+        })
+        raise StorageError(
+            'Failed sub-item expansion of %s' % str(relation.ids))
+
+
+def expand_batched(obj, latest=False, timestamp=None, seen=None,
+                   expanders=None, whitelist=None, path=''):
+    """Expand any foo_id values into nested foo objects, breadth first.
+
+    Produces the same output as expand(), but gathers every id needed at
+    each depth of the tree and loads them with one query per expander table
+    and timestamp, instead of one get_item per reference.
+    """
+    if latest:
+        assert timestamp is None
+        timestamp = get_latest_timestamp(obj)
+
+    expanders = {} if expanders is None else expanders
+    ancestors = frozenset(seen or ())
+
+    pending = []
+    obj = _collect(obj, timestamp, ancestors, expanders, whitelist, path,
+                   pending)
+
+    while pending:
+        relations, pending = pending, []
+        fetched = _fetch_relations(relations)
+        for relation in relations:
+            nested = _resolve_relation(relation, fetched)
+            if relation.id in relation.ancestors:
+                raise BadRequest('Circular references found in data. See %s'
+                                 % relation.id)
+
+            relation.container[relation.slot] = _collect(
+                nested, relation.timestamp,
+                relation.ancestors | {relation.id}, expanders, whitelist,
+                relation.path, pending)
+
+    return obj
+
+
 def serialize(obj, whitelist=None):
     """Do not expand anything, but run through expansion to get serialization.
 
@@ -0,0 +1,223 @@
+"""Fan NOTIFY_CHANNEL notifications out to in-process subscribers.
+
+One thread per process LISTENs on a dedicated connection, so the database
+sees a single listener however many subscribers there are.
+"""
+import json
+import logging
+import os
+import queue
+import select
+import threading
+
+import bottleneck
+
+log = logging.getLogger(__name__)
+
+# Seconds between checks that the listening connection is still alive, and
+# between attempts to reconnect it.
+POLL_TIMEOUT = 5
+RECONNECT_DELAY = 1
+
+# Events a slow subscriber may fall behind by before it is dropped.
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+class Listener(object):
+    """Deliver notifications to the subscribers of their key."""
+
+    def __init__(self, channel=None):
+        self.channel = channel or bottleneck.NOTIFY_CHANNEL
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._thread = None
+        self._listening = threading.Event()
+        self._stopping = threading.Event()
+        # Written to by stop() to wake the listening thread from select().
+        self._wake_fd, self._wake_write_fd = os.pipe()
+
+    def subscribe(self, key):
+        """Return a queue that receives every event for key.
+
+        Events are dicts with the table, key and row. A None in the queue
+        means the subscriber fell too far behind and was dropped.
+        """
+        events = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(str(key), set()).add(events)
+        self.start()
+        return events
+
+    def start(self):
+        """Start listening, unless this listener already is."""
+        with self._lock:
+            if self._thread is None:
+                self._stopping.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name='%s-listener' % self.channel,
+                    daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop listening, and wait up to timeout seconds for it to end."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopping.set()
+            os.write(self._wake_write_fd, b'\0')
+            thread.join(timeout)
+
+    def wait_until_listening(self, timeout=None):
+        """Block until the listener is connected, returning whether it is.
+
+        Notifications sent from then on are delivered.
+        """
+        return self._listening.wait(timeout)
+
+    def unsubscribe(self, key, events):
+        with self._lock:
+            subscribers = self._subscribers.get(str(key), set())
+            subscribers.discard(events)
+            if not subscribers:
+                self._subscribers.pop(str(key), None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._subscribers),
+                'subscribers': sum(len(subscribers) for subscribers
+                                   in self._subscribers.values()),
+            }
+
+    def publish(self, payload):
+        """Deliver one notification payload to its key's subscribers."""
+        try:
+            event = json.loads(payload)
+            key = str(event['key'])
+        except (ValueError, KeyError, TypeError):
+            log.warning({'msg': 'bad-notification', 'payload': payload})
+            return
+
+        self.deliver(key, event)
+
+    def deliver(self, key, event):
+        """Queue an event for each of its key's subscribers."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(key, ()))
+
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                self.unsubscribe(key, events)
+                # Make room for the sentinel; the subscriber is gone anyway.
+                _drain(events)
+                events.put_nowait(None)
+
+    def listening(self):
+        """Called each time the listener (re)connects."""
+        pass
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+            except Exception:
+                log.exception({'msg': 'listener-failed',
+                               'channel': self.channel})
+            self._stopping.wait(RECONNECT_DELAY)
+
+    def _listen(self):
+        # Detached from the pool: LISTEN needs its own autocommit connection
+        # for the life of the process.
+        connection = bottleneck._engine.raw_connection()
+        connection.detach()
+        dbapi_connection = connection.connection
+        dbapi_connection.autocommit = True
+        try:
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute('LISTEN %s' % self.channel)
+            self.listening()
+            self._listening.set()
+
+            while not self._stopping.is_set():
+                readable, _, _ = select.select(
+                    [dbapi_connection, self._wake_fd], [], [], POLL_TIMEOUT)
+                if self._wake_fd in readable:
+                    _drain_fd(self._wake_fd)
+                    continue
+                if not readable:
+                    with dbapi_connection.cursor() as cursor:
+                        cursor.execute('SELECT 1')
+                    continue
+
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    self.publish(notify.payload)
+        finally:
+            self._listening.clear()
+            connection.close()
+
+
+class InvalidationListener(Listener):
+    """Drop reference rows written by any process from the reference cache.
+
+    Notifications on INVALIDATE_CHANNEL are keyed on the written row's id.
+    """
+
+    def __init__(self):
+        super(InvalidationListener, self).__init__(
+            bottleneck.INVALIDATE_CHANNEL)
+
+    def deliver(self, key, event):
+        bottleneck.invalidate_reference(event.get('table'), key)
+
+    def listening(self):
+        # Anything written while nobody was listening may be cached.
+        bottleneck.clear_reference_cache()
+
+
+def _drain(events):
+    while True:
+        try:
+            events.get_nowait()
+        except queue.Empty:
+            return
+
+
+def _drain_fd(fd):
+    """Read whatever stop() has written."""
+    while select.select([fd], [], [], 0)[0]:
+        os.read(fd, 1024)
+
+
+_listener = Listener()
+_invalidation_listener = InvalidationListener()
+
+
+def subscribe(key):
+    """Subscribe to the process-wide listener. See Listener.subscribe."""
+    return _listener.subscribe(key)
+
+
+def unsubscribe(key, events):
+    _listener.unsubscribe(key, events)
+
+
+def get_listener_stats():
+    return _listener.stats()
+
+
+def start_invalidation_listener():
+    """Start invalidating the reference cache of this process."""
+    _invalidation_listener.start()
+
+
+def wait_for_invalidation_listener(timeout=None):
+    """Block until rows cached from now on will be invalidated.
+
+    The cache is cleared as the listener connects, so rows cached before
+    then are not kept. Returns whether it connected within timeout.
+    """
+    return _invalidation_listener.wait_until_listening(timeout)
@@ -0,0 +1,80 @@
+import threading
+from bisect import bisect_left
+
+# Upper bounds, in milliseconds, of the default latency buckets.
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500,
+                      5000, 10000)
+
+
+class Histogram(object):
+    """A thread-safe histogram of observations in fixed buckets."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        # One extra slot for observations above the last bucket.
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """Return cumulative bucket counts, the total count and the sum."""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            running += count
+            cumulative.append((bound, running))
+
+        return {
+            'buckets': cumulative,
+            'count': running,
+            'sum': total,
+        }
+
+
+class Series(object):
+    """Latency histogram and row counter for one set of labels."""
+
+    def __init__(self):
+        self.latency_ms = Histogram()
+        self.rows = 0
+
+    def observe(self, latency_ms, rows=0):
+        self.latency_ms.observe(latency_ms)
+        # Only ever incremented, and a lost update under a race is harmless.
+        self.rows += rows
+
+
+class Metrics(object):
+    """Series of observations, keyed by a tuple of label values."""
+
+    def __init__(self, label_names):
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, latency_ms, rows=0):
+        series = self._series.get(labels)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(labels, Series())
+        series.observe(latency_ms, rows)
+
+    def snapshot(self):
+        """Return [(labels dict, latency snapshot, rows)] for every series."""
+        with self._lock:
+            series = list(self._series.items())
+
+        return [(dict(zip(self.label_names, labels)),
+                 item.latency_ms.snapshot(),
+                 item.rows)
+                for labels, item in sorted(series)]
@@ -13,6 +13,9 @@ setup(
     url=git_repo_url,
     packages=find_packages(),
     entry_points={'console_scripts': [
-        '%s-serve = %s.main:main' % (twobradleys_app_name, twobradleys_app_name)
+        '%s-serve = %s.main:main' % (
+            twobradleys_app_name, twobradleys_app_name),
+        '%s-backfill-current = %s.main:backfill_current' % (
+            twobradleys_app_name, twobradleys_app_name),
     ]},
 )
@@ -1,18 +1,16 @@
 import pytest
-from bottleneck import clean_db
 
-from bigleague.storage import get_tables
+from bigleague.storage import reset_tables
 from bigleague.app import create_app_singletons
 
 
 @pytest.yield_fixture
 def db():
-    tables = get_tables()
-    clean_db(tables)
+    reset_tables()
     try:
         yield
     finally:
-        clean_db(tables)
+        reset_tables()
 
 
 @pytest.fixture
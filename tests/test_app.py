@@ -1,2 +1,11 @@
 def test_health(client):
     assert client.get('/health').status_code == 200
+
+
+def test_metrics(client):
+    client.get('/health')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'bigleague_request_duration_seconds_count{' in body
+    assert 'route="/health"' in body
@@ -0,0 +1,296 @@
+import threading
+from uuid import uuid4
+
+from sqlalchemy import create_engine, exc
+from werkzeug.exceptions import BadRequest
+
+import bottleneck
+from bottleneck import (backfill_current, begin_request, end_request,
+                        finish_request, get_db_url, get_history_cache_stats,
+                        get_pool_stats, transaction,
+                        get_query_cache_stats, get_reference_cache_stats,
+                        invalidate_reference)
+from bottleneck.cache import LRUCache
+from bottleneck.notify import (Listener, start_invalidation_listener,
+                               wait_for_invalidation_listener)
+from bigleague.storage.offers import (put_offer, put_offers, get_offer,
+                                      get_offers, get_offer_high_water_mark)
+from bigleague.storage.players import put_player, get_player
+
+WRITERS = 8
+WRITES_PER_WRITER = 25
+
+
+def offer_keys():
+    return {
+        'game_id': str(uuid4()),
+        'home_index': 3,
+        'away_index': 7,
+        'player_id': str(uuid4()),
+    }
+
+
+def test_put_item_returns_the_row_it_wrote(db):
+    """Concurrent versions of one offer never leak into each other's result.
+
+    Every writer puts versions of the same offer with its own prices, so a
+    returned row with someone else's price means we read back the wrong
+    version.
+    """
+    offer = {
+        'game_id': str(uuid4()),
+        'home_index': 3,
+        'away_index': 7,
+        'player_id': str(uuid4()),
+        'type': 'buy',
+    }
+    mismatches = []
+    written = []
+
+    def writer(writer_index):
+        for write_index in range(WRITES_PER_WRITER):
+            price = writer_index * 1000 + write_index
+            try:
+                stored = put_offer(dict(offer, price=price))
+            except BadRequest:
+                # Two versions landed on the same millisecond.
+                continue
+            written.append(price)
+            if stored['price'] != price:
+                mismatches.append((price, stored['price']))
+
+    threads = [threading.Thread(target=writer, args=(index,))
+               for index in range(WRITERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert written
+    assert mismatches == []
+    assert get_offer(**offer)['price'] in written
+
+
+def test_listener_fans_out_by_key(db):
+    listener = Listener()
+    keys = offer_keys()
+    game_id = keys['game_id']
+    first, second = listener.subscribe(game_id), listener.subscribe(game_id)
+    other = listener.subscribe(uuid4())
+    try:
+        assert listener.wait_until_listening(timeout=5)
+        put_offer(dict(keys, type='buy', price=10))
+
+        event = first.get(timeout=5)
+        assert second.get(timeout=5) == event
+        assert (event['table'], event['key'], event['row']['price']) == (
+            'offer', game_id, 10)
+        assert other.empty()
+    finally:
+        listener.stop(timeout=5)
+
+    listener.unsubscribe(game_id, first)
+    listener.unsubscribe(game_id, second)
+    assert listener.stats() == {'keys': 1, 'subscribers': 1}
+
+
+def test_cache_expires_and_discards():
+    cache = LRUCache(10, ttl=-1)
+    cache.put('stale', 1)
+    assert cache.get('stale') is None
+    assert cache.stats()['expirations'] == 1
+
+    cache = LRUCache(10)
+    cache.put(('team', 'a'), {'id': 'a'})
+    cache.put(('team', 'b'), {'id': 'b'})
+    assert cache.discard_where(lambda key, row: row['id'] == 'a') == 1
+    assert cache.get(('team', 'a')) is None
+    assert cache.get(('team', 'b')) == {'id': 'b'}
+
+
+def test_reference_cache_serves_every_lookup_key(db):
+    # The cache is cleared as the listener connects; wait for that first.
+    start_invalidation_listener()
+    assert wait_for_invalidation_listener(timeout=5)
+
+    player = put_player({'handle': 'cached'})
+    assert get_player(handle='cached')['id'] == player['id']
+
+    hits = get_reference_cache_stats()['hits']
+    assert get_player(id=player['id'])['handle'] == 'cached'
+    assert get_player(auth_token=player['auth_token'])['handle'] == 'cached'
+    assert get_reference_cache_stats()['hits'] == hits + 2
+
+    invalidate_reference('player', player['id'])
+    assert get_player(id=player['id'])['handle'] == 'cached'
+    assert get_reference_cache_stats()['hits'] == hits + 2
+
+
+def test_history_cache_serves_reads_past_the_horizon(db, monkeypatch):
+    keys = offer_keys()
+    timestamp = put_offer(dict(keys, type='buy', price=10))['timestamp']
+    size = get_history_cache_stats()['size']
+
+    assert get_offer(timestamp=timestamp, **keys)['price'] == 10
+    assert get_history_cache_stats()['size'] == size
+
+    monkeypatch.setattr(bottleneck, '_history_horizon_ms', 0)
+    assert get_offer(timestamp=timestamp, **keys)['price'] == 10
+    stats = get_history_cache_stats()
+    assert stats['size'] == size + 1
+
+    put_offer(dict(keys, type='buy', price=20))
+    assert get_offer(timestamp=timestamp, **keys)['price'] == 10
+    assert get_history_cache_stats()['hits'] == stats['hits'] + 1
+    assert get_offer(**keys)['price'] == 20
+
+
+def test_current_reads_match_history(db):
+    keys = offer_keys()
+    offers = put_offers([dict(keys, home_index=index, type='buy', price=index)
+                         for index in range(5)])
+    latest = put_offers([dict(offers[0], price=99)])[0]['timestamp']
+
+    current = get_offers(game_id=keys['game_id'])
+    assert sorted(offer['price'] for offer in current) == [1, 2, 3, 4, 99]
+    assert get_offers(game_id=keys['game_id'], timestamp=latest) == current
+
+    backfill_current('offer')
+    assert get_offers(game_id=keys['game_id']) == current
+
+
+def test_statements_are_built_and_compiled_once(db):
+    get_offers(game_id=str(uuid4()))
+    before = get_query_cache_stats()
+
+    get_offers(game_id=str(uuid4()))
+    after = get_query_cache_stats()
+
+    built = before['get_current_items']
+    assert after['get_current_items'] == dict(built, hits=built['hits'] + 1)
+    assert after['compiled']['hits'] == before['compiled']['hits'] + 1
+
+
+def test_unit_of_work_commits_on_success(db):
+    keys = offer_keys()
+    begin_request()
+    put_offer(dict(keys, type='buy', price=10))
+    end_request()
+
+    assert get_offer(**keys)['price'] == 10
+
+
+def test_unit_of_work_rolls_back_on_an_error_status(db):
+    keys = offer_keys()
+    begin_request()
+    put_offer(dict(keys, type='buy', price=10))
+    # What the app does with a response status of 400 or more.
+    finish_request(commit=False)
+    end_request()
+
+    assert get_offer(**keys) is None
+
+
+def test_unit_of_work_rolls_back_on_an_exception(db):
+    keys = offer_keys()
+    begin_request()
+    put_offer(dict(keys, type='buy', price=10))
+    end_request(ValueError('Request failed'))
+
+    assert get_offer(**keys) is None
+
+
+def test_read_only_unit_of_work_reads_one_snapshot(db):
+    keys = offer_keys()
+    begin_request(read_only=True)
+    try:
+        assert get_offer(**keys) is None
+        writer = threading.Thread(target=put_offer,
+                                  args=(dict(keys, type='buy', price=10),))
+        writer.start()
+        writer.join()
+        assert get_offer(**keys) is None
+    finally:
+        end_request()
+
+    assert get_offer(**keys)['price'] == 10
+
+
+def open_session(engine, statement):
+    """Begin a transaction on its own connection and leave it open."""
+    conn = engine.connect()
+    conn.begin()
+    conn.execute(statement)
+    return conn
+
+
+def test_open_readers_do_not_hold_back_the_high_water_mark(db):
+    engine = create_engine(get_db_url('bigleague'))
+    keys = offer_keys()
+    try:
+        open_session(engine, 'SELECT 1')
+        offer = put_offer(dict(keys, type='buy', price=10))
+        assert (get_offer_high_water_mark(game_id=keys['game_id'])
+                == offer['timestamp'])
+    finally:
+        engine.dispose()
+
+
+def test_open_writers_hold_back_the_high_water_mark_up_to_the_max_lag(
+        db, monkeypatch):
+    engine = create_engine(get_db_url('bigleague'))
+    keys = offer_keys()
+    try:
+        # Holding a transaction id is what marks a session as a writer.
+        open_session(engine, 'SELECT txid_current()')
+        offer = put_offer(dict(keys, type='buy', price=10))
+        assert get_offer_high_water_mark(game_id=keys['game_id']) is None
+
+        monkeypatch.setattr(bottleneck, '_changes_max_lag_ms', 0)
+        assert (get_offer_high_water_mark(game_id=keys['game_id'])
+                == offer['timestamp'])
+    finally:
+        engine.dispose()
+
+
+def test_pool_stats_count_checkouts(db):
+    with transaction():
+        pass
+    compiled = get_query_cache_stats()['compiled']['size']
+    stats = get_pool_stats()
+
+    with transaction():
+        assert get_pool_stats()['checked_out'] == stats['checked_out'] + 1
+
+    after = get_pool_stats()
+    assert after['checked_out'] == stats['checked_out']
+    assert (after['checkout_wait_ms']['count']
+            == stats['checkout_wait_ms']['count'] + 1)
+    # Pinging the checked out connection compiles nothing new.
+    assert get_query_cache_stats()['compiled']['size'] == compiled
+
+
+def test_pool_checkout_times_out(db, monkeypatch):
+    engine = create_engine(get_db_url('bigleague'), pool_size=1,
+                           max_overflow=0, pool_timeout=0.1)
+    monkeypatch.setattr(bottleneck, '_engine', engine)
+    timeouts = get_pool_stats()['checkout_timeouts']
+    errors = []
+
+    def checkout():
+        try:
+            with transaction():
+                pass
+        except exc.TimeoutError as e:
+            errors.append(e)
+
+    try:
+        with transaction():
+            waiter = threading.Thread(target=checkout)
+            waiter.start()
+            waiter.join()
+    finally:
+        engine.dispose()
+
+    assert len(errors) == 1
+    assert get_pool_stats()['checkout_timeouts'] == timeouts + 1
@@ -0,0 +1,529 @@
+import copy
+import json
+import re
+import threading
+import time
+
+import pytest
+
+import bottleneck
+from bottleneck import (clear_identity_map, expand, expand_batched,
+                        start_identity_map, transaction)
+from bigleague.lib.digits import get_cell_indexes, get_remembered_digit_index
+from bigleague.lib.matching import submit_offer
+from bigleague.lib.scores import ingest_scores
+from bigleague.storage.cells import get_cells
+from bigleague.storage.games import (get_game, get_games, start_game,
+                                     transition_game)
+from bigleague.storage.offers import get_offers
+from bigleague.views import get_expanders
+
+BUYERS = 5
+WHITELIST = [re.compile(pattern) for pattern in (
+    r'(\[\]\.)?(home_index|away_index|price|state)$',
+    r'(\[\]\.)?(player_id|player\.handle)$',
+    r'(\[\]\.)?(game_id|game\.event_name)$',
+    r'(\[\]\.)?(home_team_id|home_team\.name)$',
+)]
+
+
+class Worker(threading.Thread):
+    """A thread whose join() returns its result, or re-raises its error."""
+
+    def __init__(self, target, *args):
+        super(Worker, self).__init__()
+        self._work = lambda: target(*args)
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self._work()
+        except Exception as e:
+            self.error = e
+
+    def join(self, timeout=None):
+        super(Worker, self).join(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def post_json(client, url, body):
+    return client.post(url, data=json.dumps(body),
+                       content_type='application/json')
+
+
+def create_game(client):
+    home_team, away_team = [
+        json.loads(post_json(client, '/v1/team', {
+            'name': name,
+            'sport': 'football',
+        }).get_data(as_text=True))
+        for name in ('Home', 'Away')]
+    response = post_json(client, '/v1/game', {
+        'event_name': 'Test Bowl',
+        'sport': 'football',
+        'home_team_id': home_team['id'],
+        'away_team_id': away_team['id'],
+    })
+    assert response.status_code == 200
+    return json.loads(response.get_data(as_text=True))
+
+
+def test_create_game_builds_board(client, db):
+    game = create_game(client)
+
+    cells = get_cells(game_id=game['id'])
+    offers = get_offers(game_id=game['id'])
+
+    assert len(cells) == 100
+    assert len(offers) == 100
+    assert ({(cell['home_index'], cell['away_index']) for cell in cells}
+            == {(h, a) for h in range(10) for a in range(10)})
+    assert all(offer['type'] == 'sell' and offer['price'] == 50
+               for offer in offers)
+
+
+def test_cells_paginate_with_cursor(client, db):
+    game = create_game(client)
+    url = '/v1/cells/by-game/%s' % game['id']
+
+    full = json.loads(client.get(url).get_data(as_text=True))
+    assert len(full) == 100
+
+    seen = []
+    cursor = None
+    while True:
+        query = {'limit': 30}
+        if cursor:
+            query['cursor'] = cursor
+        page = json.loads(client.get(url, query_string=query)
+                          .get_data(as_text=True))
+        seen.extend(page['items'])
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+
+    assert [cell['id'] for cell in seen] == [cell['id'] for cell in full]
+
+
+def test_cell_changes_since(client, db):
+    game = create_game(client)
+    url = '/v1/cells/by-game/%s' % game['id']
+
+    changes = json.loads(client.get(url, query_string={'since': 0})
+                         .get_data(as_text=True))
+    assert len(changes['items']) == 100
+
+    mark = changes['high_water_mark']
+    changes = json.loads(client.get(url, query_string={'since': mark})
+                         .get_data(as_text=True))
+    assert changes == {'items': [], 'removed': [], 'high_water_mark': mark}
+
+
+def test_offer_changes_report_offers_leaving_the_filter(client, db):
+    game = create_game(client)
+    player = json.loads(post_json(client, '/v1/player', {
+        'handle': 'poller'}).get_data(as_text=True))
+    url = '/v1/offer/%s/by-index/1/1' % game['id']
+
+    def poll(since):
+        return json.loads(client.get(
+            '/v1/offers/%s' % game['id'],
+            query_string={'since': since, 'state': 'open'},
+        ).get_data(as_text=True))
+
+    mark = poll(0)['high_water_mark']
+    client.put(url, data=json.dumps({
+        'player_id': player['id'], 'type': 'buy', 'price': 10,
+    }), content_type='application/json')
+    changes = poll(mark)
+    assert [offer['player_id'] for offer in changes['items']] == [
+        player['id']]
+
+    client.delete(url, query_string={'player_id': player['id']})
+    changes = poll(changes['high_water_mark'])
+    assert changes['items'] == []
+    assert changes['removed'] == [{
+        'game_id': game['id'], 'home_index': 1, 'away_index': 1,
+        'player_id': player['id']}]
+
+
+def test_board(client, db):
+    game = create_game(client)
+
+    response = client.get('/v1/board/%s' % game['id'])
+    assert response.status_code == 200
+    board = json.loads(response.get_data(as_text=True))
+
+    assert board['game']['id'] == game['id']
+    assert len(board['teams']) == 2
+    assert len(board['cells']) == 10
+    assert all(len(row) == 10 for row in board['cells'])
+    assert all(len(cell['offers']) == 1
+               for row in board['cells'] for cell in row)
+
+
+def test_batched_expansion_matches_expand(client, db):
+    game = create_game(client)
+    player = json.loads(post_json(client, '/v1/player', {
+        'handle': 'expanded'}).get_data(as_text=True))
+    submit_offer({'game_id': game['id'], 'home_index': 0, 'away_index': 0,
+                  'player_id': player['id'], 'type': 'buy', 'price': 60})
+
+    rows = {
+        'cells': get_cells(game_id=game['id']),
+        'games': get_games(),
+        'offers': get_offers(game_id=game['id']),
+    }
+    for name, items in rows.items():
+        for whitelist in (None, WHITELIST):
+            expected = expand(copy.deepcopy(items), expanders=get_expanders(),
+                              whitelist=whitelist)
+            assert expand_batched(copy.deepcopy(items),
+                                  expanders=get_expanders(),
+                                  whitelist=whitelist) == expected, name
+
+
+def test_identity_map_loads_each_entity_once(client, db):
+    game = create_game(client)
+    cells = get_cells(game_id=game['id'])
+
+    start_identity_map()
+    try:
+        # Every cell shares one game, two teams and the house player.
+        expand_batched(copy.deepcopy(cells), expanders=get_expanders())
+        expand_batched(copy.deepcopy(cells), expanders=get_expanders())
+    finally:
+        stats = clear_identity_map()
+
+    assert stats == {'size': 4, 'hits': 4, 'misses': 4}
+
+
+def test_unchanged_cells_are_not_modified(client, db):
+    game = create_game(client)
+    url = '/v1/cells/by-game/%s' % game['id']
+
+    response = client.get(url)
+    # Read the streamed body, which releases the request's cursor.
+    assert len(json.loads(response.get_data(as_text=True))) == 100
+    etag = response.headers['ETag']
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+
+def test_batch_offers(client, db):
+    game = create_game(client)
+    player = json.loads(post_json(client, '/v1/player', {
+        'handle': 'market-maker'}).get_data(as_text=True))
+
+    response = post_json(client, '/v1/offers/%s/batch' % game['id'], {
+        'player_id': player['id'],
+        'operations': [
+            {'home_index': 0, 'away_index': 0, 'type': 'buy', 'price': 10},
+            {'home_index': 0, 'away_index': 1, 'type': 'buy', 'price': 60},
+            {'home_index': 0, 'away_index': 2, 'type': 'sell', 'price': 70},
+            {'home_index': 0, 'away_index': 0, 'cancel': True},
+        ],
+    })
+    assert response.status_code == 200
+    results = json.loads(response.get_data(as_text=True))
+
+    assert [result.get('offer', {}).get('state') for result in results] == [
+        'open', 'filled', None, None]
+    assert results[1]['offer']['counterparty_price'] == 50
+    owner = get_cells(game_id=game['id'], home_index=0,
+                      away_index=1)[0]['player_id']
+    assert str(owner) == player['id']
+
+
+def test_place_offer_rejections(client, db):
+    game = create_game(client)
+    player = json.loads(post_json(client, '/v1/player', {
+        'handle': 'seller'}).get_data(as_text=True))
+    url = '/v1/offer/%s/by-index/3/4' % game['id']
+
+    def put_offer(body):
+        response = client.put(url, data=json.dumps(body),
+                              content_type='application/json')
+        return (response.status_code,
+                json.loads(response.get_data(as_text=True)))
+
+    status, body = put_offer({'player_id': player['id'], 'type': 'sell',
+                              'price': 20})
+    assert status == 400
+    assert body['message'] == 'You cannot sell a cell you do not own.'
+
+    status, body = put_offer({'player_id': player['id'], 'type': 'buy',
+                              'price': 50})
+    assert status == 200 and body['state'] == 'filled'
+
+    status, body = put_offer({'player_id': player['id'], 'type': 'buy',
+                              'price': 60})
+    assert status == 400
+    assert body['message'] == 'You cannot buy a cell you own.'
+
+
+def test_cancel_offer(client, db):
+    game = create_game(client)
+    player = json.loads(post_json(client, '/v1/player', {
+        'handle': 'canceler'}).get_data(as_text=True))
+    url = '/v1/offer/%s/by-index/2/2' % game['id']
+
+    response = client.put(url, data=json.dumps({
+        'player_id': player['id'], 'type': 'buy', 'price': 10,
+    }), content_type='application/json')
+    assert response.status_code == 200
+
+    response = client.delete(url, query_string={'player_id': player['id']})
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True))['state'] == 'canceled'
+    assert get_offers(game_id=game['id'], player_id=player['id'],
+                      state='open') == []
+
+    response = client.delete(url, query_string={'player_id': player['id']})
+    assert response.status_code == 200
+
+
+def assert_concurrent_buyers_fill_once(client):
+    game = create_game(client)
+    players = [json.loads(post_json(client, '/v1/player', {
+        'handle': 'buyer-%d' % index}).get_data(as_text=True))['id']
+        for index in range(BUYERS)]
+
+    def buy(player_id):
+        return submit_offer({
+            'game_id': game['id'],
+            'home_index': 5,
+            'away_index': 5,
+            'player_id': player_id,
+            'type': 'buy',
+            'price': 60,
+        })['state']
+
+    threads = [Worker(buy, player_id) for player_id in players]
+    for thread in threads:
+        thread.start()
+    states = [thread.join() for thread in threads]
+
+    assert sorted(states) == ['filled'] + ['open'] * (BUYERS - 1)
+    owner = get_cells(game_id=game['id'], home_index=5,
+                      away_index=5)[0]['player_id']
+    assert str(owner) in players
+
+
+def test_concurrent_buyers_fill_a_cell_once(client, db):
+    assert_concurrent_buyers_fill_once(client)
+
+
+def test_cells_lock_without_current_tables(client, db, monkeypatch):
+    monkeypatch.setattr(bottleneck, '_current_tables', {})
+    assert_concurrent_buyers_fill_once(client)
+
+
+def test_writer_behind_the_lock_supersedes_newer_versions(client, db):
+    game = create_game(client)
+    buyer = json.loads(post_json(client, '/v1/player', {
+        'handle': 'reseller'}).get_data(as_text=True))['id']
+    cell = {'game_id': game['id'], 'home_index': 1, 'away_index': 1}
+    started, bought = threading.Event(), threading.Event()
+
+    def resell():
+        with transaction():
+            # The transaction begins before the purchase below.
+            get_cells(**cell)
+            started.set()
+            bought.wait()
+            return submit_offer(dict(cell, player_id=buyer, type='sell',
+                                     price=70))
+
+    worker = Worker(resell)
+    worker.start()
+    started.wait()
+    time.sleep(0.01)
+    filled = submit_offer(dict(cell, player_id=buyer, type='buy', price=60))
+    bought.set()
+    resold = worker.join()
+
+    assert filled['state'] == 'filled'
+    assert resold['state'] == 'open'
+    assert resold['timestamp'] > filled['timestamp']
+    assert get_offers(player_id=buyer, **cell) == [resold]
+    assert get_offers(player_id=buyer, timestamp=resold['timestamp'],
+                      **cell) == [resold]
+
+
+def test_start_game_deals_digits(client, db):
+    game = create_game(client)
+    url = '/v1/game/%s/start' % game['id']
+
+    response = client.post(url)
+    assert response.status_code == 200
+    started = json.loads(response.get_data(as_text=True))
+    assert started['game']['state'] == 'playing'
+
+    cells = get_cells(game_id=game['id'])
+    home_digits = {(cell['home_index'], cell['home_digit']) for cell in cells}
+    away_digits = {(cell['away_index'], cell['away_digit']) for cell in cells}
+    assert sorted(digit for _, digit in home_digits) == list(range(10))
+    assert sorted(digit for _, digit in away_digits) == list(range(10))
+
+    assert client.post(url).status_code == 400
+
+
+def test_digits_are_remembered_once_the_deal_commits(client, db):
+    game = create_game(client)
+
+    with pytest.raises(RuntimeError):
+        with transaction():
+            start_game(game['id'])
+            raise RuntimeError('Rolled back')
+    assert get_remembered_digit_index(game['id']) is None
+    assert get_game(id=game['id'])['state'] == 'pregame'
+
+    _, cells = start_game(game['id'])
+    digit_index = get_remembered_digit_index(game['id'])
+    for cell in cells:
+        assert get_cell_indexes(digit_index, cell['home_digit'],
+                                cell['away_digit']) == (
+            cell['home_index'], cell['away_index'])
+
+
+def test_read_cell_by_digits(client, db):
+    game = create_game(client)
+    url = '/v1/cell/by-game/%s/by-digits/%d/%d' % (game['id'], 3, 7)
+    assert client.get(url).status_code == 404
+
+    assert client.post('/v1/game/%s/start' % game['id']).status_code == 200
+    response = client.get(url)
+    assert response.status_code == 200
+    cell = json.loads(response.get_data(as_text=True))
+    assert (cell['home_digit'], cell['away_digit']) == (3, 7)
+
+    dealt = get_cells(game_id=game['id'], home_index=cell['home_index'],
+                      away_index=cell['away_index'])
+    assert [(c['home_digit'], c['away_digit']) for c in dealt] == [(3, 7)]
+
+
+def test_canceling_a_game_cancels_its_open_offers(client, db):
+    game = create_game(client)
+    url = '/v1/game/%s/state' % game['id']
+
+    def transition(state):
+        response = client.put(url, data=json.dumps({'state': state}),
+                              content_type='application/json')
+        return (response.status_code,
+                json.loads(response.get_data(as_text=True)))
+
+    status, body = transition('complete')
+    assert status == 400
+
+    status, body = transition('canceled')
+    assert status == 200
+    assert body['game']['state'] == 'canceled'
+    assert body['rows'] == {'game': 1, 'offer': 100}
+    assert get_offers(game_id=game['id'], state='open') == []
+
+    status, body = transition('playing')
+    assert status == 400
+
+
+def test_closing_a_game_waits_for_fills_and_rejects_offers(client, db):
+    game = create_game(client)
+    buyer = json.loads(post_json(client, '/v1/player', {
+        'handle': 'last-buyer'}).get_data(as_text=True))['id']
+    url = '/v1/offer/%s/by-index/4/4' % game['id']
+    filled, closing = threading.Event(), threading.Event()
+
+    def buy():
+        with transaction():
+            offer = submit_offer({'game_id': game['id'], 'home_index': 4,
+                                  'away_index': 4, 'player_id': buyer,
+                                  'type': 'buy', 'price': 60})
+            filled.set()
+            closing.wait()
+            return offer
+
+    buyer_thread = Worker(buy)
+    buyer_thread.start()
+    filled.wait()
+    closer = Worker(transition_game, game['id'], 'canceled')
+    closer.start()
+    time.sleep(0.1)
+    assert closer.is_alive()
+    closing.set()
+
+    assert buyer_thread.join()['state'] == 'filled'
+    _, rows = closer.join()
+    assert rows['offer'] == 99
+    assert get_offers(game_id=game['id'], state='open') == []
+
+    response = client.put(url, data=json.dumps({
+        'player_id': buyer, 'type': 'sell', 'price': 70,
+    }), content_type='application/json')
+    assert response.status_code == 400
+    assert json.loads(response.get_data(as_text=True))['message'] == (
+        'The game is no longer taking offers.')
+
+
+def test_ingest_scores_coalesces_and_drops_stale_events(client, db):
+    game = create_game(client)
+    assert client.post('/v1/game/%s/start' % game['id']).status_code == 200
+
+    def ingest(*events):
+        response = client.post('/v1/games/scores', data=json.dumps({
+            'events': [dict(zip(('home_score', 'away_score', 'observed_at'),
+                                event), game_id=game['id'])
+                       for event in events],
+        }), content_type='application/json')
+        assert response.status_code == 200
+        return json.loads(response.get_data(as_text=True))
+
+    body = ingest((7, 0, 2000), (3, 0, 1000), (14, 3, 3000))
+    assert body['rows'] == {'written': 1, 'coalesced': 2, 'dropped': 0}
+    scored = body['games'][game['id']]
+    assert (scored['home_score'], scored['away_score']) == (14, 3)
+
+    cell = scored['winning_cell']
+    dealt = get_cells(game_id=game['id'], home_index=cell['home_index'],
+                      away_index=cell['away_index'])
+    assert [(c['home_digit'], c['away_digit']) for c in dealt] == [(4, 3)]
+
+    body = ingest((21, 3, 2500), (14, 3, 3000))
+    assert body['rows'] == {'written': 0, 'coalesced': 1, 'dropped': 1}
+    assert body['games'][game['id']]['home_score'] == 14
+
+
+def test_score_batch_behind_the_lock_is_kept(client, db):
+    game = create_game(client)
+    assert client.post('/v1/game/%s/start' % game['id']).status_code == 200
+    started, scored = threading.Event(), threading.Event()
+
+    def score(home_score, observed_at):
+        return ingest_scores([{'game_id': game['id'],
+                               'home_score': home_score, 'away_score': 0,
+                               'observed_at': observed_at}])
+
+    def late_batch():
+        with transaction():
+            # The transaction begins before the other batch is written.
+            get_game(id=game['id'])
+            started.set()
+            scored.wait()
+            return score(14, 3000)
+
+    worker = Worker(late_batch)
+    worker.start()
+    started.wait()
+    time.sleep(0.01)
+    score(7, 2000)
+    scored.set()
+    _, rows = worker.join()
+
+    assert rows['written'] == 1
+    scored_game = get_game(id=game['id'])
+    assert (scored_game['home_score'], scored_game['observed_at']) == (
+        14, 3000)
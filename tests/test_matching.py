@@ -0,0 +1,41 @@
+from bigleague.lib.matching import OrderBook
+
+
+def offer(player_id, type_, price, timestamp=0):
+    return {'player_id': player_id, 'type': type_, 'price': price,
+            'timestamp': timestamp}
+
+
+def test_crossing_buy_fills_at_the_resting_price():
+    book = OrderBook([offer('house', 'sell', 50)])
+
+    assert book.submit(offer('a', 'buy', 40)) is None
+    fill = book.submit(offer('b', 'buy', 60))
+
+    assert fill.resting['player_id'] == 'house'
+    assert fill.price == 50
+    assert book.best('sell') is None
+    assert book.best('buy')['player_id'] == 'a'
+
+
+def test_sell_fills_the_best_then_oldest_bid():
+    book = OrderBook([offer('a', 'buy', 30, timestamp=1),
+                      offer('b', 'buy', 45, timestamp=3),
+                      offer('c', 'buy', 45, timestamp=2)])
+
+    fill = book.submit(offer('owner', 'sell', 40))
+
+    assert (fill.resting['player_id'], fill.price) == ('c', 45)
+    assert len(book) == 2
+
+
+def test_new_offer_replaces_the_players_previous_one():
+    book = OrderBook([offer('house', 'sell', 50)])
+
+    book.submit(offer('a', 'buy', 10))
+    book.submit(offer('a', 'buy', 20))
+    book.submit(offer('house', 'sell', 30))
+
+    assert len(book) == 2
+    assert book.best('buy')['price'] == 20
+    assert book.best('sell')['price'] == 30
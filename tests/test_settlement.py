@@ -0,0 +1,105 @@
+import json
+
+import numpy as np
+
+from bigleague.lib.house import HOUSE_PLAYER_ID
+from bigleague.lib.matching import submit_offer
+from bigleague.lib.scores import ingest_scores
+from bigleague.lib.settlement import (find_winners, compute_payouts,
+                                      get_winnings, load_boards, NO_CELL)
+from bigleague.storage.games import start_game
+from bigleague.storage.payouts import get_payouts
+from test_games import create_game, post_json
+
+
+def board(home_digits, away_digits):
+    """A board holding each cell's position at its digits."""
+    cells = np.full((10, 10), NO_CELL, dtype=np.int16)
+    for home_index, home_digit in enumerate(home_digits):
+        for away_index, away_digit in enumerate(away_digits):
+            cells[home_digit, away_digit] = home_index * 10 + away_index
+    return cells
+
+
+def test_winners_come_from_the_last_digits():
+    boards = np.stack([board(range(10), range(10)),
+                       board(range(9, -1, -1), range(10))])
+
+    positions = find_winners(boards, [17, 3], [21, 10])
+
+    assert positions.tolist() == [71, 60]
+
+
+def test_payouts_split_the_pot_over_the_periods():
+    boards = np.stack([board(range(10), range(10)),
+                       np.full((10, 10), NO_CELL, dtype=np.int16)])
+    owners = np.zeros((2, 100), dtype=np.int32)
+    owners[0, 33] = 1
+
+    positions, winners, amounts = compute_payouts(
+        boards, owners, [[3, 13], [0, 7]], [[3, 20], [0, 7]], [4, 4])
+
+    assert positions.tolist() == [[33, 30], [NO_CELL, NO_CELL]]
+    assert winners.tolist() == [[1, 0], [-1, -1]]
+    assert amounts.tolist() == [[1250, 1250], [0, 0]]
+
+
+def test_winnings_are_totaled_by_player():
+    assert get_winnings([
+        {'player_id': 'a', 'amount': 1250},
+        {'player_id': 'b', 'amount': 1250},
+        {'player_id': 'a', 'amount': 2500},
+    ]) == {'a': 3750, 'b': 1250}
+
+
+def start_scored_game(client, home_score, away_score):
+    """A game under way at a score, and the cell that score lands on."""
+    game = create_game(client)
+    _, cells = start_game(game['id'])
+    ingest_scores([{'game_id': game['id'], 'home_score': home_score,
+                    'away_score': away_score, 'observed_at': 1}])
+    cell = next(cell for cell in cells
+                if cell['home_digit'] == home_score % 10
+                and cell['away_digit'] == away_score % 10)
+    return game, cell
+
+
+def test_settling_a_period_pays_the_winning_cells_owner(client, db):
+    game, cell = start_scored_game(client, 17, 3)
+    winner = json.loads(post_json(client, '/v1/player', {
+        'handle': 'winner'}).get_data(as_text=True))['id']
+    submit_offer({'game_id': game['id'], 'home_index': cell['home_index'],
+                  'away_index': cell['away_index'], 'player_id': winner,
+                  'type': 'buy', 'price': 50})
+    position = cell['home_index'] * 10 + cell['away_index']
+
+    boards, owners, players = load_boards([game['id']])
+    assert boards[0, 7, 3] == position
+    assert players[owners[0, position]] == winner
+
+    response = post_json(client, '/v1/games/settle', {
+        'period': '1st quarter', 'game_ids': [game['id']]})
+    assert response.status_code == 200
+    payouts = get_payouts(game_id=game['id'])
+    assert [(payout['period'], str(payout['player_id']),
+             payout['home_index'], payout['away_index'], payout['amount'])
+            for payout in payouts] == [
+        ('1st quarter', winner, cell['home_index'], cell['away_index'],
+         1250)]
+
+
+def test_completing_a_game_pays_its_final_period(client, db):
+    game, cell = start_scored_game(client, 24, 10)
+
+    response = client.put('/v1/game/%s/state' % game['id'],
+                          data=json.dumps({'state': 'complete'}),
+                          content_type='application/json')
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True))['rows'] == {
+        'game': 1, 'offer': 100, 'payout': 1}
+    payouts = get_payouts(game_id=game['id'])
+    assert [(payout['period'], str(payout['player_id']),
+             payout['home_index'], payout['away_index'], payout['amount'])
+            for payout in payouts] == [
+        ('Final', HOUSE_PLAYER_ID, cell['home_index'], cell['away_index'],
+         1250)]